@@ -0,0 +1,228 @@
+'''
+a reproducible benchmark of the modbus clients against in-process stand-in slaves
+results are written as JSON to compare releases
+
+usage:
+    python -m modbus.benchmark --output bench.json
+    python -m modbus.benchmark --latency 0.005 --drop-rate 0.01 --iterations 200
+'''
+
+import argparse, json, math, platform, sys, time
+
+from .modbus_tcp_client import (ModbusTcpClient, FMT_SIGNED_WORD, FMT_UNSIGNED_WORD, FMT_SIGNED_2WORD,
+                                FMT_UNSIGNED_2WORD, FMT_FLOAT_2WORD, FMT_SIGNED_4WORD, FMT_UNSIGNED_4WORD,
+                                FMT_DOUBLE_4WORD, BYTE_ORDER_BIG_ENDIAN, BYTE_ORDER_LITTLE_ENDIAN,
+                                BYTE_ORDER_BIG_ENDIAN_SWAP, BYTE_ORDER_LITTLE_ENDIAN_SWAP)
+from .mc_protocol_client import McProtocolClient
+from .modbus_rtu_client import ModbusRtuMaster
+from .stand_in_servers import StandInTcpSlave, StandInRtuSlave, StandInMcServer, FaultInjector
+
+ALL_FORMATS = {
+    "FMT_SIGNED_WORD": FMT_SIGNED_WORD, "FMT_UNSIGNED_WORD": FMT_UNSIGNED_WORD,
+    "FMT_SIGNED_2WORD": FMT_SIGNED_2WORD, "FMT_UNSIGNED_2WORD": FMT_UNSIGNED_2WORD,
+    "FMT_FLOAT_2WORD": FMT_FLOAT_2WORD, "FMT_SIGNED_4WORD": FMT_SIGNED_4WORD,
+    "FMT_UNSIGNED_4WORD": FMT_UNSIGNED_4WORD, "FMT_DOUBLE_4WORD": FMT_DOUBLE_4WORD,
+}
+ALL_BYTE_ORDERS = {
+    "BYTE_ORDER_BIG_ENDIAN": BYTE_ORDER_BIG_ENDIAN, "BYTE_ORDER_LITTLE_ENDIAN": BYTE_ORDER_LITTLE_ENDIAN,
+    "BYTE_ORDER_BIG_ENDIAN_SWAP": BYTE_ORDER_BIG_ENDIAN_SWAP, "BYTE_ORDER_LITTLE_ENDIAN_SWAP": BYTE_ORDER_LITTLE_ENDIAN_SWAP,
+}
+DEFAULT_BLOCK_SIZES = (1, 10, 60, 120)
+
+
+def percentile(sorted_values, q):
+    """nearest rank percentile of an ascending list"""
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(math.ceil(q / 100.0 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def measure(name, func, iterations, registers_per_call, **labels):
+    """
+    call func iterations times and summarize latency, throughput and cpu
+    cpu is process time, it includes the in-process stand-in slave
+
+    Returns:
+        result(dict): one JSON record
+    """
+    latencies = []
+    errors = 0
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    for _ in range(iterations):
+        start = time.perf_counter()
+        try:
+            func()
+        except Exception:
+            errors += 1
+            continue
+        latencies.append(time.perf_counter() - start)
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+    latencies.sort()
+    ms = lambda seconds: None if seconds is None else round(seconds * 1000.0, 4)
+    result = {
+        "name": name,
+        "requests": iterations,
+        "errors": errors,
+        "latency_ms": {
+            "mean": ms(sum(latencies) / len(latencies)) if latencies else None,
+            "p50": ms(percentile(latencies, 50)), "p90": ms(percentile(latencies, 90)),
+            "p99": ms(percentile(latencies, 99)), "max": ms(latencies[-1] if latencies else None),
+        },
+        "registers_per_s": round(len(latencies) * registers_per_call / wall, 1) if wall else None,
+        "cpu_us_per_request": round(cpu / iterations * 1e6, 2) if iterations else None,
+    }
+    result.update(labels)
+    return result
+
+
+def bench_codec(iterations, block_sizes):
+    """pack_values/unpack_holding_registers of every format and byte order, no I/O"""
+    results = []
+    for format_name, display_format in ALL_FORMATS.items():
+        words = display_format.bytes // 2
+        for order_name, endianness in ALL_BYTE_ORDERS.items():
+            for block_size in block_sizes:
+                count = block_size // words
+                if count == 0:
+                    continue
+                values = tuple(range(count)) if display_format.format not in "fd" else tuple(float(i) for i in range(count))
+                registers = ModbusTcpClient.pack_values(values, True, display_format, endianness)
+                results.append(measure("codec.unpack", lambda: ModbusTcpClient.unpack_holding_registers(
+                    registers, True, display_format, endianness), iterations, len(registers),
+                    path="codec", format=format_name, endianness=order_name, block_size=len(registers)))
+                results.append(measure("codec.pack", lambda: ModbusTcpClient.pack_values(
+                    values, True, display_format, endianness), iterations, len(registers),
+                    path="codec", format=format_name, endianness=order_name, block_size=len(registers)))
+    return results
+
+
+def bench_tcp(iterations, block_sizes, faults):
+    results = []
+    with StandInTcpSlave(faults=faults) as slave:
+        time_out = 0.2 if faults.drop_rate else 5.0
+        client = ModbusTcpClient(server_ip=slave.address, port=slave.port, time_out=time_out, max_retry=5)
+        if not client.connect():
+            raise Exception("[Modbus-Error] can not connect to stand-in tcp slave")
+        try:
+            for block_size in block_sizes:
+                results.append(measure("tcp.read_holding_registers", lambda: client.read_holding_registers(0, block_size),
+                                       iterations, block_size, path="ModbusTcpClient", block_size=block_size))
+                results.append(measure("tcp.read_hr_commands_into", lambda: client.read_hr_commands_into(
+                    0, block_size, FMT_UNSIGNED_WORD), iterations, block_size, path="ModbusTcpClient.raw",
+                    block_size=block_size))
+                values = [1] * block_size
+                results.append(measure("tcp.write_holding_registers", lambda: client.write_holding_registers(0, values),
+                                       iterations, block_size, path="ModbusTcpClient", block_size=block_size))
+            block_size = max(block_sizes)
+            for format_name, display_format in ALL_FORMATS.items():
+                count = block_size // (display_format.bytes // 2)
+                for order_name, endianness in ALL_BYTE_ORDERS.items():
+                    results.append(measure("tcp.read_hr_commands", lambda: client.read_hr_commands(
+                        0, count, display_format, endianness), iterations, block_size,
+                        path="ModbusTcpClient", format=format_name, endianness=order_name, block_size=block_size))
+        finally:
+            client.close()
+    return results
+
+
+def bench_rtu(iterations, block_sizes, faults, baudrate):
+    results = []
+    with StandInRtuSlave(baudrate=baudrate, faults=faults) as slave:
+        master = ModbusRtuMaster(slave.port, baudrate, parity=slave.parity)
+        master.run(timeout=0.2 if faults.drop_rate else 1.0)
+        try:
+            for block_size in block_sizes:
+                results.append(measure("rtu.read_holding_registers", lambda: master.read_holding_registers(
+                    0, block_size), iterations, block_size, path="ModbusRtuMaster", block_size=block_size))
+                results.append(measure("rtu.read_coils", lambda: master.read_coils(0, block_size),
+                                       iterations, block_size, path="ModbusRtuMaster", block_size=block_size))
+            block_size = max(block_sizes)
+            for format_name, display_format in ALL_FORMATS.items():
+                count = block_size // (display_format.bytes // 2)
+                for order_name, endianness in ALL_BYTE_ORDERS.items():
+                    results.append(measure("rtu.read_hr_commands", lambda: master.read_hr_commands(
+                        0, count, display_format, endianness), iterations, block_size,
+                        path="ModbusRtuMaster", format=format_name, endianness=order_name, block_size=block_size))
+        finally:
+            master.stop()
+    return results
+
+
+def bench_mc(iterations, block_sizes, faults):
+    results = []
+    with StandInMcServer(faults=faults) as server:
+        time_out = 0.2 if faults.drop_rate else 5.0
+        client = McProtocolClient(server_ip=server.address, port=server.port, time_out=time_out, max_retry=5)
+        if not client.connect():
+            raise Exception("[MC-Error] can not connect to stand-in mc server")
+        try:
+            for block_size in block_sizes:
+                results.append(measure("mc.batch_read_words", lambda: client.batch_read_words("D0", block_size),
+                                       iterations, block_size, path="McProtocolClient", block_size=block_size))
+                values = [1] * block_size
+                results.append(measure("mc.batch_write_words", lambda: client.batch_write_words("D0", values),
+                                       iterations, block_size, path="McProtocolClient", block_size=block_size))
+                # the same count of words scattered one per 100 devices
+                devices = ["D{}".format(100 * i) for i in range(block_size)]
+                results.append(measure("mc.random_read", lambda: client.random_read(devices),
+                                       iterations, block_size, path="McProtocolClient", block_size=block_size))
+                blocks = [("D{}".format(1000 * i), 1) for i in range(min(block_size, 60))]
+                results.append(measure("mc.multi_block_read", lambda: client.multi_block_read(blocks),
+                                       iterations, len(blocks), path="McProtocolClient", block_size=len(blocks)))
+        finally:
+            client.close()
+    return results
+
+
+def run(iterations=100, block_sizes=DEFAULT_BLOCK_SIZES, latency=0.0, jitter=0.0, drop_rate=0.0,
+        baudrate=115200, seed=0, rtu=True, mc=True):
+    """
+    Returns:
+        report(dict): environment, settings and a list of result records
+    """
+    settings = {"iterations": iterations, "block_sizes": list(block_sizes), "latency": latency,
+                "jitter": jitter, "drop_rate": drop_rate, "baudrate": baudrate, "seed": seed}
+    results = bench_codec(iterations, block_sizes)
+    results += bench_tcp(iterations, block_sizes, FaultInjector(latency, jitter, drop_rate, seed))
+    if rtu:
+        results += bench_rtu(iterations, block_sizes, FaultInjector(latency, jitter, drop_rate, seed), baudrate)
+    if mc:
+        results += bench_mc(iterations, block_sizes, FaultInjector(latency, jitter, drop_rate, seed))
+    return {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "settings": settings,
+        "results": results,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="benchmark modbus clients against local stand-in slaves")
+    parser.add_argument("--iterations", type=int, default=100)
+    parser.add_argument("--block-sizes", type=int, nargs="+", default=list(DEFAULT_BLOCK_SIZES))
+    parser.add_argument("--latency", type=float, default=0.0, help="injected reply latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="uniform extra latency in seconds")
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="ratio of dropped replies")
+    parser.add_argument("--baudrate", type=int, default=115200)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-rtu", action="store_true", help="skip the pseudo-terminal RTU benchmark")
+    parser.add_argument("--no-mc", action="store_true", help="skip the MC protocol benchmark")
+    parser.add_argument("--output", default="-", help="JSON output file, - for stdout")
+    args = parser.parse_args(argv)
+
+    report = run(args.iterations, args.block_sizes, args.latency, args.jitter, args.drop_rate,
+                 args.baudrate, args.seed, not args.no_rtu, not args.no_mc)
+    if args.output == "-":
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+'''
+a connection state machine for ModbusTcpClient
+ConnectionSupervisor reconnects a dropped link in the background with jittered exponential backoff,
+requests issued while the link is down fail fast or wait for the link, depending on queue_while_down
+'''
+
+import random, socket, threading, time
+
+from modbus_tk.exceptions import ModbusError, ModbusInvalidResponseError
+
+from .glog import logger as logging
+from .instrumentation import is_timeout
+
+STATE_DISCONNECTED = "disconnected"
+STATE_CONNECTING = "connecting"
+STATE_CONNECTED = "connected"
+STATE_BACKOFF = "backoff"
+STATE_CLOSED = "closed"
+
+
+class ExponentialBackoff(object):
+    """delay of attempt n is a random value in [0, min(max_delay, initial * factor ** n)] (full jitter)"""
+
+    def __init__(self, initial=0.1, factor=2.0, max_delay=10.0, jitter=True):
+        self.initial = initial
+        self.factor = factor
+        self.max_delay = max_delay
+        self.jitter = jitter
+
+    def delay(self, attempt):
+        delay = min(self.max_delay, self.initial * self.factor ** attempt)
+        return random.uniform(0, delay) if self.jitter else delay
+
+
+def is_link_error(exc):
+    """
+    True for timeouts, socket/serial errors and broken frames, exc or its cause
+    False for a modbus exception response, the slave answered so the link is fine,
+    and for local errors such as a value out of range of its format, nothing was sent
+    """
+    while exc is not None:
+        if isinstance(exc, ModbusError):
+            return False
+        if isinstance(exc, (OSError, ModbusInvalidResponseError)) or is_timeout(exc):
+            return True
+        exc = exc.__cause__ or exc.__context__
+    return False
+
+
+def set_tcp_keepalive(sock, idle=10, interval=5, count=3):
+    """enable TCP keepalive, a dead peer is detected after about idle + interval * count seconds"""
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    # the fine tuning options are not available on every platform
+    for option, value in (("TCP_KEEPIDLE", idle), ("TCP_KEEPINTVL", interval), ("TCP_KEEPCNT", count)):
+        if hasattr(socket, option):
+            sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+
+
+class ConnectionSupervisor(object):
+    """ConnectionSupervisor owns the connection of one client on a background thread"""
+
+    def __init__(self, client, backoff=None, queue_while_down=False, heartbeat_interval=None, keepalive=True):
+        """
+        Args:
+            client(ModbusTcpClient): supervised client
+            backoff(ExponentialBackoff): delays between reconnect attempts
+            queue_while_down(bool): requests wait up to client.time_out for the link instead of failing fast
+            heartbeat_interval(float): seconds of idle link before a heartbeat read, None to disable
+            keepalive(bool/tuple): enable TCP keepalive, or (idle, interval, count) in seconds
+        """
+        self.client = client
+        self.backoff = backoff or ExponentialBackoff(max_delay=max(client.time_out, 0.1))
+        self.queue_while_down = queue_while_down
+        self.heartbeat_interval = heartbeat_interval
+        self.keepalive = keepalive
+        self.state = STATE_DISCONNECTED
+        self.last_error = None
+        self._callbacks = []
+        self._last_activity = time.monotonic()
+        self._attempt = 0
+        self._retry_at = 0.0
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def add_state_callback(self, callback):
+        """callback(old_state, new_state) on every state change, called without any lock held"""
+        self._callbacks.append(callback)
+
+    def _set_state(self, state):
+        with self._condition:
+            if self.state == STATE_CLOSED:
+                # a connect attempt finishing after stop()
+                return
+            old, self.state = self.state, state
+            self._condition.notify_all()
+        if old == state:
+            return
+        logging.info("[Modbus] link to slave {} is {}".format(self.client.modbus_server_ip, state))
+        for callback in list(self._callbacks):
+            try:
+                callback(old, state)
+            except Exception as e:
+                logging.error("[Modbus-Error] state callback failed! the error is: {}".format(e))
+
+    @property
+    def connected(self):
+        return self.state == STATE_CONNECTED
+
+    def wait_connected(self, timeout=None):
+        """block until the link is up, returns False on timeout or once closed"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while self.state != STATE_CONNECTED:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if self.state == STATE_CLOSED or (remaining is not None and remaining <= 0):
+                    return False
+                self._condition.wait(remaining)
+            return True
+
+    def check_link(self):
+        """called before every request, raises if the link is down"""
+        if self.state == STATE_CONNECTED:
+            return
+        if self.queue_while_down and self.wait_connected(self.client.time_out):
+            return
+        raise Exception("[Modbus-Error] link to slave {} is {}, last error: {}".format(
+            self.client.modbus_server_ip, self.state, self.last_error))
+
+    def notify_activity(self):
+        self._last_activity = time.monotonic()
+
+    def notify_failure(self, exc):
+        """called after a failed request, a broken link is closed and reconnected in the background"""
+        if not is_link_error(exc) or self.state != STATE_CONNECTED:
+            return
+        self.last_error = exc
+        self.client._close_link()
+        self._attempt = 0
+        self._retry_at = 0.0
+        self._set_state(STATE_DISCONNECTED)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="modbus-supervisor", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._set_state(STATE_CLOSED)
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _connect_once(self):
+        self._set_state(STATE_CONNECTING)
+        try:
+            self.client._open_link()
+            if self.keepalive:
+                sock = getattr(self.client._modbus_client, "_sock", None)
+                if sock is not None:
+                    set_tcp_keepalive(sock, *(self.keepalive if isinstance(self.keepalive, tuple) else ()))
+        except Exception as e:
+            self.last_error = e
+            self.client._close_link()
+            delay = self.backoff.delay(self._attempt)
+            self._attempt += 1
+            self._retry_at = time.monotonic() + delay
+            logging.error("[Modbus-Error] can not connect to slave! retry in {:.3f}s, the error is: {}".format(delay, e))
+            if self.client.stats is not None:
+                self.client.stats.count("retries")
+            self._set_state(STATE_BACKOFF)
+            return
+        self._attempt = 0
+        self.notify_activity()
+        self.client._count_connect()
+        self._set_state(STATE_CONNECTED)
+
+    def _heartbeat(self):
+        try:
+            self.client._heartbeat()
+            self.notify_activity()
+        except Exception as e:
+            logging.error("[Modbus-Error] heartbeat to slave {} failed! the error is: {}".format(
+                self.client.modbus_server_ip, e))
+            self.notify_failure(e)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                state = self.state
+                if state == STATE_CLOSED:
+                    return
+                now = time.monotonic()
+                if state == STATE_BACKOFF and now < self._retry_at:
+                    self._condition.wait(self._retry_at - now)
+                    continue
+                if state == STATE_CONNECTED:
+                    if self.heartbeat_interval is None:
+                        self._condition.wait()
+                        continue
+                    idle_until = self._last_activity + self.heartbeat_interval
+                    if now < idle_until:
+                        self._condition.wait(idle_until - now)
+                        continue
+            if state == STATE_CONNECTED:
+                self._heartbeat()
+            else:
+                self._connect_once()
+
+
+__all__ = ["ConnectionSupervisor", "ExponentialBackoff", "is_link_error", "set_tcp_keepalive",
+           "STATE_DISCONNECTED", "STATE_CONNECTING", "STATE_CONNECTED", "STATE_BACKOFF", "STATE_CLOSED"]
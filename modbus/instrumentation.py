@@ -0,0 +1,172 @@
+'''
+per request instrumentation of the modbus clients
+ModbusStats keeps latency histograms per function code (lock wait, wire, codec time)
+and counters of retries, reconnects, timeouts, errors and wire bytes of one endpoint
+a client without stats (the default) only pays a None check per request
+'''
+
+from bisect import bisect_left
+import socket, threading
+
+# upper bounds in seconds, the last bucket is +Inf
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+COUNTERS = ("requests", "errors", "timeouts", "retries", "connects", "reconnects", "bytes_sent", "bytes_received")
+
+# modbus tcp application header: transaction id, protocol id, length, unit id
+MBAP_BYTES = 7
+# modbus rtu framing: slave address and crc
+RTU_FRAMING_BYTES = 3
+
+
+class Histogram(object):
+    """a fixed bucket histogram, observe() is one bisect and three additions"""
+
+    __slots__ = ('buckets', 'counts', 'count', 'sum')
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """upper bound of the bucket holding the q quantile, inf if beyond the last bucket"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def snapshot(self):
+        return {"count": self.count, "sum": self.sum,
+                "buckets": dict(zip([str(b) for b in self.buckets] + ["+Inf"], self.counts)),
+                "p50": self.quantile(0.5), "p99": self.quantile(0.99)}
+
+
+def is_timeout(exc):
+    """True if exc or its cause is a socket/serial timeout"""
+    while exc is not None:
+        if isinstance(exc, (socket.timeout, TimeoutError)) or "timeout" in type(exc).__name__.lower():
+            return True
+        exc = exc.__cause__ or exc.__context__
+    return False
+
+
+class ModbusStats(object):
+    """ModbusStats of one endpoint, eg: "192.168.1.10:502/1" or "/dev/ttyUSB0/1" """
+
+    PHASES = ("lock_wait", "wire", "codec")
+
+    def __init__(self, endpoint, buckets=DEFAULT_BUCKETS):
+        self.endpoint = endpoint
+        self.buckets = buckets
+        self._histograms = {}
+        self._counters = dict.fromkeys(COUNTERS, 0)
+        self._lock = threading.Lock()
+
+    def _histogram(self, phase, function_code):
+        key = (phase, function_code)
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms[key] = Histogram(self.buckets)
+        return histogram
+
+    def observe_request(self, function_code, lock_wait, wire, bytes_sent, bytes_received, error=None):
+        """
+        record one request
+
+        Args:
+            function_code(int): modbus function code
+            lock_wait(float): seconds waiting for the client lock
+            wire(float): seconds sending the request and receiving the reply
+            bytes_sent(int)/bytes_received(int): frame bytes, bytes_received is 0 if no reply
+            error(Exception): the error of a failed request
+        """
+        with self._lock:
+            self._histogram("lock_wait", function_code).observe(lock_wait)
+            self._histogram("wire", function_code).observe(wire)
+            counters = self._counters
+            counters["requests"] += 1
+            counters["bytes_sent"] += bytes_sent
+            counters["bytes_received"] += bytes_received
+            if error is not None:
+                counters["errors"] += 1
+                if is_timeout(error):
+                    counters["timeouts"] += 1
+
+    def observe_codec(self, function_code, seconds):
+        """record seconds spent in pack_values/unpack_holding_registers"""
+        with self._lock:
+            self._histogram("codec", function_code).observe(seconds)
+
+    def count(self, counter, n=1):
+        with self._lock:
+            self._counters[counter] += n
+
+    def snapshot(self):
+        """
+        Returns:
+            snapshot(dict): endpoint, counters and {phase: {function_code: histogram}}
+        """
+        with self._lock:
+            histograms = {}
+            for (phase, function_code), histogram in self._histograms.items():
+                histograms.setdefault(phase, {})[function_code] = histogram.snapshot()
+            return {"endpoint": self.endpoint, "counters": dict(self._counters), "histograms": histograms}
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+            self._counters = dict.fromkeys(COUNTERS, 0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def prometheus_text(stats, prefix="modbus"):
+    """
+    export ModbusStats in the Prometheus text exposition format
+
+    Args:
+        stats(Iterable): ModbusStats list, eg: one per client
+        prefix(str): metric name prefix
+    Returns:
+        text(str)
+    """
+    if isinstance(stats, ModbusStats):
+        stats = (stats,)
+    snapshots = [s.snapshot() for s in stats]
+    lines = []
+    for counter in COUNTERS:
+        name = "{}_{}_total".format(prefix, counter)
+        lines.append("# TYPE {} counter".format(name))
+        for snapshot in snapshots:
+            lines.append('{}{{endpoint="{}"}} {}'.format(name, _escape(snapshot["endpoint"]), snapshot["counters"][counter]))
+    for phase in ModbusStats.PHASES:
+        name = "{}_{}_seconds".format(prefix, phase)
+        lines.append("# TYPE {} histogram".format(name))
+        for snapshot in snapshots:
+            for function_code, histogram in sorted(snapshot["histograms"].get(phase, {}).items()):
+                labels = 'endpoint="{}",function_code="{}"'.format(_escape(snapshot["endpoint"]), function_code)
+                cumulative = 0
+                for bound, count in histogram["buckets"].items():
+                    cumulative += count
+                    lines.append('{}_bucket{{{},le="{}"}} {}'.format(name, labels, bound, cumulative))
+                lines.append("{}_sum{{{}}} {}".format(name, labels, histogram["sum"]))
+                lines.append("{}_count{{{}}} {}".format(name, labels, histogram["count"]))
+    return "\n".join(lines) + "\n"
+
+
+__all__ = ["ModbusStats", "Histogram", "prometheus_text", "is_timeout", "DEFAULT_BUCKETS", "COUNTERS",
+           "MBAP_BYTES", "RTU_FRAMING_BYTES"]
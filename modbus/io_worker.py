@@ -0,0 +1,134 @@
+'''
+a dedicated I/O worker for ModbusTcpClient
+IoWorker is the only thread touching the socket of its client, it drains a priority queue of requests
+so that safety reads never wait behind bulk diagnostic reads, callers get concurrent.futures.Future back
+'''
+
+from concurrent.futures import Future
+import itertools, queue, threading, time
+
+from .glog import logger as logging
+from .modbus_tcp_client import ModbusTcpClient, FMT_SIGNED_WORD, BYTE_ORDER_BIG_ENDIAN
+
+# lower value is served first
+PRIORITY_SAFETY = 0
+PRIORITY_HIGH = 10
+PRIORITY_NORMAL = 50
+PRIORITY_LOW = 100
+
+
+class RequestExpired(Exception):
+    """the deadline of a request passed before it was sent"""
+
+
+class IoWorker(object):
+    """IoWorker serves the requests of one client in priority order, FIFO within a priority"""
+
+    def __init__(self, client, name=None):
+        """
+        Args:
+            client(ModbusTcpClient): a connected client
+        """
+        self.client = client
+        self.expired = 0
+        self._queue = queue.PriorityQueue()
+        self._sequence = itertools.count()
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name=name or "modbus-io-{}".format(client.modbus_server_ip))
+        self._running = True
+        self._thread.start()
+
+    def submit(self, func, priority=PRIORITY_NORMAL, timeout=None):
+        """
+        queue func() to run on the worker thread
+
+        Args:
+            priority(int): PRIORITY_* or any int, lower is served first
+            timeout(float): seconds from now after which the request is dropped unsent, None for no deadline
+        Returns:
+            future(concurrent.futures.Future): result of func(), RequestExpired if dropped
+        """
+        if not self._running:
+            raise Exception("[Modbus-Error] io worker of slave {} is stopped".format(self.client.modbus_server_ip))
+        future = Future()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        self._queue.put((priority, next(self._sequence), deadline, func, future))
+        return future
+
+    def submit_read_holding_registers(self, address, count=1, priority=PRIORITY_NORMAL, timeout=None):
+        client = self.client
+        signed, slave_id = client.signed, client.slave_id
+        return self.submit(lambda: client._read_holding_registers(address, signed, count, slave_id), priority, timeout)
+
+    def submit_write_holding_registers(self, address, holding_register_values, priority=PRIORITY_NORMAL, timeout=None):
+        client = self.client
+        signed, slave_id = client.signed, client.slave_id
+
+        def write():
+            client._write_holding_registers(address, signed, holding_register_values, slave_id)
+            # write through as ModbusTcpClient.write_holding_registers() does
+            if client.cache is not None:
+                client.cache.update(slave_id, address, holding_register_values)
+
+        return self.submit(write, priority, timeout)
+
+    def submit_read_hr_commands(self, address, count=1, display_format=FMT_SIGNED_WORD, endianness=BYTE_ORDER_BIG_ENDIAN,
+                                priority=PRIORITY_NORMAL, timeout=None):
+        """
+        queue a read_hr_commands, the values are decoded on the worker thread
+        """
+        client = self.client
+        signed, slave_id = client.signed, client.slave_id
+        words_num = count * (display_format.bytes // 2)
+        return self.submit(lambda: ModbusTcpClient.unpack_holding_registers(
+            client._read_holding_registers(address, signed, words_num, slave_id), signed, display_format, endianness),
+            priority, timeout)
+
+    def submit_write_hr_commands(self, address, values, display_format=FMT_SIGNED_WORD, endianness=BYTE_ORDER_BIG_ENDIAN,
+                                 priority=PRIORITY_NORMAL, timeout=None):
+        """
+        queue a write_hr_commands, the values are packed by the caller so packing errors raise right away
+        """
+        holding_register_values = ModbusTcpClient.pack_values(values, self.client.signed, display_format, endianness)
+        return self.submit_write_holding_registers(address, holding_register_values, priority, timeout)
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def _run(self):
+        while True:
+            _, _, deadline, func, future = self._queue.get()
+            if func is None:
+                return
+            if not future.set_running_or_notify_cancel():
+                continue
+            if deadline is not None and time.monotonic() > deadline:
+                self.expired += 1
+                future.set_exception(RequestExpired("[Modbus-Error] request expired before it was sent"))
+                continue
+            try:
+                future.set_result(func())
+            except Exception as e:
+                future.set_exception(e)
+
+    def stop(self, drain=True):
+        """
+        stop the worker, pending requests are served first if drain, otherwise they are cancelled
+        """
+        if not self._running:
+            return
+        self._running = False
+        if not drain:
+            while True:
+                try:
+                    future = self._queue.get_nowait()[4]
+                except queue.Empty:
+                    break
+                future.cancel()
+        # sorts after every real request
+        self._queue.put((float("inf"), next(self._sequence), None, None, None))
+        self._thread.join()
+        logging.info("[Modbus] io worker of slave {} stopped".format(self.client.modbus_server_ip))
+
+
+__all__ = ["IoWorker", "RequestExpired", "PRIORITY_SAFETY", "PRIORITY_HIGH", "PRIORITY_NORMAL", "PRIORITY_LOW"]
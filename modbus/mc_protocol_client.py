@@ -0,0 +1,366 @@
+'''
+a Mitsubishi MC protocol client, 3E frame in binary code
+McProtocolClient is mainly for communication with Mitsubishi PLC (Q/L/iQ-R/iQ-F series),
+scattered devices are read in one frame by random read (0x0403) and multi-block batch read (0x0406)
+'''
+
+from collections import namedtuple
+import re, socket, struct, sys, time
+from multiprocessing import Lock
+
+from .glog import logger as logging
+from .modbus_tcp_client import ModbusTcpClient, FMT_SIGNED_WORD, FMT_SIGNED_2WORD, BYTE_ORDER_LITTLE_ENDIAN_SWAP
+
+# device name, binary device code and whether the device number is hexadecimal
+DeviceType = namedtuple('DeviceType', ['name', 'code', 'hex', 'bit'])
+
+DEVICE_TYPES = {
+    "X": DeviceType("X", 0x9C, True, True),
+    "Y": DeviceType("Y", 0x9D, True, True),
+    "M": DeviceType("M", 0x90, False, True),
+    "L": DeviceType("L", 0x92, False, True),
+    "B": DeviceType("B", 0xA0, True, True),
+    "D": DeviceType("D", 0xA8, False, False),
+    "W": DeviceType("W", 0xB4, True, False),
+    "R": DeviceType("R", 0xAF, False, False),
+}
+DEVICE_CODES = {device_type.code: device_type for device_type in DEVICE_TYPES.values()}
+
+CMD_BATCH_READ = 0x0401
+CMD_BATCH_WRITE = 0x1401
+CMD_RANDOM_READ = 0x0403
+CMD_RANDOM_WRITE = 0x1402
+CMD_MULTI_BLOCK_READ = 0x0406
+
+SUBCMD_WORD = 0x0000
+SUBCMD_BIT = 0x0001
+
+REQUEST_SUBHEADER = 0x5000
+RESPONSE_SUBHEADER = 0xD000
+
+# end codes of the CPU module, 0 is success
+END_CODE_DEVICE_RANGE = 0xC056
+END_CODE_COMMAND = 0xC059
+
+# subheader, network no, pc no, module io no, module station no, data length
+# the subheader is written as is (50 00 / D0 00), every other field is little endian
+_SUBHEADER = struct.Struct(">H")
+_ACCESS_ROUTE = struct.Struct("<BBHBH")
+HEADER_SIZE = _SUBHEADER.size + _ACCESS_ROUTE.size
+
+_DEVICE_PATTERN = re.compile(r"^([A-Z]+)([0-9A-F]+)$")
+
+
+def parse_device(device):
+    """
+    parse a device like "D100", "M8000", "X1F" (X/Y/B/W are hexadecimal)
+
+    Returns:
+        (DeviceType, int): device type and device number
+    """
+    match = _DEVICE_PATTERN.match(device.strip().upper())
+    if match is None or match.group(1) not in DEVICE_TYPES:
+        raise Exception("[MC-Error] device {} is not supported".format(device))
+    device_type = DEVICE_TYPES[match.group(1)]
+    try:
+        return device_type, int(match.group(2), 16 if device_type.hex else 10)
+    except ValueError:
+        raise Exception("[MC-Error] device number of {} is not {}".format(
+            device, "hexadecimal" if device_type.hex else "decimal"))
+
+
+def pack_device(device):
+    """3 bytes device number (little endian) and 1 byte device code"""
+    device_type, number = parse_device(device)
+    return struct.pack("<I", number)[:3] + bytes([device_type.code])
+
+
+def unpack_device(data, offset=0):
+    """
+    Returns:
+        (DeviceType, int): device type and device number of the 4 bytes at offset
+    """
+    number = data[offset] | (data[offset + 1] << 8) | (data[offset + 2] << 16)
+    return DEVICE_CODES[data[offset + 3]], number
+
+
+def pack_bits(values):
+    """bit points are packed 2 per byte, the first point in the high nibble"""
+    values = [1 if v else 0 for v in values]
+    if len(values) % 2:
+        values.append(0)
+    return bytes((values[i] << 4) | values[i + 1] for i in range(0, len(values), 2))
+
+
+def unpack_bits(data, count):
+    bits = []
+    for byte in data:
+        bits.append(byte >> 4 & 1)
+        bits.append(byte & 1)
+    return tuple(bits[:count])
+
+
+def pack_frame(command, subcommand, data, network=0, pc=0xFF, module_io=0x03FF, module_station=0, monitoring_timer=4):
+    """a 3E binary request frame, monitoring_timer is in units of 250ms"""
+    body = struct.pack("<HHH", monitoring_timer, command, subcommand) + data
+    return _SUBHEADER.pack(REQUEST_SUBHEADER) + _ACCESS_ROUTE.pack(network, pc, module_io, module_station, len(body)) + body
+
+
+def pack_response(request_header, end_code, data=b""):
+    """a 3E binary response frame to the request with request_header, used by stand-in servers"""
+    network, pc, module_io, module_station, _ = _ACCESS_ROUTE.unpack_from(request_header, _SUBHEADER.size)
+    body = struct.pack("<H", end_code) + data
+    return _SUBHEADER.pack(RESPONSE_SUBHEADER) + _ACCESS_ROUTE.pack(network, pc, module_io, module_station, len(body)) + body
+
+
+def unpack_header(header):
+    """
+    Returns:
+        (subheader, data length): data length counts every byte after the header
+    """
+    return _SUBHEADER.unpack_from(header)[0], _ACCESS_ROUTE.unpack_from(header, _SUBHEADER.size)[4]
+
+
+def recv_exactly(sock, size):
+    buffer = bytearray()
+    while len(buffer) < size:
+        chunk = sock.recv(size - len(buffer))
+        if not chunk:
+            raise ConnectionError("connection closed by peer")
+        buffer += chunk
+    return bytes(buffer)
+
+
+class McProtocolClient(object):
+    """McProtocolClient act as socket client of a Mitsubishi PLC, MC protocol 3E frame binary code"""
+
+    def __init__(self, server_ip="127.0.0.1", port=5000, signed=True, time_out=5.0, max_retry=20,
+                 network=0, pc=0xFF, module_io=0x03FF, module_station=0):
+        bybe_order = sys.byteorder.capitalize()
+        assert(bybe_order == "Little")
+        self.plc_server_ip = server_ip
+        self.port = port
+        self.signed = signed
+        self.time_out = time_out
+        self.max_retry = max_retry
+        self.network = network
+        self.pc = pc
+        self.module_io = module_io
+        self.module_station = module_station
+        # monitoring timer of the PLC, in units of 250ms
+        self.monitoring_timer = max(1, int(time_out * 4))
+        self._sock = None
+        self._client_lock = Lock()
+
+    def _open(self):
+        self._sock = socket.create_connection((self.plc_server_ip, self.port), self.time_out)
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def connect(self):
+        for _ in range(self.max_retry):
+            try:
+                self._open()
+                logging.info("[MC] connect success to plc {}".format(self.plc_server_ip))
+                return True
+            except Exception as e:
+                self._sock = None
+                logging.error("[MC-Error] can not connect to plc! the error is: {}".format(e))
+                time.sleep(self.time_out)
+        return False
+
+    def close(self):
+        if self._sock:
+            self._sock.close()
+            self._sock = None
+
+    def set_signed(self, signed):
+        """
+        defines word devices to be signed or unsigned value
+        """
+        self.signed = signed
+
+    def _execute(self, command, subcommand, data):
+        """
+        send one request frame and return the response data after the end code
+        3E frames carry no serial number, a late reply would be taken for the reply of the next request,
+        so the connection is dropped on any transport error and opened again by the next request
+        """
+        frame = pack_frame(command, subcommand, data, self.network, self.pc, self.module_io,
+                           self.module_station, self.monitoring_timer)
+        with self._client_lock:
+            try:
+                if self._sock is None:
+                    self._open()
+                self._sock.sendall(frame)
+                subheader, length = unpack_header(recv_exactly(self._sock, HEADER_SIZE))
+                if subheader != RESPONSE_SUBHEADER:
+                    raise Exception("unexpected subheader 0x{:04X}".format(subheader))
+                body = recv_exactly(self._sock, length)
+            except Exception as e:
+                self.close()
+                raise Exception("[MC-Error] can not execute command 0x{:04X}! the error is: {}\n---".format(command, e))
+        end_code = struct.unpack_from("<H", body)[0]
+        if end_code != 0:
+            raise Exception("[MC-Error] command 0x{:04X} failed with end code 0x{:04X}".format(command, end_code))
+        return body[2:]
+
+    def _unpack_words(self, data, count, offset=0):
+        return struct.unpack_from("<{}{}".format(count, "h" if self.signed else "H"), data, offset)
+
+    def _pack_words(self, values):
+        return struct.pack("<{}{}".format(len(values), "h" if self.signed else "H"), *values)
+
+    def batch_read_words(self, device, count=1):
+        """
+        read count words from device, eg: batch_read_words("D100", 10)
+        bit devices are read in units of 16 points
+
+        Returns:
+            results(tuple): a tuple of words
+        """
+        data = self._execute(CMD_BATCH_READ, SUBCMD_WORD, pack_device(device) + struct.pack("<H", count))
+        return self._unpack_words(data, count)
+
+    def batch_read_bits(self, device, count=1):
+        """
+        read count bit points from device, eg: batch_read_bits("M0", 16)
+
+        Returns:
+            results(tuple): a tuple of 0/1
+        """
+        data = self._execute(CMD_BATCH_READ, SUBCMD_BIT, pack_device(device) + struct.pack("<H", count))
+        return unpack_bits(data, count)
+
+    def batch_write_words(self, device, values):
+        data = pack_device(device) + struct.pack("<H", len(values)) + self._pack_words(values)
+        self._execute(CMD_BATCH_WRITE, SUBCMD_WORD, data)
+
+    def batch_write_bits(self, device, values):
+        data = pack_device(device) + struct.pack("<H", len(values)) + pack_bits(values)
+        self._execute(CMD_BATCH_WRITE, SUBCMD_BIT, data)
+
+    def random_read(self, word_devices=(), dword_devices=()):
+        """
+        read scattered word and double word devices in one frame
+
+        Args:
+            word_devices(Iterable): eg: ["D100", "D2000", "W1A"]
+            dword_devices(Iterable): eg: ["D300"], D300 is the low word and D301 the high word
+        Returns:
+            (word_values, dword_values): two tuples
+        """
+        word_devices, dword_devices = list(word_devices), list(dword_devices)
+        data = bytes([len(word_devices), len(dword_devices)]) \
+               + b"".join(pack_device(d) for d in word_devices) + b"".join(pack_device(d) for d in dword_devices)
+        response = self._execute(CMD_RANDOM_READ, SUBCMD_WORD, data)
+        words = self._unpack_words(response, len(word_devices))
+        dwords = struct.unpack_from("<{}{}".format(len(dword_devices), "i" if self.signed else "I"),
+                                    response, 2 * len(word_devices))
+        return words, dwords
+
+    def random_write(self, word_items=(), dword_items=()):
+        """
+        write scattered word and double word devices in one frame
+
+        Args:
+            word_items(Iterable): (device, value) list
+            dword_items(Iterable): (device, value) list
+        """
+        word_items, dword_items = list(word_items), list(dword_items)
+        word_format, dword_format = ("<h", "<i") if self.signed else ("<H", "<I")
+        data = bytes([len(word_items), len(dword_items)]) \
+               + b"".join(pack_device(d) + struct.pack(word_format, v) for d, v in word_items) \
+               + b"".join(pack_device(d) + struct.pack(dword_format, v) for d, v in dword_items)
+        self._execute(CMD_RANDOM_WRITE, SUBCMD_WORD, data)
+
+    def random_write_bits(self, items):
+        """
+        write scattered bit devices in one frame
+
+        Args:
+            items(Iterable): (device, 0/1) list
+        """
+        items = list(items)
+        data = bytes([len(items)]) + b"".join(pack_device(d) + bytes([1 if v else 0]) for d, v in items)
+        self._execute(CMD_RANDOM_WRITE, SUBCMD_BIT, data)
+
+    def multi_block_read(self, word_blocks=(), bit_blocks=()):
+        """
+        read several blocks of devices in one frame
+
+        Args:
+            word_blocks(Iterable): (device, count of words) list, eg: [("D0", 10), ("W100", 4)]
+            bit_blocks(Iterable): (device, count of 16 point words) list, eg: [("M0", 2)] reads M0-M31
+        Returns:
+            (word_results, bit_results): lists of tuples, bit blocks are returned as 0/1 per point
+        """
+        word_blocks, bit_blocks = list(word_blocks), list(bit_blocks)
+        data = bytes([len(word_blocks), len(bit_blocks)]) \
+               + b"".join(pack_device(d) + struct.pack("<H", n) for d, n in word_blocks) \
+               + b"".join(pack_device(d) + struct.pack("<H", n) for d, n in bit_blocks)
+        response = self._execute(CMD_MULTI_BLOCK_READ, SUBCMD_WORD, data)
+        offset = 0
+        word_results = []
+        for _, count in word_blocks:
+            word_results.append(self._unpack_words(response, count, offset))
+            offset += 2 * count
+        bit_results = []
+        for _, count in bit_blocks:
+            words = struct.unpack_from("<{}H".format(count), response, offset)
+            bit_results.append(tuple(word >> i & 1 for word in words for i in range(16)))
+            offset += 2 * count
+        return word_results, bit_results
+
+    def read_commands(self, device, count=1, display_format=FMT_SIGNED_WORD, endianness=BYTE_ORDER_LITTLE_ENDIAN_SWAP):
+        """
+        read word devices and parse them to count actual values
+        Mitsubishi PLCs keep the low word first, that is BYTE_ORDER_LITTLE_ENDIAN_SWAP
+
+        Returns:
+            a tuple of actual values(int/double/float)
+        """
+        words = self.batch_read_words(device, count * (display_format.bytes // 2))
+        return ModbusTcpClient.unpack_holding_registers(words, self.signed, display_format, endianness)
+
+    def write_commands(self, device, values, display_format=FMT_SIGNED_WORD, endianness=BYTE_ORDER_LITTLE_ENDIAN_SWAP):
+        """
+        write actual values to word devices
+        """
+        words = ModbusTcpClient.pack_values(values, self.signed, display_format, endianness)
+        self.batch_write_words(device, words)
+
+
+__all__ = ["McProtocolClient", "DeviceType", "DEVICE_TYPES", "DEVICE_CODES", "parse_device", "pack_device",
+           "unpack_device", "pack_bits", "unpack_bits", "pack_frame", "pack_response", "unpack_header", "recv_exactly",
+           "HEADER_SIZE", "CMD_BATCH_READ", "CMD_BATCH_WRITE", "CMD_RANDOM_READ", "CMD_RANDOM_WRITE",
+           "CMD_MULTI_BLOCK_READ", "SUBCMD_WORD", "SUBCMD_BIT", "END_CODE_DEVICE_RANGE", "END_CODE_COMMAND"]
+
+
+if __name__ == "__main__":
+    plc = McProtocolClient(server_ip="127.0.0.1", port=5000, signed=True, max_retry=5)
+    connected = plc.connect()
+    if not connected:
+        print("make sure there is MC protocol 3E binary server")
+        exit()
+
+    l_signed_word = [-1, -32768, -1567, 0, 32766, 16524, 32767, 1, 4567]
+    plc.batch_write_words("D100", l_signed_word)
+    ret_data = plc.batch_read_words("D100", len(l_signed_word))
+    print(ret_data)
+    print("test batch word {}".format("ok" if list(ret_data) == l_signed_word else "failed"))
+
+    l_signed_dword = [-1, -123456789, 0, 123456789, 45678912]
+    plc.write_commands("D200", l_signed_dword, display_format=FMT_SIGNED_2WORD)
+    ret_data = plc.read_commands("D200", len(l_signed_dword), display_format=FMT_SIGNED_2WORD)
+    print(ret_data)
+    print("test signed dword {}".format("ok" if list(ret_data) == l_signed_dword else "failed"))
+
+    plc.random_write([("D10", 7), ("W1A", -2)], [("D300", -123456)])
+    ret_data = plc.random_read(["D10", "W1A"], ["D300"])
+    print(ret_data)
+    print("test random read {}".format("ok" if ret_data == ((7, -2), (-123456,)) else "failed"))
+
+    plc.batch_write_bits("M0", [1, 0, 1, 1])
+    ret_data = plc.multi_block_read([("D100", 2)], [("M0", 1)])
+    print(ret_data)
+    plc.close()
@@ -0,0 +1,282 @@
+'''
+a pool of ModbusTcpClient, one per PLC endpoint
+ModbusClientPool runs fleet wide reads and writes on a bounded worker pool,
+a slow or broken PLC only affects the requests sent to it,
+at most max_in_flight requests of one endpoint hold a worker, the rest wait in the queue of the endpoint
+'''
+
+from collections import deque, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed, TimeoutError as FuturesTimeoutError
+import threading, time
+
+from .connection_supervisor import is_link_error
+from .glog import logger as logging
+from .modbus_tcp_client import ModbusTcpClient, FMT_SIGNED_WORD, BYTE_ORDER_BIG_ENDIAN
+
+Endpoint = namedtuple('Endpoint', ['server_ip', 'port', 'slave_id'])
+
+# values is None for a read request
+PoolRequest = namedtuple('PoolRequest', ['endpoint', 'address', 'count', 'display_format', 'endianness', 'values'])
+PoolRequest.__new__.__defaults__ = (1, FMT_SIGNED_WORD, BYTE_ORDER_BIG_ENDIAN, None)
+
+# error is None on success, value is None on failure
+PoolResult = namedtuple('PoolResult', ['endpoint', 'request', 'value', 'error', 'elapsed'])
+
+CIRCUIT_CLOSED = "closed"
+CIRCUIT_OPEN = "open"
+CIRCUIT_HALF_OPEN = "half_open"
+
+
+class CircuitBreaker(object):
+    """
+    opens after failure_threshold consecutive failures, requests are rejected without any I/O while open
+    after reset_timeout seconds a single trial request is let through (half open)
+    only link errors are failures, a modbus exception response is an answer of a working slave
+    """
+
+    def __init__(self, failure_threshold=3, reset_timeout=10.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.state = CIRCUIT_CLOSED
+        self._opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == CIRCUIT_CLOSED:
+                return True
+            if self.state == CIRCUIT_OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self.state = CIRCUIT_HALF_OPEN
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.state = CIRCUIT_CLOSED
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == CIRCUIT_HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = CIRCUIT_OPEN
+                self._opened_at = time.monotonic()
+
+
+class _CircuitOpen(Exception):
+    """raised without any I/O, not a failure of the endpoint"""
+
+
+class _PooledEndpoint(object):
+    """a lazily connected client with its own circuit breaker"""
+
+    def __init__(self, endpoint, client, breaker):
+        self.endpoint = endpoint
+        self.client = client
+        self.breaker = breaker
+        self.connected = False
+        self.lock = threading.Lock()
+        # requests holding a worker and (request, future) waiting for one, guarded by the pool lock
+        self.in_flight = 0
+        self.pending = deque()
+
+
+class ModbusClientPool(object):
+    """ModbusClientPool owns one ModbusTcpClient per (server_ip, port, slave_id)"""
+
+    def __init__(self, max_workers=8, time_out=1.0, max_retry=1, failure_threshold=3, reset_timeout=10.0,
+                 max_in_flight=1):
+        """
+        Args:
+            max_workers(int): max count of requests running in parallel over the whole fleet
+            max_in_flight(int): max count of workers serving one endpoint, requests of one endpoint are
+                                serialized by its client anyway, so more only waits on the client lock
+            time_out(float): default socket timeout of every endpoint
+            max_retry(int): default connect attempts of every endpoint
+            failure_threshold(int): consecutive failures opening the circuit of an endpoint
+            reset_timeout(float): seconds before an open circuit lets a trial request through
+        """
+        self.time_out = time_out
+        self.max_retry = max_retry
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_in_flight = max_in_flight
+        self._endpoints = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="modbus-pool")
+
+    def add_endpoint(self, server_ip, port=502, slave_id=1, signed=True, time_out=None, max_retry=None):
+        """
+        register a PLC endpoint, the connection is opened on first use
+
+        Returns:
+            endpoint(Endpoint): key of the endpoint
+        """
+        endpoint = Endpoint(server_ip, port, slave_id)
+        client = ModbusTcpClient(server_ip=server_ip, port=port, signed=signed,
+                                 time_out=self.time_out if time_out is None else time_out,
+                                 max_retry=self.max_retry if max_retry is None else max_retry,
+                                 slave_id=slave_id)
+        with self._lock:
+            if endpoint not in self._endpoints:
+                self._endpoints[endpoint] = _PooledEndpoint(endpoint, client,
+                                                            CircuitBreaker(self.failure_threshold, self.reset_timeout))
+        return endpoint
+
+    @property
+    def endpoints(self):
+        return list(self._endpoints)
+
+    def client(self, endpoint):
+        return self._endpoints[endpoint].client
+
+    def circuit_state(self, endpoint):
+        return self._endpoints[endpoint].breaker.state
+
+    def _call(self, endpoint, func):
+        pooled = self._endpoints[endpoint]
+        if not pooled.breaker.allow():
+            raise _CircuitOpen("[Modbus-Error] circuit of slave {} is open".format(endpoint))
+        try:
+            with pooled.lock:
+                # requests waiting here while a connect failed must not connect again
+                if pooled.breaker.state == CIRCUIT_OPEN:
+                    raise _CircuitOpen("[Modbus-Error] circuit of slave {} is open".format(endpoint))
+                if not pooled.connected:
+                    if not pooled.client.connect():
+                        raise ConnectionError("[Modbus-Error] can not connect to slave {}".format(endpoint))
+                    pooled.connected = True
+            result = func(pooled.client)
+        except _CircuitOpen:
+            raise
+        except Exception as e:
+            if not is_link_error(e):
+                # the slave answered with an exception response, or nothing was sent, the link works
+                if pooled.breaker.state == CIRCUIT_HALF_OPEN:
+                    pooled.breaker.record_success()
+                raise
+            pooled.breaker.record_failure()
+            if pooled.breaker.state == CIRCUIT_OPEN:
+                # reconnect on the next trial request
+                with pooled.lock:
+                    if pooled.connected:
+                        pooled.client.close()
+                    pooled.connected = False
+            raise
+        pooled.breaker.record_success()
+        return result
+
+    def read(self, endpoint, address, count=1, display_format=FMT_SIGNED_WORD, endianness=BYTE_ORDER_BIG_ENDIAN):
+        """read_hr_commands of one endpoint through its circuit breaker"""
+        return self._call(endpoint, lambda client: client.read_hr_commands(address, count, display_format, endianness))
+
+    def write(self, endpoint, address, values, display_format=FMT_SIGNED_WORD, endianness=BYTE_ORDER_BIG_ENDIAN):
+        """write_hr_commands of one endpoint through its circuit breaker"""
+        return self._call(endpoint, lambda client: client.write_hr_commands(address, values, display_format, endianness))
+
+    def _run(self, request):
+        start = time.monotonic()
+        try:
+            if request.values is None:
+                value = self.read(request.endpoint, request.address, request.count,
+                                  request.display_format, request.endianness)
+            else:
+                value = self.write(request.endpoint, request.address, request.values,
+                                   request.display_format, request.endianness)
+            error = None
+        except Exception as e:
+            value, error = None, e
+            logging.error("[Modbus-Error] request {} failed! the error is: {}".format(request, e))
+        return PoolResult(request.endpoint, request, value, error, time.monotonic() - start)
+
+    def submit(self, request):
+        """
+        run one PoolRequest on the worker pool
+
+        Returns:
+            future(concurrent.futures.Future): resolves to a PoolResult, never raises
+        """
+        future = Future()
+        pooled = self._endpoints[request.endpoint]
+        with self._lock:
+            if pooled.in_flight >= self.max_in_flight:
+                pooled.pending.append((request, future))
+                return future
+            pooled.in_flight += 1
+        self._executor.submit(self._serve, pooled, request, future)
+        return future
+
+    def _serve(self, pooled, request, future):
+        """run request, then the pending requests of the same endpoint on this worker"""
+        while True:
+            if future.set_running_or_notify_cancel():
+                future.set_result(self._run(request))
+            with self._lock:
+                if not pooled.pending:
+                    pooled.in_flight -= 1
+                    return
+                request, future = pooled.pending.popleft()
+
+    def execute_batch(self, requests, timeout=None):
+        """
+        run PoolRequests in parallel, reads and writes can be mixed
+        requests of the same endpoint are serialized by its client, every request is submitted at once
+
+        Args:
+            requests(Iterable): PoolRequest list
+            timeout(float): max seconds to wait for the whole batch
+        Returns:
+            results(generator): (index of the request, PoolResult) in completion order,
+                                a request not done within timeout has a TimeoutError and is cancelled if not started
+        """
+        requests = list(requests)
+        futures = [self.submit(request) for request in requests]
+        return self._as_completed(requests, futures, timeout)
+
+    def _as_completed(self, requests, futures, timeout):
+        start = time.monotonic()
+        indexes = {future: index for index, future in enumerate(futures)}
+        try:
+            for future in as_completed(futures, timeout=timeout):
+                yield indexes.pop(future), future.result()
+        except FuturesTimeoutError:
+            pass
+        for future, index in sorted(indexes.items(), key=lambda item: item[1]):
+            future.cancel()
+            request = requests[index]
+            error = TimeoutError("request to slave {} not done within {}s".format(request.endpoint, timeout))
+            yield index, PoolResult(request.endpoint, request, None, error, time.monotonic() - start)
+
+    def execute_batch_ordered(self, requests, timeout=None):
+        """
+        execute_batch and wait for every result
+
+        Returns:
+            results(list): PoolResult of every request in request order
+        """
+        requests = list(requests)
+        results = [None] * len(requests)
+        for index, result in self.execute_batch(requests, timeout):
+            results[index] = result
+        return results
+
+    def read_batch(self, requests, timeout=None):
+        """execute_batch of read requests, see PoolRequest"""
+        return self.execute_batch(requests, timeout)
+
+    def write_batch(self, requests, timeout=None):
+        """execute_batch of write requests, see PoolRequest"""
+        return self.execute_batch(requests, timeout)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        for pooled in self._endpoints.values():
+            with pooled.lock:
+                if pooled.connected:
+                    pooled.client.close()
+                pooled.connected = False
+
+
+__all__ = ["ModbusClientPool", "CircuitBreaker", "Endpoint", "PoolRequest", "PoolResult",
+           "CIRCUIT_CLOSED", "CIRCUIT_OPEN", "CIRCUIT_HALF_OPEN"]
@@ -0,0 +1,512 @@
+'''
+a Modbus TCP gateway in front of one PLC
+ModbusGateway accepts many local Modbus TCP clients and forwards their requests over the single
+connection of one ModbusTcpClient, identical queued reads are sent upstream once (singleflight),
+holding register reads can be served by a RegisterCache, and clients are served round robin
+with an optional per client rate limit so a noisy client can not starve the others,
+a client is one connection by default, so HMIs on one host or behind one NAT are told apart
+
+stats are served as JSON on http://<stats address>:<stats port>/stats
+and in the Prometheus text format on /metrics
+'''
+
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json, socket, socketserver, struct, threading, time
+
+import modbus_tk.defines as cst
+from modbus_tk.exceptions import ModbusError
+
+from .glog import logger as logging
+from .instrumentation import Histogram, prometheus_text
+from .modbus_tcp_client import RAW_BUFFER_SIZE
+
+# transaction id, protocol id, length, unit id
+_MBAP_HEADER = struct.Struct(">HHHB")
+# the MBAP length counts the unit id and the pdu of at most 253 bytes
+_MIN_MBAP_LENGTH = 2
+_MAX_MBAP_LENGTH = 254
+_ADDRESS_QUANTITY = struct.Struct(">HH")
+
+_READ_BITS = (cst.READ_COILS, cst.READ_DISCRETE_INPUTS)
+_READ_REGISTERS = (cst.READ_HOLDING_REGISTERS, cst.READ_INPUT_REGISTERS)
+
+# modbus exception codes answered by the gateway itself
+EXCEPTION_ILLEGAL_FUNCTION = 0x01
+EXCEPTION_ILLEGAL_DATA_VALUE = 0x03
+EXCEPTION_SLAVE_DEVICE_BUSY = 0x06
+EXCEPTION_GATEWAY_TARGET_FAILED = 0x0B
+
+GATEWAY_COUNTERS = ("requests", "upstream_requests", "coalesced", "cache_hits", "rate_limited", "errors")
+GATEWAY_PHASES = ("total", "queue_wait", "upstream", "overhead")
+
+
+class TokenBucket(object):
+    """rate requests per second on average, bursts of up to burst requests"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1.0, rate)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+
+    def allow(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if self._tokens < 1.0:
+            return False
+        self._tokens -= 1.0
+        return True
+
+
+class _Request(object):
+    """one upstream request, shared by every downstream request coalesced into it"""
+
+    __slots__ = ('key', 'unit', 'function_code', 'address', 'quantity', 'values', 'queued', 'started',
+                 'upstream', 'result', 'error', 'done')
+
+    def __init__(self, key, unit, function_code, address, quantity, values=None):
+        self.key = key
+        self.unit = unit
+        self.function_code = function_code
+        self.address = address
+        self.quantity = quantity
+        self.values = values
+        self.queued = time.perf_counter()
+        self.started = None
+        self.upstream = 0.0
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class _ClientStats(object):
+    __slots__ = ('counters', 'connections')
+
+    def __init__(self):
+        self.counters = dict.fromkeys(GATEWAY_COUNTERS, 0)
+        self.connections = 0
+
+
+def _exception_code(exc):
+    """the exception code of a slave exception response in the chain of exc, None for link errors"""
+    while exc is not None:
+        if isinstance(exc, ModbusError):
+            return exc.get_exception_code()
+        exc = exc.__cause__ or exc.__context__
+    return None
+
+
+def _pack_bits(bits):
+    data = bytearray((len(bits) + 7) // 8)
+    for i, bit in enumerate(bits):
+        if bit:
+            data[i // 8] |= 1 << (i % 8)
+    return bytes(data)
+
+
+def _unpack_bits(data, count):
+    return tuple(data[i // 8] >> (i % 8) & 1 for i in range(count))
+
+
+class _GatewayServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class _GatewayHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        gateway = self.server.gateway
+        sock = self.request
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        peer = gateway.client_key(self.client_address)
+        gateway._connected(peer)
+        stream = sock.makefile("rb")
+        try:
+            while True:
+                header = stream.read(_MBAP_HEADER.size)
+                if len(header) < _MBAP_HEADER.size:
+                    return
+                transaction_id, protocol_id, length, unit = _MBAP_HEADER.unpack(header)
+                # the stream can not be resynchronized after a broken header
+                if protocol_id != 0 or not _MIN_MBAP_LENGTH <= length <= _MAX_MBAP_LENGTH:
+                    logging.error("[Modbus-Error] invalid MBAP header from {}: protocol id {}, length {}".format(
+                        peer, protocol_id, length))
+                    return
+                pdu = stream.read(length - 1)
+                if len(pdu) < length - 1 or not pdu:
+                    return
+                response = gateway.handle(peer, unit, pdu)
+                sock.sendall(_MBAP_HEADER.pack(transaction_id, protocol_id, len(response) + 1, unit) + response)
+        except OSError:
+            return
+        finally:
+            stream.close()
+            gateway._disconnected(peer)
+
+
+class _StatsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        gateway = self.server.gateway
+        if self.path.startswith("/metrics"):
+            body, content_type = gateway.prometheus_text().encode(), "text/plain; version=0.0.4"
+        elif self.path.startswith("/stats"):
+            body, content_type = json.dumps(gateway.snapshot(), indent=2).encode(), "application/json"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ModbusGateway(object):
+    """ModbusGateway forwards the requests of every local client over one upstream ModbusTcpClient"""
+
+    def __init__(self, client, port=502, address="0.0.0.0", cache=None, rate_limit=None, burst=None,
+                 max_pending=64, stats_port=None, stats_address="127.0.0.1", client_key=None):
+        """
+        Args:
+            client(ModbusTcpClient): connected upstream client, the unit id of every request is forwarded as slave id
+            cache(RegisterCache): serves holding register reads if given, gateway writes update it
+            rate_limit(float): requests per second of one client, None for no limit
+            burst(int): requests a client can send at once, defaults to rate_limit
+            max_pending(int): queued requests of one client, further requests are answered busy
+            stats_port(int): port of the HTTP stats endpoint, None to disable it
+            client_key(callable): client_key((ip, port)) -> client identity of a connection,
+                                  None for "ip:port", one client per connection,
+                                  eg: lambda address: address[0] makes every connection of a host one client
+        """
+        self.client = client
+        self.address = address
+        self.port = port
+        self.cache = cache
+        self.rate_limit = rate_limit
+        self.burst = burst
+        self.max_pending = max_pending
+        self.client_key = client_key or self.connection_key
+        self.stats_address = stats_address
+        self.stats_port = stats_port
+        self._condition = threading.Condition()
+        # client to queued requests, clients with queued requests are served round robin
+        self._queues = {}
+        self._ready = deque()
+        # reads queued but not sent upstream yet, by (unit, function code, address, quantity)
+        self._flights = {}
+        self._buckets = {}
+        self._clients = {}
+        # counters of every client, connected or gone
+        self._totals = dict.fromkeys(GATEWAY_COUNTERS, 0)
+        self._histograms = {phase: Histogram() for phase in GATEWAY_PHASES}
+        self._stats_lock = threading.Lock()
+        self._receive_buffer = bytearray(RAW_BUFFER_SIZE)
+        self._running = False
+        self._server = None
+        self._stats_server = None
+        self._threads = []
+
+    @staticmethod
+    def connection_key(client_address):
+        """the default client identity, "ip:port" of the connection"""
+        return "{}:{}".format(*client_address[:2])
+
+    def _count(self, peer, counter):
+        with self._stats_lock:
+            self._clients.setdefault(peer, _ClientStats()).counters[counter] += 1
+            self._totals[counter] += 1
+
+    def _connected(self, peer):
+        with self._stats_lock:
+            self._clients.setdefault(peer, _ClientStats()).connections += 1
+
+    def _disconnected(self, peer):
+        with self._stats_lock:
+            stats = self._clients[peer]
+            stats.connections -= 1
+            if stats.connections:
+                return
+            # a client is forgotten with its last connection, its counters stay in the totals
+            del self._clients[peer]
+        with self._condition:
+            self._buckets.pop(peer, None)
+
+    def handle(self, peer, unit, pdu):
+        """
+        answer one request PDU of client peer
+
+        Returns:
+            pdu(bytes): the response PDU
+        """
+        received = time.perf_counter()
+        function_code = pdu[0]
+        self._count(peer, "requests")
+        try:
+            request = self._parse(unit, pdu)
+        except Exception:
+            self._count(peer, "errors")
+            code = EXCEPTION_ILLEGAL_FUNCTION if function_code not in _READ_BITS + _READ_REGISTERS + (
+                cst.WRITE_SINGLE_COIL, cst.WRITE_SINGLE_REGISTER, cst.WRITE_MULTIPLE_COILS,
+                cst.WRITE_MULTIPLE_REGISTERS) else EXCEPTION_ILLEGAL_DATA_VALUE
+            return struct.pack(">BB", function_code | 0x80, code)
+
+        if function_code == cst.READ_HOLDING_REGISTERS and self.cache is not None:
+            cached = self.cache.get(unit, request.address, request.quantity)
+            if cached is not None:
+                self._count(peer, "cache_hits")
+                response = self._response(request, cached)
+                self._observe(received, None)
+                return response
+
+        request = self._enqueue(peer, request)
+        if request is None:
+            self._count(peer, "rate_limited")
+            return struct.pack(">BB", function_code | 0x80, EXCEPTION_SLAVE_DEVICE_BUSY)
+        request.done.wait()
+        if request.error is not None:
+            self._count(peer, "errors")
+            code = _exception_code(request.error)
+            response = struct.pack(">BB", function_code | 0x80, EXCEPTION_GATEWAY_TARGET_FAILED if code is None else code)
+        else:
+            response = self._response(request, request.result)
+        self._observe(received, request)
+        return response
+
+    def _observe(self, received, request):
+        total = time.perf_counter() - received
+        with self._stats_lock:
+            self._histograms["total"].observe(total)
+            if request is not None and request.started is not None:
+                self._histograms["queue_wait"].observe(max(0.0, request.started - max(request.queued, received)))
+                self._histograms["upstream"].observe(request.upstream)
+                self._histograms["overhead"].observe(max(0.0, total - request.upstream))
+            else:
+                self._histograms["overhead"].observe(total)
+
+    @staticmethod
+    def _parse(unit, pdu):
+        function_code = pdu[0]
+        address, quantity = _ADDRESS_QUANTITY.unpack_from(pdu, 1)
+        if function_code in _READ_BITS or function_code in _READ_REGISTERS:
+            if quantity < 1 or quantity > (2000 if function_code in _READ_BITS else 125):
+                raise ValueError("quantity {} out of range".format(quantity))
+            return _Request((unit, function_code, address, quantity), unit, function_code, address, quantity)
+        if function_code == cst.WRITE_SINGLE_COIL:
+            return _Request(None, unit, function_code, address, 1, 1 if quantity == 0xFF00 else 0)
+        if function_code == cst.WRITE_SINGLE_REGISTER:
+            return _Request(None, unit, function_code, address, 1, quantity)
+        if function_code == cst.WRITE_MULTIPLE_COILS:
+            return _Request(None, unit, function_code, address, quantity, _unpack_bits(pdu[6:], quantity))
+        if function_code == cst.WRITE_MULTIPLE_REGISTERS:
+            values = struct.unpack_from(">{}H".format(quantity), pdu, 6)
+            return _Request(None, unit, function_code, address, quantity, values)
+        raise ValueError("function code {} is not supported".format(function_code))
+
+    @staticmethod
+    def _response(request, result):
+        function_code = request.function_code
+        if function_code in _READ_BITS:
+            data = _pack_bits(result)
+            return struct.pack(">BB", function_code, len(data)) + data
+        if function_code in _READ_REGISTERS:
+            if not isinstance(result, (bytes, bytearray)):
+                result = struct.pack(">{}H".format(len(result)), *[r & 0xFFFF for r in result])
+            return struct.pack(">BB", function_code, len(result)) + result
+        if function_code == cst.WRITE_SINGLE_COIL:
+            return struct.pack(">BHH", function_code, request.address, 0xFF00 if request.values else 0)
+        if function_code == cst.WRITE_SINGLE_REGISTER:
+            return struct.pack(">BHH", function_code, request.address, request.values)
+        return struct.pack(">BHH", function_code, request.address, request.quantity)
+
+    def _enqueue(self, peer, request):
+        """
+        queue request of client peer, or join an identical queued read
+
+        Returns:
+            request(_Request): the request to wait for, None if rate limited or too many are queued
+        """
+        with self._condition:
+            flight = self._flights.get(request.key) if request.key is not None else None
+            if flight is not None:
+                # a read not sent yet answers every client asking for the same registers
+                self._count(peer, "coalesced")
+                return flight
+            if self.rate_limit is not None:
+                bucket = self._buckets.get(peer)
+                if bucket is None:
+                    bucket = self._buckets[peer] = TokenBucket(self.rate_limit, self.burst)
+                if not bucket.allow():
+                    return None
+            queue = self._queues.get(peer)
+            if queue is None:
+                queue = self._queues[peer] = deque()
+            if len(queue) >= self.max_pending:
+                return None
+            if not queue:
+                self._ready.append(peer)
+            queue.append(request)
+            if request.key is not None:
+                self._flights[request.key] = request
+            self._condition.notify()
+        self._count(peer, "upstream_requests")
+        return request
+
+    def _next(self):
+        with self._condition:
+            while self._running and not self._ready:
+                self._condition.wait()
+            if not self._running:
+                return None
+            peer = self._ready.popleft()
+            queue = self._queues[peer]
+            request = queue.popleft()
+            if queue:
+                self._ready.append(peer)
+            else:
+                del self._queues[peer]
+            if request.key is not None:
+                # later identical reads are sent again, they may follow a write
+                del self._flights[request.key]
+            request.started = time.perf_counter()
+            return request
+
+    def _execute(self, request):
+        client = self.client
+        function_code = request.function_code
+        if function_code == cst.READ_HOLDING_REGISTERS:
+            version = self.cache.version() if self.cache is not None else None
+            result = bytes(client.read_holding_registers_raw(request.address, request.quantity, self._receive_buffer,
+                                                             request.unit))
+            if self.cache is not None:
+                self.cache.put(request.unit, request.address, struct.unpack(">{}H".format(request.quantity), result),
+                               version)
+            return result
+        result = client.execute_request(request.unit, function_code, request.address, request.quantity,
+                                        request.values)
+        if function_code in _READ_BITS + _READ_REGISTERS:
+            return result
+        if self.cache is not None and function_code in (cst.WRITE_SINGLE_REGISTER, cst.WRITE_MULTIPLE_REGISTERS):
+            values = request.values if function_code == cst.WRITE_MULTIPLE_REGISTERS else (request.values,)
+            self.cache.update(request.unit, request.address, values)
+        return None
+
+    def _run(self):
+        while True:
+            request = self._next()
+            if request is None:
+                return
+            try:
+                request.result = self._execute(request)
+            except Exception as e:
+                request.error = e
+                # slave exception responses are answered as is, only link failures are logged
+                if _exception_code(e) is None:
+                    logging.error("[Modbus-Error] gateway request of function code {} failed! the error is: {}".format(
+                        request.function_code, e))
+            request.upstream = time.perf_counter() - request.started
+            request.done.set()
+
+    def snapshot(self):
+        """
+        Returns:
+            snapshot(dict): gateway counters in total and per connected client, latency histograms
+                            and upstream client stats
+        """
+        with self._stats_lock:
+            clients = {peer: dict(stats.counters, connections=stats.connections) for peer, stats in self._clients.items()}
+            histograms = {phase: histogram.snapshot() for phase, histogram in self._histograms.items()}
+            totals = dict(self._totals)
+        with self._condition:
+            queued = sum(len(queue) for queue in self._queues.values())
+        snapshot = {"upstream": "{}:{}".format(self.client.modbus_server_ip, self.client.port),
+                    "counters": totals, "queued": queued, "clients": clients, "histograms": histograms}
+        if self.cache is not None:
+            snapshot["cache"] = self.cache.stats()
+        if self.client.stats is not None:
+            snapshot["upstream_stats"] = self.client.stats.snapshot()
+        return snapshot
+
+    def prometheus_text(self, prefix="modbus_gateway"):
+        """gateway metrics in the Prometheus text exposition format, followed by the upstream client stats"""
+        snapshot = self.snapshot()
+        lines = []
+        for counter in GATEWAY_COUNTERS:
+            name = "{}_{}_total".format(prefix, counter)
+            lines.append("# TYPE {} counter".format(name))
+            lines.append("{} {}".format(name, snapshot["counters"][counter]))
+        # connected clients only, a client ends with its last connection
+        for counter in GATEWAY_COUNTERS:
+            name = "{}_client_{}_total".format(prefix, counter)
+            lines.append("# TYPE {} counter".format(name))
+            for peer, counters in sorted(snapshot["clients"].items()):
+                lines.append('{}{{client="{}"}} {}'.format(name, peer, counters[counter]))
+        for phase in GATEWAY_PHASES:
+            name = "{}_{}_seconds".format(prefix, phase)
+            histogram = snapshot["histograms"][phase]
+            lines.append("# TYPE {} histogram".format(name))
+            cumulative = 0
+            for bound, count in histogram["buckets"].items():
+                cumulative += count
+                lines.append('{}_bucket{{le="{}"}} {}'.format(name, bound, cumulative))
+            lines.append("{}_sum {}".format(name, histogram["sum"]))
+            lines.append("{}_count {}".format(name, histogram["count"]))
+        text = "\n".join(lines) + "\n"
+        if self.client.stats is not None:
+            text += prometheus_text(self.client.stats)
+        return text
+
+    def start(self):
+        self._running = True
+        self._server = _GatewayServer((self.address, self.port), _GatewayHandler)
+        self._server.gateway = self
+        self.port = self._server.server_address[1]
+        self._threads = [threading.Thread(target=self._run, name="modbus-gateway-upstream", daemon=True),
+                         threading.Thread(target=self._server.serve_forever, name="modbus-gateway", daemon=True)]
+        if self.stats_port is not None:
+            self._stats_server = ThreadingHTTPServer((self.stats_address, self.stats_port), _StatsHandler)
+            self._stats_server.daemon_threads = True
+            self._stats_server.gateway = self
+            self.stats_port = self._stats_server.server_address[1]
+            self._threads.append(threading.Thread(target=self._stats_server.serve_forever,
+                                                  name="modbus-gateway-stats", daemon=True))
+        for thread in self._threads:
+            thread.start()
+        logging.info("[Modbus] gateway listening on {}:{}".format(self.address, self.port))
+        return self
+
+    def stop(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+            # answer the requests still queued
+            for queue in self._queues.values():
+                for request in queue:
+                    request.error = Exception("[Modbus-Error] gateway stopped")
+                    request.done.set()
+            self._queues.clear()
+            self._ready.clear()
+            self._flights.clear()
+        for server in (self._server, self._stats_server):
+            if server is not None:
+                server.shutdown()
+                server.server_close()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+__all__ = ["ModbusGateway", "TokenBucket", "GATEWAY_COUNTERS", "GATEWAY_PHASES", "EXCEPTION_ILLEGAL_FUNCTION",
+           "EXCEPTION_ILLEGAL_DATA_VALUE", "EXCEPTION_SLAVE_DEVICE_BUSY", "EXCEPTION_GATEWAY_TARGET_FAILED"]
@@ -1,22 +1,48 @@
 	
+import time
+import traceback
+
 import modbus_tk
 import modbus_tk.defines as cst
 from modbus_tk import modbus_rtu
 import serial
 
+from .instrumentation import ModbusStats, RTU_FRAMING_BYTES
+from .modbus_tcp_client import ModbusTcpClient, FMT_SIGNED_WORD, BYTE_ORDER_BIG_ENDIAN
+from .tag_map import Tag, plan_reads
+
+# max count of coils/discrete inputs of one read request
+MAX_READ_BITS = 2000
+
 
 class ModbusRtuMaster:
-    def __init__(self, port, baudrate):
+    def __init__(self, port, baudrate, parity='E', bytesize=8, stopbits=1, slave_id=1, signed=True):
         self.port = port
         self.baudrate = baudrate
+        self.parity = parity
+        self.bytesize = bytesize
+        self.stopbits = stopbits
+        self.slave_id = slave_id
+        self.signed = signed
         self.modbus_rtu_master = None
+        self.stats = None # optional ModbusStats, see instrumentation.py
+        # False skips the process-wide lock of modbus_tk, only when one thread owns the port, see RtuBusScheduler
+        self.threadsafe = True
+
+    def enable_stats(self):
+        if self.stats is None:
+            self.stats = ModbusStats("{}/{}".format(self.port, self.slave_id))
+        return self.stats
+
+    def disable_stats(self):
+        self.stats = None
 
     def run(self, timeout=10):
         self.modbus_rtu_master = modbus_rtu.RtuMaster(serial.Serial(port=self.port, 
                                 baudrate=self.baudrate, 
-                                bytesize=8, 
-                                parity='E', 
-                                stopbits=1))
+                                bytesize=self.bytesize, 
+                                parity=self.parity, 
+                                stopbits=self.stopbits))
         self.modbus_rtu_master.set_timeout(timeout)
         print("[INFO]: Modbus_Rtu Master running!!")
 
@@ -25,10 +51,38 @@ class ModbusRtuMaster:
             self.modbus_rtu_master.close()
 
 
+    def set_slave_id(self, slave_id):
+        self.slave_id = slave_id
+
+    def set_holding_register_signed(self, signed):
+        """
+        defines holding/input register to be signed or unsigned value
+        """
+        self.signed = signed
+
+    def _execute(self, request_pdu_bytes, response_pdu_bytes, slave, function_code, *args, **kwargs):
+        """
+        RtuMaster.execute(), wire time and frame bytes are recorded if stats are enabled
+        """
+        stats = self.stats
+        if stats is None:
+            return self.modbus_rtu_master.execute(slave, function_code, *args, threadsafe=self.threadsafe, **kwargs)
+        start = time.perf_counter()
+        try:
+            result = self.modbus_rtu_master.execute(slave, function_code, *args, threadsafe=self.threadsafe,
+                                                    **kwargs)
+        except Exception as e:
+            stats.observe_request(function_code, 0.0, time.perf_counter() - start,
+                                  RTU_FRAMING_BYTES + request_pdu_bytes, 0, e)
+            raise
+        stats.observe_request(function_code, 0.0, time.perf_counter() - start,
+                              RTU_FRAMING_BYTES + request_pdu_bytes, RTU_FRAMING_BYTES + response_pdu_bytes)
+        return result
+
     def write_single(self, address, value):
         res = None
         try:
-            res = self.modbus_rtu_master.execute(1, cst.WRITE_SINGLE_COIL, address, output_value=value)
+            res = self._execute(5, 5, self.slave_id, cst.WRITE_SINGLE_COIL, address, output_value=value)
             print("[Mobuds INFO]: write command successful !\n[res]: {}".format(res))
         except Exception as e:
             traceback.print_exc()
@@ -37,20 +91,142 @@ class ModbusRtuMaster:
     def read_single(self, address):
         res = None
         try:
-            return self.modbus_rtu_master.execute(1, cst.READ_COILS, address, 1)
+            return self._execute(5, 3, self.slave_id, cst.READ_COILS, address, 1)
         except Exception as e:
             traceback.print_exc()
             print("[Mobuds ERROR]: read command error \n[ERROR INFO]: {}\n[res]: {}".format(e, res))
 
-    def wait_until(self, *args):
+    def _read_bits(self, function_code, address, count):
+        try:
+            return self._execute(5, 2 + (count + 7) // 8, self.slave_id, function_code, address, count)
+        except Exception as e:
+            raise Exception("[Modbus-Error] can not read bits! the error is: {}\n---".format(e))
+
+    def _read_registers(self, function_code, address, count):
+        # ">" is read friendly notation in byte order, that is AB
+        data_format = ">{}h".format(count) if self.signed else ">{}H".format(count)
+        try:
+            return self._execute(5, 2 + 2 * count, self.slave_id, function_code, address, count,
+                                 data_format=data_format)
+        except Exception as e:
+            raise Exception("[Modbus-Error] can not read registers! the error is: {}\n---".format(e))
+
+    def read_coils(self, address, count=1):
+        """
+        read a serial of coils in one request
+
+        Returns:
+            results(tuple): a tuple of 0/1
         """
+        return self._read_bits(cst.READ_COILS, address, count)
+
+    def read_discrete_inputs(self, address, count=1):
+        """
+        read a serial of discrete inputs in one request
+
+        Returns:
+            results(tuple): a tuple of 0/1
+        """
+        return self._read_bits(cst.READ_DISCRETE_INPUTS, address, count)
+
+    def read_holding_registers(self, address, count=1):
+        """
+        read a serial of holding registers in one request
+        each of the result holding registers is big endian based, that is AB
+
+        Returns:
+            results(tuple): a tuple of holding registers
+        """
+        return self._read_registers(cst.READ_HOLDING_REGISTERS, address, count)
+
+    def read_input_registers(self, address, count=1):
+        """
+        read a serial of input registers in one request
+        each of the result input registers is big endian based, that is AB
+
+        Returns:
+            results(tuple): a tuple of input registers
+        """
+        return self._read_registers(cst.READ_INPUT_REGISTERS, address, count)
+
+    def write_coils(self, address, values):
+        """
+        write a serial of coils in one request
+
+        Args:
+            address(int): starting address of coils
+            values(Iterable): 0/1 of every coil
+        """
+        values = list(values)
+        try:
+            return self._execute(6 + (len(values) + 7) // 8, 5, self.slave_id, cst.WRITE_MULTIPLE_COILS, address,
+                                 output_value=values)
+        except Exception as e:
+            raise Exception("[Modbus-Error] can not write coils! the error is: {}\n---".format(e))
+
+    def write_holding_registers(self, address, holding_register_values):
+        """
+        write a serial of holding registers in one request
+        """
+        count = len(holding_register_values)
+        data_format = ">{}h".format(count) if self.signed else ">{}H".format(count)
+        try:
+            return self._execute(6 + 2 * count, 5, self.slave_id, cst.WRITE_MULTIPLE_REGISTERS, address,
+                                 output_value=holding_register_values, data_format=data_format)
+        except Exception as e:
+            raise Exception("[Modbus-Error] can not write holding registers! the error is: {}\n---".format(e))
+
+    def read_hr_commands(self, address, count=1, display_format=FMT_SIGNED_WORD, endianness=BYTE_ORDER_BIG_ENDIAN):
+        """
+        read holding registers and parse them to count actual values, see ModbusTcpClient.read_hr_commands
+        """
+        holding_registers = self.read_holding_registers(address, count * (display_format.bytes // 2))
+        return ModbusTcpClient.unpack_holding_registers(holding_registers, self.signed, display_format, endianness)
+
+    def read_ir_commands(self, address, count=1, display_format=FMT_SIGNED_WORD, endianness=BYTE_ORDER_BIG_ENDIAN):
+        """
+        read input registers and parse them to count actual values
+        """
+        input_registers = self.read_input_registers(address, count * (display_format.bytes // 2))
+        return ModbusTcpClient.unpack_holding_registers(input_registers, self.signed, display_format, endianness)
+
+    def write_hr_commands(self, address, values, display_format=FMT_SIGNED_WORD, endianness=BYTE_ORDER_BIG_ENDIAN):
+        """
+        write actual values to holding registers, see ModbusTcpClient.write_hr_commands
+        """
+        holding_register_values = ModbusTcpClient.pack_values(values, self.signed, display_format, endianness)
+        self.write_holding_registers(address, holding_register_values)
+
+    def wait_until(self, *args, timeout=None, interval=0.2, max_gap=16):
+        """
+        wait until any of the coils in args is on
+        the coils are fetched by as few range reads as possible per round
+
+        Args:
+            args(int): coil addresses
+            timeout(float): max seconds to wait, None to wait forever
+            interval(float): seconds between two rounds
+            max_gap(int): max count of unwatched coils read to merge two ranges
+        Returns:
+            the value of the first coil which is on, None on timeout
         """
         print("modbus client is waiting for io:",args)
+        # a coil tag spans one address, so the register planner applies as is
+        blocks = plan_reads([Tag(arg, arg) for arg in set(args)], max_gap, MAX_READ_BITS)
+        deadline = None if timeout is None else time.monotonic() + timeout
         while True:
-            for arg in args:
-                cmd = self.read_single(arg)[0]
-                if cmd:
-                    print("[Modbus] get a command signal:{},value:{}".format(arg, cmd))
-                    return cmd
-                else:
-                    time.sleep(0.2)
+            for block in blocks:
+                try:
+                    coils = self.read_coils(block.address, block.count)
+                except Exception as e:
+                    print("[Mobuds ERROR]: read command error \n[ERROR INFO]: {}".format(e))
+                    continue
+                for arg in args:
+                    if block.address <= arg < block.address + block.count:
+                        cmd = coils[arg - block.address]
+                        if cmd:
+                            print("[Modbus] get a command signal:{},value:{}".format(arg, cmd))
+                            return cmd
+            if deadline is not None and time.monotonic() >= deadline:
+                return None
+            time.sleep(interval)
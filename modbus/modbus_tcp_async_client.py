@@ -0,0 +1,230 @@
+'''
+an asyncio ModbusTcpClient implementation
+AsyncModbusTcpClient keeps several requests in flight on one TCP connection
+and matches the replies by MBAP transaction id, their unit id and function code are checked against the request
+'''
+
+import asyncio
+import struct
+import sys
+
+import modbus_tk.defines as cst
+from modbus_tk.exceptions import ModbusInvalidResponseError
+
+from .glog import logger as logging
+from .modbus_tcp_client import ModbusTcpClient, FMT_SIGNED_WORD, BYTE_ORDER_BIG_ENDIAN
+
+# transaction id, protocol id, length, unit id
+_MBAP_HEADER = struct.Struct(">HHHB")
+
+
+class AsyncModbusTcpClient(object):
+    """AsyncModbusTcpClient act as asyncio socket client, aka ModbusTcp Master"""
+
+    def __init__(self, server_ip="127.0.0.1", port=502, signed=True, time_out=5.0, max_retry=20, slave_id=1,
+                 pipeline_depth=8):
+        """
+        Args:
+            pipeline_depth(int): max count of requests in flight, 1 for PLCs accepting only one outstanding request
+        """
+        bybe_order = sys.byteorder.capitalize()
+        assert(bybe_order == "Little")
+        assert(pipeline_depth >= 1)
+        self.modbus_server_ip = server_ip
+        self.port = port
+        self.signed = signed
+        self.time_out = time_out
+        self.max_retry = max_retry
+        self.slave_id = slave_id
+        self.pipeline_depth = pipeline_depth
+        self._reader = None
+        self._writer = None
+        self._reader_task = None
+        self._pipeline = None
+        # transaction id to (future, unit id, function code) of the requests in flight
+        self._pending = {}
+        self._transaction_id = 0
+
+    async def connect(self):
+        for _ in range(self.max_retry):
+            try:
+                self._reader, self._writer = await asyncio.wait_for(
+                    asyncio.open_connection(self.modbus_server_ip, self.port), self.time_out)
+                self._pipeline = asyncio.Semaphore(self.pipeline_depth)
+                self._reader_task = asyncio.ensure_future(self._read_loop())
+                # heart beat holding register
+                await self.read_holding_registers(0, 1)
+                logging.info("[Modbus] connect success to slave {}".format(self.modbus_server_ip))
+                return True
+            except Exception as e:
+                await self.close()
+                logging.error("[Modbus-Error] can not connect to slave! the error is: {}".format(e))
+                await asyncio.sleep(self.time_out)
+        return False
+
+    async def close(self):
+        if self._reader_task:
+            self._reader_task.cancel()
+            self._reader_task = None
+        if self._writer:
+            self._writer.close()
+            self._writer = None
+        self._fail_pending(ConnectionError("connection closed"))
+
+    def set_holding_register_signed(self, signed):
+        """
+        defines holding register to be signed or unsigned value
+        """
+        self.signed = signed
+
+    def set_slave_id(self, slave_id):
+        self.slave_id = slave_id
+
+    def _fail_pending(self, exc):
+        pending, self._pending = self._pending, {}
+        for future, _, _ in pending.values():
+            if not future.done():
+                future.set_exception(exc)
+
+    def _next_transaction_id(self):
+        # skip ids still in flight after wrapping around
+        while True:
+            self._transaction_id = (self._transaction_id + 1) & 0xFFFF
+            if self._transaction_id not in self._pending:
+                return self._transaction_id
+
+    async def _read_loop(self):
+        """dispatch every reply to the request with the same transaction id"""
+        try:
+            while True:
+                header = await self._reader.readexactly(_MBAP_HEADER.size)
+                transaction_id, protocol_id, length, unit_id = _MBAP_HEADER.unpack(header)
+                # the length counts the unit id and at least a function code, the stream can not be resynchronized
+                if protocol_id != 0 or length < 2:
+                    raise ModbusInvalidResponseError("invalid MBAP header, protocol id {} length {}".format(
+                        protocol_id, length))
+                pdu = await self._reader.readexactly(length - 1)
+                request = self._pending.pop(transaction_id, None)
+                # a reply to a timed out request is dropped
+                if request is None or request[0].done():
+                    continue
+                future, request_unit_id, function_code = request
+                if unit_id != request_unit_id or pdu[0] & 0x7F != function_code or (pdu[0] & 0x80 and len(pdu) < 2):
+                    future.set_exception(ModbusInvalidResponseError(
+                        "reply of unit {} function code {} to a request of unit {} function code {}".format(
+                            unit_id, pdu[0], request_unit_id, function_code)))
+                else:
+                    future.set_result(pdu)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error("[Modbus-Error] connection to slave {} lost! the error is: {}".format(self.modbus_server_ip, e))
+            if self._writer:
+                self._writer.close()
+                self._writer = None
+            self._fail_pending(e)
+
+    async def _execute(self, slave_id, pdu):
+        """
+        send a request pdu and wait for its reply pdu, at most time_out seconds
+        a timed out request leaves the other requests in flight untouched
+        """
+        if self._writer is None:
+            raise Exception("[Modbus-Error] not connected to slave {}".format(self.modbus_server_ip))
+        async with self._pipeline:
+            transaction_id = self._next_transaction_id()
+            future = asyncio.get_running_loop().create_future()
+            self._pending[transaction_id] = (future, slave_id, pdu[0])
+            self._writer.write(_MBAP_HEADER.pack(transaction_id, 0, len(pdu) + 1, slave_id) + pdu)
+            try:
+                await self._writer.drain()
+                response = await asyncio.wait_for(future, self.time_out)
+            finally:
+                self._pending.pop(transaction_id, None)
+        if response[0] & 0x80:
+            raise Exception("modbus exception code {}".format(response[1]))
+        return response
+
+    async def _write_holding_registers(self, address, signed, holding_register_values, slave_id):
+        """
+        write multiple holding registers
+        """
+        count = len(holding_register_values)
+        # signed is consistent with PLC
+        data_format = ">{}h".format(count) if signed else ">{}H".format(count)
+        try:
+            pdu = struct.pack(">BHHB", cst.WRITE_MULTIPLE_REGISTERS, address, count, count * 2) \
+                  + struct.pack(data_format, *holding_register_values)
+            response = await self._execute(slave_id, pdu)
+            result = struct.unpack(">HH", response[1:5])
+        except Exception as e:
+            raise Exception("[Modbus-Error] can not write holding registers! the error is: {}\n---".format(e))
+        return result
+
+    async def _read_holding_registers(self, address, signed, count, slave_id):
+        """
+        read holding registers by starting adress and count of holding registers
+        the result is a tuple of holding registers, each is big endian based. eg: AB
+        """
+        # ">" is read friendly notation in byte order, that is AB
+        # signed is consistent with PLC
+        data_format = ">{}h".format(count) if signed else ">{}H".format(count)
+        try:
+            pdu = struct.pack(">BHH", cst.READ_HOLDING_REGISTERS, address, count)
+            response = await self._execute(slave_id, pdu)
+            result = struct.unpack(data_format, response[2:2 + response[1]])
+        except Exception as e:
+            raise Exception("[Modbus-Error] can not read holding registers! the error is: {}\n---".format(e))
+        return result
+
+    async def write_holding_registers(self, address, holding_register_values):
+        """
+        write a serial of modbus holding registers
+
+        Args:
+            address(int): starting address of holding registers
+            holding_register_values(Iterable):
+        Returns:
+        """
+        await self._write_holding_registers(address, self.signed, holding_register_values, self.slave_id)
+
+    async def write_hr_commands(self, address, values, display_format=FMT_SIGNED_WORD, endianness=BYTE_ORDER_BIG_ENDIAN):
+        """
+        write a serial of actual values to modbus holding registers.
+        the values should be identical in display_format and endianness
+        """
+        holding_register_values = ModbusTcpClient.pack_values(values, self.signed, display_format, endianness)
+        await self.write_holding_registers(address, holding_register_values)
+
+    async def read_holding_registers(self, address, count=1):
+        """
+        read a serial of modbus holding registers
+        each of the result holding registers is big endian based, that is AB
+
+        Args:
+            address(int): starting address of holding registers
+            count(int): count number of holding registers holding to be read
+        Returns:
+            results(tuple): a tuple of holding registers
+        """
+        return await self._read_holding_registers(address, self.signed, count, self.slave_id)
+
+    async def read_hr_commands(self, address, count=1, display_format=FMT_SIGNED_WORD, endianness=BYTE_ORDER_BIG_ENDIAN):
+        """
+        read a serial of modbus holding regesiters and parse them to actual values
+        actual values should be identical in display_format and endianness
+
+        Args:
+            address(int): starting address of holding registers
+            count(int): count number of actual values
+            display_format:
+            endianness:
+        Returns:
+            a tuple of actual values(int/double/float), which can be used directly
+        """
+        words_num = count * (display_format.bytes//2)
+        read_holding_registers = await self.read_holding_registers(address, words_num)
+        return ModbusTcpClient.unpack_holding_registers(read_holding_registers, self.signed, display_format, endianness)
+
+
+__all__ = ["AsyncModbusTcpClient"]
@@ -11,14 +11,19 @@ a ModbusTcpClient implementation using modbus_tk
 ModbusTcpClient is mainly for communication with PLC
 '''
 
+from array import array
 from collections import namedtuple
 from collections.abc import Iterable
+from functools import lru_cache
 import struct, sys, time
 import modbus_tk.defines as cst
 from multiprocessing import Lock
-from modbus_tk import modbus_tcp
+from modbus_tk import modbus_tcp, utils
+from modbus_tk.exceptions import ModbusError, ModbusInvalidResponseError
 
 from .glog import logger as logging
+from .instrumentation import ModbusStats, MBAP_BYTES
+from .connection_supervisor import ConnectionSupervisor, ExponentialBackoff, is_link_error
 
 #supported format
 DisplayFormat = namedtuple('DisplayFormat', ['format', 'bytes', 'info'])
@@ -37,92 +42,165 @@ BYTE_ORDER_LITTLE_ENDIAN = 1
 BYTE_ORDER_BIG_ENDIAN_SWAP = 2
 BYTE_ORDER_LITTLE_ENDIAN_SWAP = 3
 
+# mbap header, function code and byte count of a read response, followed by at most 125 registers
+_RAW_REQUEST = struct.Struct(">HHHBBHH")
+_RAW_RESPONSE_HEADER = struct.Struct(">HHHBBB")
+RAW_PAYLOAD_OFFSET = _RAW_RESPONSE_HEADER.size
+RAW_BUFFER_SIZE = RAW_PAYLOAD_OFFSET + 2 * 125
 
-def _swap_little_endian_2bytes(src_bytes: bytes) -> bytes:
-    """
-    byte order : BA
-    """
-    rb = b''
-    assert(len(src_bytes)%2==0)
-    for i in range(len(src_bytes)):
-        if i%2 == 0:
-            rb += bytes([src_bytes[i+1], src_bytes[i]])
-    return rb
-
-def _swap_little_endian_4bytes(src_bytes: bytes) -> bytes:
-    """
-    byte order : DC BA
-    """
-    rb = b''
-    assert(len(src_bytes)%4==0)
-    for i in range(len(src_bytes)):
-        if i%4 == 0:
-            rb += bytes([src_bytes[i+3], src_bytes[i+2], src_bytes[i+1], src_bytes[i]])
-    return rb
-
-def _swap_byte_big_endian_4bytes(src_bytes: bytes) -> bytes:
-    """
-    byte order : BA DC
-    """
-    rb = b''
-    assert(len(src_bytes)%4==0)
-    for i in range(len(src_bytes)):
-        if i%4 == 0:
-            rb += bytes([src_bytes[i+1], src_bytes[i], src_bytes[i+3], src_bytes[i+2]])
-    return rb
-
-def _swap_byte_little_endian_4bytes(src_bytes: bytes) -> bytes:
-    """
-    byte order : CD AB
-    """
-    rb = b''
-    assert(len(src_bytes)%4==0)
-    for i in range(len(src_bytes)):
-        if i%4 == 0:
-            rb += bytes([src_bytes[i+2], src_bytes[i+3], src_bytes[i], src_bytes[i+1]])
-    return rb
-
-def _swap_little_endian_8bytes(src_bytes: bytes) -> bytes:
-    """
-    byte order : HG FE DC BA
-    """
-    rb = b''
-    assert(len(src_bytes)%8==0)
-    for i in range(len(src_bytes)):
-        if i%8 == 0:
-            rb += bytes([src_bytes[i+7], src_bytes[i+6], src_bytes[i+5], src_bytes[i+4],
-                            src_bytes[i+3], src_bytes[i+2], src_bytes[i+1], src_bytes[i]])
-    return rb
-
-def _swap_byte_big_endian_8bytes(src_bytes: bytes) -> bytes:
+
+_SUPPORTED_FORMATS = (FMT_SIGNED_WORD, FMT_UNSIGNED_WORD, FMT_SIGNED_2WORD, FMT_UNSIGNED_2WORD,
+                      FMT_FLOAT_2WORD, FMT_SIGNED_4WORD, FMT_UNSIGNED_4WORD, FMT_DOUBLE_4WORD)
+
+# every supported byte order is a combination of the byte order inside one holding register
+# and the byte order of the whole value built from those registers, eg: for ABCD
+#   BIG_ENDIAN          ABCD  -> registers ">", value ">"
+#   LITTLE_ENDIAN       DC BA -> registers ">", value "<"
+#   BIG_ENDIAN_SWAP     BA DC -> registers "<", value ">"
+#   LITTLE_ENDIAN_SWAP  CD AB -> registers "<", value "<"
+_ENDIAN_STRUCT_ORDERS = {
+    BYTE_ORDER_BIG_ENDIAN: (">", ">"),
+    BYTE_ORDER_LITTLE_ENDIAN: (">", "<"),
+    BYTE_ORDER_BIG_ENDIAN_SWAP: ("<", ">"),
+    BYTE_ORDER_LITTLE_ENDIAN_SWAP: ("<", "<"),
+}
+
+
+@lru_cache(maxsize=1024)
+def _cached_struct(byte_order, count, fmt):
+    return struct.Struct("{}{}{}".format(byte_order, count, fmt))
+
+
+class RegisterCodec(object):
     """
-    byte order : BA DC FE HG
+    precompiled encoder/decoder for one (display_format, endianness, signed) combination
+    values are converted to/from holding registers in a single struct pass, no byte shuffling in python
+    use get_register_codec() to get a cached instance
     """
-    rb = b''
-    assert(len(src_bytes)%8==0)
-    for i in range(len(src_bytes)):
-        if i%8 == 0:
-            rb += bytes([src_bytes[i+1], src_bytes[i], src_bytes[i+3], src_bytes[i+2],
-                            src_bytes[i+5], src_bytes[i+4], src_bytes[i+7], src_bytes[i+6]])
-    return rb
-
-def _swap_byte_little_endian_8bytes(src_bytes: bytes) -> bytes:
+
+    def __init__(self, display_format, endianness, signed):
+        if display_format not in _SUPPORTED_FORMATS:
+            raise NotImplementedError("display format {} is not supported".format(display_format))
+        if endianness not in _ENDIAN_STRUCT_ORDERS:
+            raise Exception("[Modbus] endian type {} is not supported".format(endianness))
+        self.display_format = display_format
+        self.endianness = endianness
+        self.signed = signed
+        self.register_order, self.value_order = _ENDIAN_STRUCT_ORDERS[endianness]
+        self.register_format = "h" if signed else "H"
+        # count of holding registers per value
+        self.words = display_format.bytes // 2
+        # 16 bit values whose registers are not swapped are passed through untouched
+        self.passthrough = self.words == 1 and self.register_order == self.value_order
+        # struct order to decode values straight from big endian wire registers, None if a byte swap is needed
+        if self.register_order == ">":
+            self.wire_order = self.value_order
+        elif self.words == 1:
+            self.wire_order = ">" if self.value_order == "<" else "<"
+        else:
+            self.wire_order = None
+
+    def register_struct(self, count):
+        """struct.Struct of count holding registers"""
+        return _cached_struct(self.register_order, count, self.register_format)
+
+    def value_struct(self, count):
+        """struct.Struct of count actual values"""
+        return _cached_struct(self.value_order, count, self.display_format.format)
+
+    def encode(self, values):
+        """
+        encode actual values to a tuple of holding registers, each is big endian based
+
+        Args:
+            values(list/tuple): actual values, integer or double/float
+        Returns:
+            results(tuple): a tuple of holding registers
+        """
+        count = len(values)
+        packed = self.value_struct(count).pack(*values)
+        if self.passthrough:
+            return values
+        return self.register_struct(count * self.words).unpack(packed)
+
+    def decode(self, holding_registers):
+        """
+        decode a tuple/list of big endian based holding registers to actual values
+
+        Args:
+            holding_registers(list/tuple): holding registers, each is AB
+        Returns:
+            results(tuple): a tuple of actual values(int/double/float)
+        """
+        count = len(holding_registers)
+        packed = self.register_struct(count).pack(*holding_registers)
+        return self.value_struct(count // self.words).unpack(packed)
+
+    def _wire_bytes(self, buffer, count, offset):
+        """
+        the bytes of count values in buffer as the value struct expects them, and their offset
+        registers are big endian on the wire, swapped orders need one byte swap pass
+        """
+        if self.wire_order is not None:
+            return buffer, offset
+        size = count * self.display_format.bytes
+        view = memoryview(buffer)[offset:offset + size]
+        swapped = bytearray(size)
+        swapped[0::2] = view[1::2]
+        swapped[1::2] = view[0::2]
+        return swapped, 0
+
+    def decode_from(self, buffer, count, offset=0):
+        """
+        decode count actual values straight from the raw register bytes of a response
+
+        Args:
+            buffer(bytes/bytearray/memoryview): holding registers as sent on the wire, each is AB
+            count(int): count of actual values
+            offset(int): byte offset of the first register in buffer
+        Returns:
+            results(tuple): a tuple of actual values(int/double/float)
+        """
+        data, offset = self._wire_bytes(buffer, count, offset)
+        return _cached_struct(self.wire_order or self.value_order, count, self.display_format.format).unpack_from(data, offset)
+
+    def decode_into(self, buffer, out, count=None, offset=0):
+        """
+        decode actual values from raw register bytes into out, a list, array.array or numpy array
+        count defaults to len(out)
+        """
+        count = len(out) if count is None else count
+        if type(out).__module__ == "numpy":
+            out[:count] = self.numpy_view(buffer, count, offset)
+        elif isinstance(out, array):
+            out[:count] = array(out.typecode, self.decode_from(buffer, count, offset))
+        else:
+            out[:count] = self.decode_from(buffer, count, offset)
+        return out
+
+    def numpy_view(self, buffer, count, offset=0):
+        """
+        numpy array of count actual values over the raw register bytes
+        the array shares memory with buffer unless a byte swap pass is needed, numpy is required
+        """
+        import numpy as np
+        data, offset = self._wire_bytes(buffer, count, offset)
+        dtype = np.dtype((self.wire_order or self.value_order) + self.display_format.format)
+        return np.frombuffer(data, dtype=dtype, count=count, offset=offset)
+
+
+@lru_cache(maxsize=None)
+def get_register_codec(display_format, endianness, signed=True):
     """
-    byte order : GH EF CD AB
+    get the cached RegisterCodec of display_format, endianness and signed
     """
-    rb = b''
-    assert(len(src_bytes)%8==0)
-    for i in range(len(src_bytes)):
-        if i%8 == 0:
-            rb += bytes([src_bytes[i+6], src_bytes[i+7], src_bytes[i+4], src_bytes[i+5],
-                            src_bytes[i+2], src_bytes[i+3], src_bytes[i], src_bytes[i+1]])
-    return rb
+    return RegisterCodec(display_format, endianness, bool(signed))
 
 
 class ModbusTcpClient(object):
     """ModbusTcpClient act as socket client, aka ModbusTcp Master"""
 
-    def __init__(self, server_ip="127.0.0.1", port=502, signed=True, time_out=5.0, max_retry=20, slave_id=1):
+    def __init__(self, server_ip="127.0.0.1", port=502, signed=True, time_out=5.0, max_retry=20, slave_id=1, cache=None, stats=False):
         bybe_order = sys.byteorder.capitalize()
         assert(bybe_order == "Little")
         self.modbus_server_ip = server_ip
@@ -131,7 +209,20 @@ class ModbusTcpClient(object):
         self.time_out = time_out
         self.max_retry = max_retry
         self.slave_id = slave_id
-        self._client_lock = Lock() # redundant as TcpMaster.execute() is thread safe
+        # serializes the requests of this client, the process wide lock of TcpMaster.execute() is skipped
+        # so that a slave timing out does not hold up the clients of other slaves
+        self._client_lock = Lock()
+        self._modbus_client = None
+        self.cache = cache # optional RegisterCache, see register_cache.py
+        self.stats = None # optional ModbusStats, see instrumentation.py
+        self.supervisor = None # optional ConnectionSupervisor, see enable_auto_reconnect()
+        self.recorder = None # optional TrafficRecorder, see traffic_log.py
+        self._ever_connected = False
+        # receive buffer of the raw read path, reused by every raw read under the client lock
+        self._raw_buffer = bytearray(RAW_BUFFER_SIZE)
+        self._transaction_id = 0
+        if stats:
+            self.enable_stats()
 
     def connect(self):
         connected  = self._connect_modbus_server(server_ip=self.modbus_server_ip, port=self.port, \
@@ -143,32 +234,102 @@ class ModbusTcpClient(object):
         defines holding register to be signed or unsigned value
         """
         self.signed = signed
+        if self.cache is not None:
+            # cached holding registers are decoded by the previous signed
+            self.cache.clear()
+
+    def set_cache(self, cache):
+        """
+        enable read-through caching of holding registers by a RegisterCache, None to disable
+        """
+        self.cache = cache
+
+    def set_recorder(self, recorder):
+        """
+        record every successful request to a TrafficRecorder, None to disable
+        """
+        self.recorder = recorder
     
+    def enable_stats(self):
+        """
+        enable per request instrumentation
+        Returns:
+            stats(ModbusStats): use stats.snapshot() or prometheus_text() to export
+        """
+        if self.stats is None:
+            self.stats = ModbusStats("{}:{}/{}".format(self.modbus_server_ip, self.port, self.slave_id))
+        return self.stats
+
+    def disable_stats(self):
+        self.stats = None
+
     def set_slave_id(self, slave_id):
         self.slave_id = slave_id
 
+    def enable_auto_reconnect(self, backoff=None, queue_while_down=False, heartbeat_interval=None, keepalive=True):
+        """
+        connect and keep reconnecting in the background, connect() is not needed
+        requests issued while the link is down fail fast, or wait up to time_out if queue_while_down
+
+        Args:
+            backoff(ExponentialBackoff): delays between reconnect attempts
+            heartbeat_interval(float): seconds of idle link before a heartbeat read, None to disable
+            keepalive(bool/tuple): enable TCP keepalive, or (idle, interval, count) in seconds
+        Returns:
+            supervisor(ConnectionSupervisor): use add_state_callback() / wait_connected() to observe the link
+        """
+        if self.supervisor is None:
+            self.supervisor = ConnectionSupervisor(self, backoff, queue_while_down, heartbeat_interval, keepalive)
+            self.supervisor.start()
+        return self.supervisor
+
+    def _open_link(self, server_ip=None, port=None, time_out=None):
+        """open a new TcpMaster and check it by a heart beat, raises on failure"""
+        # init yet not connect to socket server
+        self._modbus_client = modbus_tcp.TcpMaster(host=server_ip or self.modbus_server_ip, port=port or self.port)
+        self._modbus_client.set_timeout(self.time_out if time_out is None else time_out)
+        # connect
+        self._modbus_client.open()
+        self._heartbeat()
+
+    def _heartbeat(self):
+        """heart beat holding register"""
+        with self._client_lock:
+            self._modbus_client.execute(self.slave_id, cst.READ_HOLDING_REGISTERS, 0, 1, threadsafe=False)
+
+    def _close_link(self):
+        with self._client_lock:
+            if self._modbus_client:
+                self._modbus_client.close()
+            self._modbus_client = None
+
+    def _count_connect(self):
+        if self.stats is not None:
+            self.stats.count("reconnects" if self._ever_connected else "connects")
+        self._ever_connected = True
+
     def _connect_modbus_server(self, server_ip, port, time_out, max_retry):
-        for _ in range(max_retry):
+        backoff = ExponentialBackoff(initial=min(0.1, time_out), max_delay=time_out)
+        for attempt in range(max_retry):
             try:
-                # init yet not connect to socket server
-                # open and close connection each time in TcpMaster.execute()
-                self._modbus_client = modbus_tcp.TcpMaster(host=server_ip, port=port) 
-                self._modbus_client.set_timeout(time_out)
-                # connect
-                self._modbus_client.open()
-                # heart beat holding register
-                self.read_holding_registers(0, 1)
+                self._open_link(server_ip, port, time_out)
                 logging.info("[Modbus] connect success to slave {}".format(server_ip))
+                self._count_connect()
                 return True
-                break
             except Exception as e:
-                self._modbus_client = None
+                self._close_link()
                 logging.error("[Modbus-Error] can not connect to slave! the error is: {}".format(e))
-                time.sleep(time_out)
-                continue
+                if attempt + 1 < max_retry:
+                    if self.stats is not None:
+                        self.stats.count("retries")
+                    # jittered exponential backoff, at most time_out
+                    time.sleep(backoff.delay(attempt))
         return False
    
     def close(self):
+        if self.supervisor is not None:
+            self.supervisor.stop()
+            self.supervisor = None
         if self._modbus_client:
             self._modbus_client.close()     
 
@@ -190,46 +351,7 @@ class ModbusTcpClient(object):
         if not isinstance(src_values, list) and not isinstance(src_values, tuple):
             src_values = (src_values,)
 
-        fmt = display_format.format
-        count = len(src_values)
-
-        # big endian is read friendly notation. eg: AB/ABCD/ABCDEFGH
-        pack_data = struct.pack(">" + str(count) +fmt, *src_values)
-        if display_format == FMT_SIGNED_WORD or display_format == FMT_UNSIGNED_WORD:           
-            if endianness == BYTE_ORDER_BIG_ENDIAN or endianness == BYTE_ORDER_LITTLE_ENDIAN_SWAP:
-                return src_values
-            elif endianness == BYTE_ORDER_LITTLE_ENDIAN or endianness == BYTE_ORDER_BIG_ENDIAN_SWAP:
-                ret = _swap_little_endian_2bytes(pack_data)
-            else:
-                raise Exception("[Modbus] endian type {} is not supported".format(endianness))
-        elif display_format == FMT_SIGNED_2WORD or display_format == FMT_UNSIGNED_2WORD or display_format ==FMT_FLOAT_2WORD:
-            if endianness == BYTE_ORDER_BIG_ENDIAN:
-                ret = pack_data
-            elif endianness == BYTE_ORDER_LITTLE_ENDIAN:
-                ret = _swap_little_endian_4bytes(pack_data)
-            elif endianness == BYTE_ORDER_BIG_ENDIAN_SWAP:
-                ret = _swap_byte_big_endian_4bytes(pack_data)
-            elif endianness == BYTE_ORDER_LITTLE_ENDIAN_SWAP:
-                ret = _swap_byte_little_endian_4bytes(pack_data)
-            else:
-                raise Exception("[Modbus] endian type {} is not supported".format(endianness))
-        elif display_format == FMT_SIGNED_4WORD or display_format == FMT_UNSIGNED_4WORD or display_format == FMT_DOUBLE_4WORD:
-            if endianness == BYTE_ORDER_BIG_ENDIAN:
-                ret = pack_data
-            elif endianness == BYTE_ORDER_LITTLE_ENDIAN:
-                ret = _swap_little_endian_8bytes(pack_data)
-            elif endianness == BYTE_ORDER_BIG_ENDIAN_SWAP:
-                ret = _swap_byte_big_endian_8bytes(pack_data)
-            elif endianness == BYTE_ORDER_LITTLE_ENDIAN_SWAP:
-                ret = _swap_byte_little_endian_8bytes(pack_data)
-            else:
-                raise Exception("[Modbus] endian type {} is not supported".format(endianness))
-        else:
-            raise NotImplementedError("display format {} is not supported".format(display_format))
-
-        data_format = ">{}h".format(len(ret)//2) if signed else ">{}H".format(len(ret)//2)
-        results = struct.unpack(data_format, ret)
-        return results
+        return get_register_codec(display_format, endianness, signed).encode(src_values)
 
     @staticmethod
     def unpack_holding_registers(holding_registers, signed, display_format, endianness):
@@ -249,45 +371,141 @@ class ModbusTcpClient(object):
         if not isinstance(holding_registers, Iterable):
             holding_registers = (holding_registers,)
 
-        count = len(holding_registers)
+        return get_register_codec(display_format, endianness, signed).decode(holding_registers)
 
-        data_format = ">{}h".format(count) if signed else ">{}H".format(count)
-        pack_data = struct.pack(data_format, *holding_registers)
-
-        if display_format == FMT_SIGNED_WORD or display_format == FMT_UNSIGNED_WORD:
-            if endianness == BYTE_ORDER_BIG_ENDIAN or endianness == BYTE_ORDER_LITTLE_ENDIAN_SWAP:
-                ret = pack_data
-            elif endianness == BYTE_ORDER_LITTLE_ENDIAN or endianness == BYTE_ORDER_BIG_ENDIAN_SWAP:
-                ret = _swap_little_endian_2bytes(pack_data)
-            else:
-                raise Exception("[Modbus] endian type {} is not supported".format(endianness))
-        elif display_format == FMT_SIGNED_2WORD or display_format == FMT_UNSIGNED_2WORD or display_format == FMT_FLOAT_2WORD:
-            if endianness == BYTE_ORDER_BIG_ENDIAN:
-                ret = pack_data
-            elif endianness == BYTE_ORDER_LITTLE_ENDIAN:
-                ret = _swap_little_endian_4bytes(pack_data)
-            elif endianness == BYTE_ORDER_BIG_ENDIAN_SWAP:
-                ret = _swap_byte_big_endian_4bytes(pack_data)
-            elif endianness == BYTE_ORDER_LITTLE_ENDIAN_SWAP:
-                ret = _swap_byte_little_endian_4bytes(pack_data)
-            else:
-                raise Exception("[Modbus] endian type {} is not supported".format(endianness))
-        elif display_format == FMT_SIGNED_4WORD or display_format == FMT_UNSIGNED_4WORD or display_format == FMT_DOUBLE_4WORD:
-            if endianness == BYTE_ORDER_BIG_ENDIAN:
-                ret = pack_data
-            elif endianness == BYTE_ORDER_LITTLE_ENDIAN:
-                ret = _swap_little_endian_8bytes(pack_data)
-            elif endianness == BYTE_ORDER_BIG_ENDIAN_SWAP:
-                ret = _swap_byte_big_endian_8bytes(pack_data)
-            elif endianness == BYTE_ORDER_LITTLE_ENDIAN_SWAP:
-                ret = _swap_byte_little_endian_8bytes(pack_data)
-            else:
-                raise Exception("[Modbus] endian type {} is not supported".format(endianness))
+    def _execute(self, request_pdu_bytes, response_pdu_bytes, **kwargs):
+        """
+        TcpMaster.execute() under the client lock
+        the link is checked first and repaired on failure if auto reconnect is enabled
+        """
+        supervisor = self.supervisor
+        if supervisor is None:
+            result = self._timed_execute(request_pdu_bytes, response_pdu_bytes, **kwargs)
         else:
-            raise NotImplementedError("display format {} is not supported".format(display_format))
-        # ret is big endian based after swapping
-        results = struct.unpack(">{}{}".format(len(ret)//display_format.bytes, display_format.format), ret)
-        return results
+            supervisor.check_link()
+            try:
+                result = self._timed_execute(request_pdu_bytes, response_pdu_bytes, **kwargs)
+            except Exception as e:
+                supervisor.notify_failure(e)
+                raise
+            supervisor.notify_activity()
+        # raw reads are recorded by _raw_execute(), before decoding
+        if self.recorder is not None and "buffer" not in kwargs:
+            self.recorder.record_execute(kwargs, result)
+        return result
+
+    def _timed_execute(self, request_pdu_bytes, response_pdu_bytes, **kwargs):
+        """
+        lock wait, wire time and frame bytes are recorded if stats are enabled
+        """
+        stats = self.stats
+        execute = self._raw_execute if "buffer" in kwargs else self._tcp_master_execute
+        if stats is None:
+            with self._client_lock:
+                return execute(**kwargs)
+        start = time.perf_counter()
+        with self._client_lock:
+            locked = time.perf_counter()
+            try:
+                result = execute(**kwargs)
+            except Exception as e:
+                stats.observe_request(kwargs["function_code"], locked - start, time.perf_counter() - locked,
+                                      MBAP_BYTES + request_pdu_bytes, 0, e)
+                raise
+            done = time.perf_counter()
+        stats.observe_request(kwargs["function_code"], locked - start, done - locked,
+                              MBAP_BYTES + request_pdu_bytes, MBAP_BYTES + response_pdu_bytes)
+        return result
+
+    def _link_socket(self):
+        """socket of TcpMaster, a ConnectionError (a link error) if the link is closed"""
+        sock = self._modbus_client._sock if self._modbus_client is not None else None
+        if sock is None:
+            raise ConnectionError("link to slave {} is closed".format(self.modbus_server_ip))
+        return sock
+
+    def _tcp_master_execute(self, **kwargs):
+        self._link_socket()
+        return self._modbus_client.execute(threadsafe=False, **kwargs)
+
+    def _recv_into(self, sock, view):
+        while view:
+            received = sock.recv_into(view)
+            if not received:
+                raise ModbusInvalidResponseError("connection closed by the slave")
+            view = view[received:]
+
+    def _raw_execute(self, slave, function_code, starting_address, quantity_of_x, buffer, decode=None):
+        """
+        one read request on the socket of TcpMaster, the response is received into buffer as is
+        modbus_tk receives byte by byte and builds a tuple of ints, this path does neither
+        the link is reopened on a broken frame or a timeout, the rest of the stream can not be framed again
+
+        Returns:
+            decode(view) if decode, otherwise view: a memoryview of the register bytes in buffer
+        """
+        try:
+            payload = self._raw_transact(slave, function_code, starting_address, quantity_of_x, buffer)
+        except Exception as e:
+            if is_link_error(e):
+                self._reopen_link()
+            raise
+        if self.recorder is not None:
+            self.recorder.append(function_code, slave, starting_address, quantity_of_x, payload)
+        return payload if decode is None else decode(payload)
+
+    def _raw_transact(self, slave, function_code, starting_address, quantity_of_x, buffer):
+        sock = self._link_socket()
+        # drop late replies of timed out requests, as TcpMaster does before every send
+        utils.flush_socket(sock, 3)
+        self._transaction_id = transaction_id = (self._transaction_id + 1) & 0xFFFF
+        sock.sendall(_RAW_REQUEST.pack(transaction_id, 0, 6, slave, function_code, starting_address, quantity_of_x))
+        view = memoryview(buffer)
+        while True:
+            self._recv_into(sock, view[:RAW_PAYLOAD_OFFSET])
+            response_id, protocol_id, length, _, response_code, byte_count = _RAW_RESPONSE_HEADER.unpack_from(buffer)
+            # the header holds unit id, function code and one byte of the pdu
+            if protocol_id != 0 or length < 3 or RAW_PAYLOAD_OFFSET + length - 3 > len(buffer):
+                raise ModbusInvalidResponseError("invalid response header: protocol {}, length {}".format(
+                    protocol_id, length))
+            payload = view[RAW_PAYLOAD_OFFSET:RAW_PAYLOAD_OFFSET + length - 3]
+            self._recv_into(sock, payload)
+            # a late reply of a timed out request is skipped as a whole
+            if response_id == transaction_id:
+                break
+        if response_code == function_code + 0x80:
+            # the byte count field is the exception code
+            raise ModbusError(byte_count)
+        if response_code != function_code or byte_count != 2 * quantity_of_x or length != byte_count + 3:
+            raise ModbusInvalidResponseError("unexpected response: function code {}, {} bytes, length {}".format(
+                response_code, byte_count, length))
+        return payload
+
+    def _reopen_link(self):
+        """reconnect the socket of TcpMaster after a broken frame, the caller holds the client lock"""
+        try:
+            self._modbus_client.close()
+            self._modbus_client.open()
+        except Exception as e:
+            logging.error("[Modbus-Error] can not reopen link to slave {}! the error is: {}".format(
+                self.modbus_server_ip, e))
+
+    def _read_holding_registers_raw(self, address, count, slave_id, buffer, decode=None):
+        """
+        read holding registers into buffer, see _raw_execute()
+        """
+        try:
+            result = self._execute(5, 2 + 2 * count,
+                                   slave=slave_id,
+                                   function_code=cst.READ_HOLDING_REGISTERS,
+                                   starting_address=address,
+                                   quantity_of_x=count,
+                                   buffer=buffer,
+                                   decode=decode)
+        except Exception as e:
+            result = None
+            raise Exception("[Modbus-Error] can not read holding registers! the error is: {}\n---".format(e))
+        return result
 
     def _write_holding_registers(self, address, signed, holding_register_values, slave_id):
         """
@@ -296,16 +514,16 @@ class ModbusTcpClient(object):
         count = len(holding_register_values)
         # signed is consistent with PLC
         data_format = ">{}h".format(count) if signed else ">{}H".format(count)
-        with self._client_lock:
-            try:
-                result = self._modbus_client.execute(slave=slave_id,
-                                                     function_code=cst.WRITE_MULTIPLE_REGISTERS,
-                                                     starting_address=address,
-                                                     output_value=holding_register_values,
-                                                     data_format=data_format)
-            except Exception as e:
-                result = None
-                raise Exception("[Modbus-Error] can not write holding registers! the error is: {}\n---".format(e))
+        try:
+            result = self._execute(6 + 2 * count, 5,
+                                   slave=slave_id,
+                                   function_code=cst.WRITE_MULTIPLE_REGISTERS,
+                                   starting_address=address,
+                                   output_value=holding_register_values,
+                                   data_format=data_format)
+        except Exception as e:
+            result = None
+            raise Exception("[Modbus-Error] can not write holding registers! the error is: {}\n---".format(e))
         return result
 
     def _read_holding_registers(self, address, signed, count, slave_id):
@@ -317,18 +535,46 @@ class ModbusTcpClient(object):
         # ">" is read friendly notation in byte order, that is AB
         # signed is consistent with PLC
         data_format = ">{}h".format(count) if signed else ">{}H".format(count)
-        with self._client_lock:
-            try:
-                result = self._modbus_client.execute(slave=slave_id,
-                                                     function_code=cst.READ_HOLDING_REGISTERS,
-                                                     starting_address=address,
-                                                     quantity_of_x=count, 
-                                                     data_format=data_format)
-            except Exception as e:
-                result = None
-                raise Exception("[Modbus-Error] can not read holding registers! the error is: {}\n---".format(e))
+        try:
+            result = self._execute(5, 2 + 2 * count,
+                                   slave=slave_id,
+                                   function_code=cst.READ_HOLDING_REGISTERS,
+                                   starting_address=address,
+                                   quantity_of_x=count, 
+                                   data_format=data_format)
+        except Exception as e:
+            result = None
+            raise Exception("[Modbus-Error] can not read holding registers! the error is: {}\n---".format(e))
         return result
 
+    def _read_coils(self, address, count, slave_id):
+        """
+        read coils by starting adress and count of coils
+        the result is a tuple of 0/1
+        """
+        try:
+            result = self._execute(5, 2 + (count + 7) // 8,
+                                   slave=slave_id,
+                                   function_code=cst.READ_COILS,
+                                   starting_address=address,
+                                   quantity_of_x=count)
+        except Exception as e:
+            result = None
+            raise Exception("[Modbus-Error] can not read coils! the error is: {}\n---".format(e))
+        return result
+
+    def read_coils(self, address, count=1):
+        """
+        read a serial of modbus coils
+
+        Args:
+            address(int): starting address of coils
+            count(int): count number of coils to be read
+        Returns:
+            results(tuple): a tuple of 0/1
+        """
+        return self._read_coils(address, count, self.slave_id)
+
     def write_holding_registers(self, address, holding_register_values):
         """
         write a serial of modbus holding registers
@@ -340,6 +586,8 @@ class ModbusTcpClient(object):
         """
 
         self._write_holding_registers(address, self.signed, holding_register_values, self.slave_id)
+        if self.cache is not None:
+            self.cache.update(self.slave_id, address, holding_register_values)
 
     def write_hr_commands(self, address, values, display_format=FMT_SIGNED_WORD, endianness=BYTE_ORDER_BIG_ENDIAN):
         """
@@ -347,7 +595,12 @@ class ModbusTcpClient(object):
         eg: values=[1, 360, 179, 1234] 
         the values should be identical in display_format and endianness
         """
-        holding_register_values = ModbusTcpClient.pack_values(values, self.signed, display_format, endianness)
+        if self.stats is None:
+            holding_register_values = ModbusTcpClient.pack_values(values, self.signed, display_format, endianness)
+        else:
+            start = time.perf_counter()
+            holding_register_values = ModbusTcpClient.pack_values(values, self.signed, display_format, endianness)
+            self.stats.observe_codec(cst.WRITE_MULTIPLE_REGISTERS, time.perf_counter() - start)
         self.write_holding_registers(address, holding_register_values)
 
     def read_holding_registers(self, address, count=1):
@@ -361,7 +614,16 @@ class ModbusTcpClient(object):
         Returns:
             results(tuple): a tuple of holding registers
         """
+        cache = self.cache
+        if cache is not None:
+            cached = cache.get(self.slave_id, address, count)
+            if cached is not None:
+                return cached
+            # a write through while this read is on the wire makes put() drop it
+            version = cache.version()
         read_holding_registers = self._read_holding_registers(address, self.signed, count, self.slave_id)
+        if cache is not None:
+            cache.put(self.slave_id, address, read_holding_registers, version)
         return read_holding_registers
 
     def read_hr_commands(self, address, count=1, display_format=FMT_SIGNED_WORD, endianness=BYTE_ORDER_BIG_ENDIAN):
@@ -379,11 +641,107 @@ class ModbusTcpClient(object):
         """
         words_num = count * (display_format.bytes//2)
         read_holding_registers = self.read_holding_registers(address, words_num)
+        if self.stats is None:
+            return ModbusTcpClient.unpack_holding_registers(read_holding_registers, self.signed, display_format, endianness)
+        start = time.perf_counter()
         read_data = ModbusTcpClient.unpack_holding_registers(read_holding_registers, self.signed, display_format, endianness)
+        self.stats.observe_codec(cst.READ_HOLDING_REGISTERS, time.perf_counter() - start)
         return read_data
 
+    def read_holding_registers_raw(self, address, count=1, buffer=None, slave_id=None):
+        """
+        read a serial of modbus holding registers without decoding them
+        the register cache is bypassed
+
+        Args:
+            address(int): starting address of holding registers
+            count(int): count number of holding registers, at most 125
+            buffer(bytearray): receive buffer of at least RAW_BUFFER_SIZE bytes, None to reuse the client buffer
+            slave_id(int): None for the slave id of the client
+        Returns:
+            view(memoryview): 2 * count bytes in buffer, each holding register is AB
+                              a view of the client buffer is only valid until the next raw read
+        """
+        return self._read_holding_registers_raw(address, count, self.slave_id if slave_id is None else slave_id,
+                                                self._raw_buffer if buffer is None else buffer)
+
+    def execute_request(self, slave_id, function_code, address, quantity=1, values=None):
+        """
+        send one request as given, for gateways and bridges forwarding the requests of other masters
+        the register cache is bypassed and holding registers are unsigned
+
+        Args:
+            function_code(int): read coils/discrete inputs/holding registers/input registers,
+                                write single coil/register or write multiple coils/registers
+            quantity(int): count of coils/registers of reads and multiple writes
+            values: the value of single writes, an Iterable of multiple writes
+        Returns:
+            results(tuple): coils/registers of reads, the echoed (address, value/quantity) of writes
+        """
+        kwargs = dict(slave=slave_id, function_code=function_code, starting_address=address)
+        if function_code in (cst.READ_COILS, cst.READ_DISCRETE_INPUTS):
+            return self._execute(5, 2 + (quantity + 7) // 8, quantity_of_x=quantity, **kwargs)
+        if function_code in (cst.READ_HOLDING_REGISTERS, cst.READ_INPUT_REGISTERS):
+            return self._execute(5, 2 + 2 * quantity, quantity_of_x=quantity,
+                                 data_format=">{}H".format(quantity), **kwargs)
+        if function_code == cst.WRITE_MULTIPLE_REGISTERS:
+            return self._execute(6 + 2 * quantity, 5, output_value=values,
+                                 data_format=">{}H".format(quantity), **kwargs)
+        if function_code == cst.WRITE_MULTIPLE_COILS:
+            return self._execute(6 + (quantity + 7) // 8, 5, output_value=values, **kwargs)
+        if function_code in (cst.WRITE_SINGLE_COIL, cst.WRITE_SINGLE_REGISTER):
+            return self._execute(5, 5, output_value=values, **kwargs)
+        raise Exception("[Modbus-Error] function code {} is not supported".format(function_code))
+
+    def read_hr_commands_into(self, address, count=1, display_format=FMT_SIGNED_WORD, endianness=BYTE_ORDER_BIG_ENDIAN,
+                              out=None):
+        """
+        read_hr_commands() decoding the values straight from the received bytes
+        no tuple of holding registers is built and the register cache is bypassed
+
+        Args:
+            out(list/array.array/numpy.ndarray): filled with the count values if given
+        Returns:
+            out if given, otherwise a tuple of actual values(int/double/float)
+        """
+        codec = get_register_codec(display_format, endianness, self.signed)
+        if out is None:
+            decode = lambda payload: codec.decode_from(payload, count)
+        else:
+            decode = lambda payload: codec.decode_into(payload, out, count)
+        return self._read_holding_registers_raw(address, count * codec.words, self.slave_id, self._raw_buffer, decode)
+
+    def read_tags(self, tag_map):
+        """
+        read every tag of tag_map with the fewest read holding registers requests
+
+        Args:
+            tag_map(TagMap): tag table, see tag_map.py
+        Returns:
+            results(dict): tag name to actual value
+        """
+        return tag_map.read(self)
+
+    def read_record(self, address, layout):
+        """
+        read one record of mixed display formats and endianness
+
+        Args:
+            address(int): starting address of the record
+            layout(RecordLayout): record layout, see record_layout.py
+        Returns:
+            record(namedtuple)
+        """
+        return layout.read(self, address)
+
+    def write_record(self, address, layout, record):
+        """
+        write one whole record in a single frame
+        """
+        layout.write(self, address, record)
+
 __all__ = [
-    "ModbusTcpClient",
+    "ModbusTcpClient", "RegisterCodec", "get_register_codec", "RAW_BUFFER_SIZE", "RAW_PAYLOAD_OFFSET",
     "FMT_SIGNED_WORD", "FMT_UNSIGNED_WORD", "FMT_SIGNED_2WORD", "FMT_UNSIGNED_2WORD",
     "FMT_FLOAT_2WORD", "FMT_SIGNED_4WORD", "FMT_UNSIGNED_4WORD", "FMT_DOUBLE_4WORD",
     "BYTE_ORDER_BIG_ENDIAN", "BYTE_ORDER_LITTLE_ENDIAN", 
@@ -0,0 +1,254 @@
+'''
+a subscription based poll engine
+PollEngine reads subscribed holding registers and coils at their periods,
+subscriptions sharing a period are read together in batched requests,
+callbacks and waiters are only woken up when a value changes
+'''
+
+from collections import namedtuple
+import heapq, threading, time
+
+from .glog import logger as logging
+from .modbus_tcp_client import FMT_SIGNED_WORD, BYTE_ORDER_BIG_ENDIAN
+from .tag_map import Tag, TagMap, plan_reads
+
+# max count of coils of one modbus read coils request
+MAX_READ_COILS = 2000
+
+KIND_REGISTER = "register"
+KIND_COIL = "coil"
+
+Subscription = namedtuple('Subscription', ['name', 'kind', 'tag', 'period', 'deadband', 'callback'])
+
+
+def value_changed(old, new, deadband):
+    """
+    True if new differs from old, numbers within deadband of old are not a change
+    old/new are scalars or tuples of the same length
+    """
+    if old is None:
+        return True
+    if deadband <= 0:
+        return old != new
+    if not isinstance(new, tuple):
+        old, new = (old,), (new,)
+    return any(abs(n - o) > deadband for o, n in zip(old, new))
+
+
+class _PeriodGroup(object):
+    """subscriptions sharing one period and their planned read blocks"""
+
+    def __init__(self, period):
+        self.period = period
+        self.subscriptions = {}
+        self._register_blocks = None
+        self._coil_blocks = None
+
+    def invalidate(self):
+        self._register_blocks = None
+        self._coil_blocks = None
+
+    def register_blocks(self, max_gap):
+        if self._register_blocks is None:
+            self._register_blocks = plan_reads([s.tag for s in self.subscriptions.values() if s.kind == KIND_REGISTER],
+                                               max_gap)
+        return self._register_blocks
+
+    def coil_blocks(self, max_gap):
+        # a coil tag of FMT_SIGNED_WORD spans tag.count addresses, so the register planner applies as is
+        if self._coil_blocks is None:
+            self._coil_blocks = plan_reads([s.tag for s in self.subscriptions.values() if s.kind == KIND_COIL],
+                                           max_gap, MAX_READ_COILS)
+        return self._coil_blocks
+
+
+class PollEngine(object):
+    """PollEngine polls subscriptions on a background thread of its own"""
+
+    def __init__(self, client, max_gap=8):
+        """
+        Args:
+            client: ModbusTcpClient or any client with read_holding_registers(address, count),
+                    read_coils(address, count) and signed
+            max_gap(int): max count of unused addresses merged into one batched read
+        """
+        self.client = client
+        self.max_gap = max_gap
+        self._groups = {}
+        self._names = {}
+        self._values = {}
+        self._condition = threading.Condition()
+        self._thread = None
+        self._running = False
+
+    def subscribe(self, name, address, period, display_format=FMT_SIGNED_WORD, endianness=BYTE_ORDER_BIG_ENDIAN,
+                  count=1, deadband=0.0, callback=None):
+        """
+        subscribe holding registers
+
+        Args:
+            name(str): unique name of the subscription
+            address(int): starting address of holding registers
+            period(float): poll period in seconds
+            count(int): count number of actual values
+            deadband(float): changes not larger than deadband are ignored, mostly for float/double formats
+            callback(callable): callback(name, value, old_value) on every change, called on the poll thread
+        """
+        tag = Tag(name, address, display_format, endianness, count)
+        self._add(Subscription(name, KIND_REGISTER, tag, period, deadband, callback))
+
+    def subscribe_coils(self, name, address, period, count=1, callback=None):
+        """
+        subscribe coils, value is 0/1 or a tuple of 0/1 if count > 1
+        """
+        tag = Tag(name, address, FMT_SIGNED_WORD, BYTE_ORDER_BIG_ENDIAN, count)
+        self._add(Subscription(name, KIND_COIL, tag, period, 0.0, callback))
+
+    def _add(self, subscription):
+        with self._condition:
+            if subscription.name in self._names:
+                self._remove(subscription.name)
+            group = self._groups.get(subscription.period)
+            if group is None:
+                group = self._groups[subscription.period] = _PeriodGroup(subscription.period)
+            group.subscriptions[subscription.name] = subscription
+            group.invalidate()
+            self._names[subscription.name] = group
+            # wake up the poll thread to schedule a new period
+            self._condition.notify_all()
+
+    def unsubscribe(self, name):
+        with self._condition:
+            self._remove(name)
+
+    def _remove(self, name):
+        group = self._names.pop(name)
+        del group.subscriptions[name]
+        group.invalidate()
+        self._values.pop(name, None)
+        if not group.subscriptions:
+            del self._groups[group.period]
+
+    def get(self, name):
+        """latest value of a subscription, None before the first read"""
+        with self._condition:
+            return self._values.get(name)
+
+    def wait_for(self, names, predicate=bool, timeout=None):
+        """
+        block until the value of any subscription in names satisfies predicate
+
+        Args:
+            names(str/Iterable): one or several subscription names
+            predicate(callable): predicate(value) -> bool
+            timeout(float): max seconds to wait, None to wait forever
+        Returns:
+            (name, value) of the first satisfied subscription, None on timeout
+        """
+        if isinstance(names, str):
+            names = (names,)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while True:
+                for name in names:
+                    value = self._values.get(name)
+                    if value is not None and predicate(value):
+                        return name, value
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self._condition.wait(remaining)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="modbus-poll", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def poll(self, period):
+        """read every subscription of period once and publish the changes"""
+        with self._condition:
+            group = self._groups.get(period)
+            if group is None:
+                return
+            register_blocks = group.register_blocks(self.max_gap)
+            coil_blocks = group.coil_blocks(self.max_gap)
+            subscriptions = dict(group.subscriptions)
+        results = {}
+        for block in register_blocks:
+            holding_registers = self.client.read_holding_registers(block.address, block.count)
+            TagMap.decode_block(block, holding_registers, self.client.signed, results)
+        for block in coil_blocks:
+            coils = self.client.read_coils(block.address, block.count)
+            for tag in block.tags:
+                offset = tag.address - block.address
+                results[tag.name] = coils[offset] if tag.count == 1 else tuple(coils[offset:offset + tag.count])
+        self._publish(subscriptions, results)
+
+    def _publish(self, subscriptions, results):
+        changes = []
+        with self._condition:
+            for name, value in results.items():
+                subscription = subscriptions[name]
+                if name not in self._names:
+                    # unsubscribed while reading
+                    continue
+                old = self._values.get(name)
+                if value_changed(old, value, subscription.deadband):
+                    self._values[name] = value
+                    changes.append((subscription, value, old))
+            if changes:
+                self._condition.notify_all()
+        for subscription, value, old in changes:
+            if subscription.callback is None:
+                continue
+            try:
+                subscription.callback(subscription.name, value, old)
+            except Exception as e:
+                logging.error("[Modbus-Error] callback of {} failed! the error is: {}".format(subscription.name, e))
+
+    def _run(self):
+        schedule = []
+        scheduled = set()
+        while True:
+            with self._condition:
+                if not self._running:
+                    return
+                now = time.monotonic()
+                for period in self._groups:
+                    if period not in scheduled:
+                        heapq.heappush(schedule, (now, period))
+                        scheduled.add(period)
+                if not schedule:
+                    self._condition.wait()
+                    continue
+                due, period = schedule[0]
+                if due > now:
+                    self._condition.wait(due - now)
+                    continue
+                heapq.heappop(schedule)
+                if period not in self._groups:
+                    scheduled.discard(period)
+                    continue
+            try:
+                self.poll(period)
+            except Exception as e:
+                logging.error("[Modbus-Error] poll of period {} failed! the error is: {}".format(period, e))
+            # keep the original phase, skip missed cycles instead of bursting
+            next_due = due + period
+            now = time.monotonic()
+            if next_due <= now:
+                next_due = now + period - (now - due) % period
+            heapq.heappush(schedule, (next_due, period))
+
+
+__all__ = ["PollEngine", "Subscription", "value_changed", "KIND_REGISTER", "KIND_COIL", "MAX_READ_COILS"]
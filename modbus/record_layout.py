@@ -0,0 +1,248 @@
+'''
+record layouts of mixed holding registers
+a RecordLayout is an ordered list of fields, each with its own display format, endianness and bit fields,
+compiled once to a byte permutation plus a single struct so one register block decodes to a namedtuple
+(or many blocks to a numpy structured array) in one pass, and a whole record is written in one frame
+'''
+
+from collections import namedtuple
+import struct
+
+from .modbus_tcp_client import get_register_codec, FMT_SIGNED_WORD, BYTE_ORDER_BIG_ENDIAN, RAW_BUFFER_SIZE
+from .tag_map import MAX_READ_REGISTERS
+from .write_batcher import MAX_WRITE_REGISTERS
+
+# count values of one display format, name None for reserved registers
+Field = namedtuple('Field', ['name', 'display_format', 'endianness', 'count', 'bits'])
+Field.__new__.__defaults__ = (FMT_SIGNED_WORD, BYTE_ORDER_BIG_ENDIAN, 1, ())
+
+# width bits of an integer field starting at bit shift, bit 0 is the least significant bit
+Bits = namedtuple('Bits', ['name', 'shift', 'width'])
+Bits.__new__.__defaults__ = (1,)
+
+_INTEGER_FORMATS = "hHiIqQ"
+
+
+def _wire_positions(display_format, endianness):
+    """
+    wire_positions[i] is the big endian value byte sent as byte i of the registers of one value,
+    the same mapping as RegisterCodec.encode()/decode()
+    """
+    codec = get_register_codec(display_format, endianness)
+    size = display_format.bytes
+    memory = list(range(size)) if codec.value_order == ">" else list(reversed(range(size)))
+    return memory if codec.register_order == ">" else [memory[i ^ 1] for i in range(size)]
+
+
+class RecordLayout(object):
+    """RecordLayout decodes/encodes one record type, build it once and reuse it"""
+
+    def __init__(self, name, fields):
+        """
+        Args:
+            name(str): name of the record namedtuple
+            fields(Iterable): Field list in register order, eg:
+                [Field("state", FMT_UNSIGNED_WORD, bits=(Bits("ready", 0), Bits("mode", 4, 3))),
+                 Field("position", FMT_FLOAT_2WORD, BYTE_ORDER_LITTLE_ENDIAN_SWAP, count=3),
+                 Field(None, FMT_UNSIGNED_WORD),
+                 Field("counter", FMT_UNSIGNED_4WORD)]
+        """
+        self.name = name
+        self.fields = tuple(fields)
+        formats = []
+        permutation = []
+        # (key, index of the first struct value, count, public) of every field
+        # key is the field name, or a private one for reserved fields
+        self._slots = []
+        # (name, key, shift, mask) of every bit field
+        self._bits = []
+        names = []
+        offset = 0
+        start = 0
+        for index, field in enumerate(self.fields):
+            if field.bits and (field.count != 1 or field.display_format.format not in _INTEGER_FORMATS):
+                raise Exception("[Modbus] bit fields need a single integer field, {} is not".format(field.name))
+            size = field.display_format.bytes
+            positions = _wire_positions(field.display_format, field.endianness)
+            for _ in range(field.count):
+                permutation += [offset + p for p in positions]
+                offset += size
+            formats.append("{}{}".format(field.count, field.display_format.format))
+            key = field.name if field.name is not None else "_{}".format(index)
+            self._slots.append((key, start, field.count, field.name is not None))
+            start += field.count
+            if field.name is not None:
+                names.append(field.name)
+            for bits in field.bits:
+                self._bits.append((bits.name, key, bits.shift, (1 << bits.width) - 1))
+                names.append(bits.name)
+        self.size = offset
+        # count of holding registers of one record
+        self.words = offset // 2
+        self.record_type = namedtuple(name, names)
+        # big endian value bytes, every field of the record normalized for one struct pass
+        self._struct = struct.Struct(">" + "".join(formats))
+        # decoding: normalized[j] = wire[_decode_moves[j]], encoding: wire[i] = normalized[permutation[i]]
+        # only the positions that differ are moved, the rest is one memcpy
+        decode_sources = [0] * offset
+        for wire_index, value_index in enumerate(permutation):
+            decode_sources[value_index] = wire_index
+        self._decode_moves = [(j, i) for j, i in enumerate(decode_sources) if i != j]
+        self._encode_moves = [(i, j) for i, j in enumerate(permutation) if i != j]
+        self._dtypes = None
+
+    @staticmethod
+    def _permute(data, moves, record_size):
+        if not moves:
+            return data
+        view = memoryview(data)
+        result = bytearray(data)
+        for target, source in moves:
+            result[target::record_size] = view[source::record_size]
+        return result
+
+    def _record(self, values):
+        record = {}
+        for key, start, count, public in self._slots:
+            record[key] = values[start] if count == 1 else values[start:start + count]
+        for name, key, shift, mask in self._bits:
+            record[name] = record[key] >> shift & mask
+        return self.record_type(**{name: record[name] for name in self.record_type._fields})
+
+    def decode(self, buffer, offset=0):
+        """
+        decode one record from raw register bytes, eg: ModbusTcpClient.read_holding_registers_raw()
+
+        Args:
+            buffer(bytes/bytearray/memoryview): holding registers as sent on the wire, each is AB
+            offset(int): byte offset of the record in buffer
+        Returns:
+            record(namedtuple): fields of count > 1 are tuples, reserved fields are left out
+        """
+        data = self._permute(memoryview(buffer)[offset:offset + self.size], self._decode_moves, self.size)
+        return self._record(self._struct.unpack(data))
+
+    def decode_many(self, buffer, count, offset=0):
+        """decode count consecutive records, a list of namedtuples"""
+        data = self._permute(memoryview(buffer)[offset:offset + count * self.size], self._decode_moves, self.size)
+        return [self._record(values) for values in self._struct.iter_unpack(data)]
+
+    def decode_registers(self, holding_registers):
+        """decode one record from a tuple/list of holding registers, eg: ModbusTcpClient.read_holding_registers()"""
+        raw = struct.pack(">{}H".format(len(holding_registers)), *[r & 0xFFFF for r in holding_registers])
+        return self.decode(raw)
+
+    @property
+    def dtype(self):
+        """numpy dtype of decode_array() results, numpy is required"""
+        return self._numpy_dtypes()[1]
+
+    def _numpy_dtypes(self):
+        if self._dtypes is None:
+            import numpy as np
+            names, formats, offsets, public = [], [], [], []
+            offset = 0
+            for (key, _, _, is_public), field in zip(self._slots, self.fields):
+                shape = (field.count,) if field.count > 1 else ()
+                names.append(key)
+                formats.append((np.dtype(">" + field.display_format.format), shape))
+                offsets.append(offset)
+                offset += field.count * field.display_format.bytes
+                if is_public:
+                    public.append((key, np.dtype(field.display_format.format), shape))
+                public += [(bits.name, np.min_scalar_type((1 << bits.width) - 1)) for bits in field.bits]
+            wire = np.dtype({"names": names, "formats": formats, "offsets": offsets, "itemsize": self.size})
+            self._dtypes = (wire, np.dtype(public))
+        return self._dtypes
+
+    def decode_array(self, buffer, count, offset=0):
+        """
+        decode count consecutive records to a numpy structured array of dtype, numpy is required
+        """
+        import numpy as np
+        wire, dtype = self._numpy_dtypes()
+        data = self._permute(memoryview(buffer)[offset:offset + count * self.size], self._decode_moves, self.size)
+        normalized = np.frombuffer(data, dtype=wire, count=count)
+        records = np.empty(count, dtype=dtype)
+        for key, _, _, public in self._slots:
+            if public:
+                records[key] = normalized[key]
+        for name, key, shift, mask in self._bits:
+            records[name] = normalized[key] >> shift & mask
+        return records
+
+    def encode(self, record, signed=True):
+        """
+        encode one record to holding registers
+
+        Args:
+            record(namedtuple/dict): values by field name, a missing field or bit field is 0,
+                                     bit fields are merged into the value of their field
+            signed(bool): signed of the client the registers are written by
+        Returns:
+            results(tuple): a tuple of holding registers, each is big endian based
+        """
+        if not isinstance(record, dict):
+            record = record._asdict()
+        values = []
+        for field in self.fields:
+            value = record.get(field.name, 0) if field.name is not None else 0
+            if field.bits:
+                value_bits = 8 * field.display_format.bytes
+                value &= (1 << value_bits) - 1
+                for bits in field.bits:
+                    mask = (1 << bits.width) - 1
+                    value = value & ~(mask << bits.shift) | (record.get(bits.name, 0) & mask) << bits.shift
+                if field.display_format.format.islower() and value >> (value_bits - 1):
+                    value -= 1 << value_bits
+            if field.count == 1:
+                values.append(value)
+            else:
+                values += list(value) if value else [0] * field.count
+        data = self._permute(self._struct.pack(*values), self._encode_moves, self.size)
+        return struct.unpack(">{}{}".format(self.words, "h" if signed else "H"), data)
+
+    def _read_raw(self, client, address, words):
+        raw = getattr(client, "read_holding_registers_raw", None)
+        data = bytearray()
+        for start in range(0, words, MAX_READ_REGISTERS):
+            count = min(MAX_READ_REGISTERS, words - start)
+            if raw is not None:
+                data += raw(address + start, count, bytearray(RAW_BUFFER_SIZE))
+            else:
+                holding_registers = client.read_holding_registers(address + start, count)
+                data += struct.pack(">{}H".format(count), *[r & 0xFFFF for r in holding_registers])
+        return data
+
+    def read(self, client, address):
+        """
+        read one record at address by client, in one request if the record fits
+
+        Args:
+            client(ModbusTcpClient): a connected client
+        Returns:
+            record(namedtuple)
+        """
+        return self.decode(self._read_raw(client, address, self.words))
+
+    def read_many(self, client, address, count, as_array=False):
+        """
+        read count consecutive records, requests are split every 125 holding registers
+
+        Returns:
+            records(list/numpy.ndarray): namedtuples, or a structured array if as_array
+        """
+        data = self._read_raw(client, address, count * self.words)
+        return self.decode_array(data, count) if as_array else self.decode_many(data, count)
+
+    def write(self, client, address, record):
+        """
+        write one whole record in a single write multiple registers frame
+        """
+        if self.words > MAX_WRITE_REGISTERS:
+            raise Exception("[Modbus] record {} spans {} holding registers, more than {} of one frame".format(
+                self.name, self.words, MAX_WRITE_REGISTERS))
+        client.write_holding_registers(address, self.encode(record, client.signed))
+
+
+__all__ = ["RecordLayout", "Field", "Bits"]
@@ -0,0 +1,206 @@
+'''
+a read-through holding register cache for ModbusTcpClient
+blocks are keyed by (slave_id, starting address, count), expire after a per range TTL
+and are evicted in LRU order once the cache exceeds its memory budget
+'''
+
+from bisect import bisect_left, insort
+from collections import OrderedDict, namedtuple
+import threading, time
+
+# ttl applies to blocks of slave_id overlapping [start, end), slave_id None applies to every slave
+TtlRule = namedtuple('TtlRule', ['slave_id', 'start', 'end', 'ttl'])
+
+# every holding register is 2 bytes of budget, the tuple and int objects around it are not counted
+REGISTER_BYTES = 2
+
+
+class _CacheEntry(object):
+    __slots__ = ('address', 'values', 'expires', 'size')
+
+    def __init__(self, address, values, expires):
+        self.address = address
+        self.values = values
+        self.expires = expires
+        self.size = REGISTER_BYTES * len(values)
+
+
+class RegisterCache(object):
+    """RegisterCache holds holding register blocks, sub ranges are served from a cached superset block"""
+
+    def __init__(self, default_ttl=0.1, max_bytes=1 << 20):
+        """
+        Args:
+            default_ttl(float): seconds a block stays valid if no TtlRule matches, 0 disables caching
+            max_bytes(int): budget of all cached blocks, REGISTER_BYTES per holding register
+        """
+        self.default_ttl = default_ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.stale_puts = 0
+        self._rules = []
+        self._entries = OrderedDict()
+        # slave_id to the sorted (address, count) keys of its blocks and the largest count among them
+        self._index = {}
+        self._max_count = {}
+        self._bytes = 0
+        # bumped by every write through and invalidation, a read started before it is not cached,
+        # the version of the last bump of every slave, and of the last bump of all slaves
+        self._version = 0
+        self._slave_versions = {}
+        self._all_version = 0
+        self._lock = threading.Lock()
+
+    def set_ttl(self, address, count, ttl, slave_id=None):
+        """
+        define the TTL of holding registers [address, address + count)
+        a block overlapping several rules gets the shortest TTL
+        """
+        with self._lock:
+            self._rules.append(TtlRule(slave_id, address, address + count, ttl))
+
+    def _ttl(self, slave_id, address, end):
+        ttls = [rule.ttl for rule in self._rules
+                if (rule.slave_id is None or rule.slave_id == slave_id) and rule.start < end and address < rule.end]
+        return min(ttls) if ttls else self.default_ttl
+
+    def _drop(self, key):
+        entry = self._entries.pop(key)
+        self._bytes -= entry.size
+        keys = self._index[key[0]]
+        del keys[bisect_left(keys, key[1:])]
+
+    def _overlapping(self, slave_id, address, end):
+        """keys of the blocks of slave_id overlapping [address, end)"""
+        keys = self._index.get(slave_id)
+        if not keys:
+            return []
+        # a block starting before address - max count can not reach address
+        low = bisect_left(keys, (address - self._max_count[slave_id] + 1,))
+        high = bisect_left(keys, (end,))
+        return [(slave_id,) + k for k in keys[low:high] if address < k[0] + k[1]]
+
+    def _bump(self, slave_id):
+        self._version += 1
+        if slave_id is None:
+            self._all_version = self._version
+        else:
+            self._slave_versions[slave_id] = self._version
+
+    def version(self):
+        """
+        take the version before sending a read and pass it to put(),
+        a write through or invalidation in between makes put() drop the read
+        """
+        with self._lock:
+            return self._version
+
+    def get(self, slave_id, address, count):
+        """
+        Returns:
+            results(tuple): cached holding registers, None on miss
+        """
+        end = address + count
+        now = time.monotonic()
+        with self._lock:
+            for key in self._overlapping(slave_id, address, end):
+                _, entry_address, entry_count = key
+                if address < entry_address or end > entry_address + entry_count:
+                    continue
+                entry = self._entries[key]
+                if entry.expires <= now:
+                    self._drop(key)
+                    continue
+                self._entries.move_to_end(key)
+                self.hits += 1
+                offset = address - entry_address
+                return entry.values[offset:offset + count]
+            self.misses += 1
+            return None
+
+    def put(self, slave_id, address, values, version=None):
+        """
+        cache holding registers read from slave_id at address
+
+        Args:
+            version(int): version() taken before the read was sent, None to cache unconditionally
+        """
+        values = tuple(values)
+        count = len(values)
+        ttl = self._ttl(slave_id, address, address + count)
+        if ttl <= 0:
+            return
+        entry = _CacheEntry(address, values, time.monotonic() + ttl)
+        if entry.size > self.max_bytes:
+            return
+        key = (slave_id, address, count)
+        with self._lock:
+            if version is not None and version < max(self._all_version, self._slave_versions.get(slave_id, 0)):
+                # the read may have been answered before a write of this slave
+                self.stale_puts += 1
+                return
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = entry
+            insort(self._index.setdefault(slave_id, []), key[1:])
+            self._max_count[slave_id] = max(self._max_count.get(slave_id, 0), count)
+            self._bytes += entry.size
+            while self._bytes > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+
+    def update(self, slave_id, address, values):
+        """
+        write through: blocks covering the whole written range are patched,
+        blocks partially overlapping it are invalidated
+        """
+        values = tuple(values)
+        end = address + len(values)
+        with self._lock:
+            self._bump(slave_id)
+            for key in self._overlapping(slave_id, address, end):
+                _, entry_address, entry_count = key
+                if entry_address <= address and end <= entry_address + entry_count:
+                    entry = self._entries[key]
+                    offset = address - entry_address
+                    entry.values = entry.values[:offset] + values + entry.values[offset + len(values):]
+                else:
+                    self._drop(key)
+                    self.invalidations += 1
+
+    def invalidate(self, slave_id=None, address=0, count=None):
+        """drop the blocks of slave_id overlapping [address, address + count), everything by default"""
+        with self._lock:
+            self._bump(slave_id)
+            if slave_id is not None and count is not None:
+                keys = self._overlapping(slave_id, address, address + count)
+            else:
+                keys = [key for key in self._entries if slave_id is None or key[0] == slave_id]
+                if count is not None:
+                    keys = [key for key in keys if address < key[1] + key[2] and key[1] < address + count]
+            for key in keys:
+                self._drop(key)
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._bump(None)
+            self._entries.clear()
+            self._index.clear()
+            self._max_count.clear()
+            self._bytes = 0
+
+    def stats(self):
+        """hit/miss counters to tune TTLs"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses,
+                    "hit_ratio": self.hits / lookups if lookups else 0.0,
+                    "evictions": self.evictions, "invalidations": self.invalidations,
+                    "stale_puts": self.stale_puts, "entries": len(self._entries), "bytes": self._bytes}
+
+
+__all__ = ["RegisterCache", "TtlRule", "REGISTER_BYTES"]
@@ -0,0 +1,284 @@
+'''
+a shared memory image of holding registers for multi-process consumers
+RegisterImagePublisher is the only process talking to the PLC, it polls register ranges
+and publishes them to a multiprocessing.shared_memory segment guarded by a sequence counter (seqlock),
+RegisterImageReader decodes the image in any process of the host, no socket and no pickling
+'''
+
+from bisect import bisect_right
+from collections import namedtuple
+from multiprocessing import resource_tracker, shared_memory
+import os, struct, threading, time
+
+from .glog import logger as logging
+from .modbus_tcp_client import get_register_codec, FMT_SIGNED_WORD, BYTE_ORDER_BIG_ENDIAN, RAW_BUFFER_SIZE
+from .tag_map import MAX_READ_REGISTERS
+
+IMAGE_MAGIC = b"MBRI"
+IMAGE_VERSION = 1
+
+# magic, version, count of ranges, sequence, time.time() of the last publish
+_HEADER = struct.Struct("<4sHHQd")
+_SEQUENCE = struct.Struct("<Q")
+_SEQUENCE_OFFSET = 8
+# starting address, count of registers, byte offset of the registers in the segment
+_RANGE = struct.Struct("<III")
+
+# holding registers [address, address + count) are kept at offset as sent on the wire, each is AB
+ImageRange = namedtuple('ImageRange', ['address', 'count', 'offset'])
+
+
+def _layout(ranges):
+    """ImageRange list sorted by address and the size of the segment"""
+    ranges = sorted((address, count) for address, count in ranges)
+    for (address, count), (next_address, _) in zip(ranges, ranges[1:]):
+        if address + count > next_address:
+            raise Exception("[Modbus-Error] register ranges overlap at address {}".format(next_address))
+    offset = _HEADER.size + _RANGE.size * len(ranges)
+    # registers start 8 bytes aligned
+    offset += -offset % 8
+    layout = []
+    for address, count in ranges:
+        layout.append(ImageRange(address, count, offset))
+        offset += 2 * count
+    return layout, offset
+
+
+# names of the segments created by the publishers of this process
+_published = set()
+
+
+def _attach(name):
+    """attach an existing segment without letting this process' resource tracker unlink it at exit"""
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        pass
+    # python < 3.13 registers every attached segment on posix (bpo-39959), the tracker holds one registration
+    # per name, so it is kept if a publisher of this process owns the segment
+    segment = shared_memory.SharedMemory(name=name)
+    if os.name == "posix" and segment.name not in _published:
+        resource_tracker.unregister(segment._name, "shared_memory")
+    return segment
+
+
+class RegisterImagePublisher(object):
+    """RegisterImagePublisher polls register ranges of one client into a shared memory segment it owns"""
+
+    def __init__(self, client, ranges, name=None, period=0.05):
+        """
+        Args:
+            client: ModbusTcpClient or any client with read_holding_registers(address, count)
+            ranges(Iterable): (address, count) of holding registers to publish, must not overlap
+            name(str): segment name readers attach to, None for a generated one
+            period(float): poll period in seconds
+        """
+        self.client = client
+        self.period = period
+        self.ranges, size = _layout(ranges)
+        self.errors = 0
+        self._segment = shared_memory.SharedMemory(name=name, create=True, size=size)
+        self.name = self._segment.name
+        _published.add(self.name)
+        self._buffer = self._segment.buf
+        # every range is read into a private buffer first, the seqlock is held only for the copy
+        self._staging = [bytearray(2 * r.count) for r in self.ranges]
+        self._receive_buffer = bytearray(RAW_BUFFER_SIZE)
+        self._sequence = 0
+        _HEADER.pack_into(self._buffer, 0, IMAGE_MAGIC, IMAGE_VERSION, len(self.ranges), 0, 0.0)
+        for i, r in enumerate(self.ranges):
+            _RANGE.pack_into(self._buffer, _HEADER.size + _RANGE.size * i, *r)
+        self._running = False
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def _read_range(self, image_range, staging):
+        raw = getattr(self.client, "read_holding_registers_raw", None)
+        for start in range(0, image_range.count, MAX_READ_REGISTERS):
+            count = min(MAX_READ_REGISTERS, image_range.count - start)
+            if raw is not None:
+                staging[2 * start:2 * (start + count)] = raw(image_range.address + start, count,
+                                                                      self._receive_buffer)
+            else:
+                holding_registers = self.client.read_holding_registers(image_range.address + start, count)
+                struct.pack_into(">{}H".format(count), staging, 2 * start, *[r & 0xFFFF for r in holding_registers])
+
+    def publish_once(self):
+        """
+        read every range and publish them as one consistent snapshot
+
+        Returns:
+            sequence(int): sequence of the published snapshot
+        """
+        for image_range, staging in zip(self.ranges, self._staging):
+            self._read_range(image_range, staging)
+        buffer = self._buffer
+        # odd while writing, readers retry
+        _SEQUENCE.pack_into(buffer, _SEQUENCE_OFFSET, self._sequence + 1)
+        for image_range, staging in zip(self.ranges, self._staging):
+            buffer[image_range.offset:image_range.offset + len(staging)] = staging
+        struct.pack_into("<d", buffer, _SEQUENCE_OFFSET + _SEQUENCE.size, time.time())
+        self._sequence += 2
+        _SEQUENCE.pack_into(buffer, _SEQUENCE_OFFSET, self._sequence)
+        return self._sequence
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._running = True
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="modbus-image-{}".format(self.name), daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def close(self):
+        """stop polling and remove the segment, attached readers keep their mapping"""
+        self.stop()
+        self._buffer = None
+        self._segment.close()
+        _published.discard(self.name)
+        self._segment.unlink()
+
+    def _run(self):
+        due = time.monotonic()
+        while self._running:
+            try:
+                self.publish_once()
+            except Exception as e:
+                self.errors += 1
+                logging.error("[Modbus-Error] publish of register image {} failed! the error is: {}".format(self.name, e))
+            # keep the original phase, skip missed cycles instead of bursting
+            due += self.period
+            now = time.monotonic()
+            if due <= now:
+                due = now + self.period - (now - due) % self.period
+            self._stopped.wait(due - now)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class RegisterImageReader(object):
+    """RegisterImageReader gives read_hr_commands() style access to a published register image"""
+
+    def __init__(self, name, signed=True):
+        """
+        Args:
+            name(str): name of the segment, RegisterImagePublisher.name
+            signed(bool): holding registers are returned signed or unsigned by read_holding_registers()
+        """
+        self.name = name
+        self.signed = signed
+        self._segment = _attach(name)
+        self._buffer = self._segment.buf
+        magic, version, range_count, _, _ = _HEADER.unpack_from(self._buffer)
+        if magic != IMAGE_MAGIC or version != IMAGE_VERSION:
+            raise Exception("[Modbus-Error] {} is not a register image of version {}".format(name, IMAGE_VERSION))
+        self.ranges = [ImageRange(*_RANGE.unpack_from(self._buffer, _HEADER.size + _RANGE.size * i))
+                       for i in range(range_count)]
+        self._addresses = [r.address for r in self.ranges]
+
+    @property
+    def sequence(self):
+        """sequence of the latest snapshot, even, 0 before the first publish"""
+        return _SEQUENCE.unpack_from(self._buffer, _SEQUENCE_OFFSET)[0] & ~1
+
+    def _locate(self, address, count):
+        i = bisect_right(self._addresses, address) - 1
+        if i >= 0:
+            r = self.ranges[i]
+            if address + count <= r.address + r.count:
+                return r.offset + 2 * (address - r.address)
+        raise Exception("[Modbus-Error] holding registers {}-{} are not published in {}".format(
+            address, address + count - 1, self.name))
+
+    def read_raw(self, address, count=1):
+        """
+        copy holding registers out of the image under the seqlock
+
+        Returns:
+            (raw, sequence, timestamp): 2 * count bytes, each holding register is AB,
+                                        the snapshot sequence and the time.time() it was published
+        """
+        start = self._locate(address, count)
+        end = start + 2 * count
+        buffer = self._buffer
+        while True:
+            sequence = _SEQUENCE.unpack_from(buffer, _SEQUENCE_OFFSET)[0]
+            if sequence & 1:
+                # the publisher is copying, it holds the seqlock for a few microseconds
+                time.sleep(0)
+                continue
+            raw = bytes(buffer[start:end])
+            timestamp = struct.unpack_from("<d", buffer, _SEQUENCE_OFFSET + _SEQUENCE.size)[0]
+            if _SEQUENCE.unpack_from(buffer, _SEQUENCE_OFFSET)[0] == sequence:
+                return raw, sequence, timestamp
+
+    def read_holding_registers(self, address, count=1):
+        """
+        Returns:
+            results(tuple): a tuple of holding registers, as ModbusTcpClient.read_holding_registers()
+        """
+        raw = self.read_raw(address, count)[0]
+        return struct.unpack(">{}{}".format(count, "h" if self.signed else "H"), raw)
+
+    def read_hr_commands(self, address, count=1, display_format=FMT_SIGNED_WORD, endianness=BYTE_ORDER_BIG_ENDIAN):
+        """
+        decode count actual values of the latest snapshot, as ModbusTcpClient.read_hr_commands()
+
+        Returns:
+            a tuple of actual values(int/double/float)
+        """
+        codec = get_register_codec(display_format, endianness, self.signed)
+        raw = self.read_raw(address, count * codec.words)[0]
+        return codec.decode_from(raw, count)
+
+    def age(self):
+        """seconds since the latest publish, None before the first publish"""
+        timestamp = self.read_raw(self.ranges[0].address, 0)[2] if self.ranges else 0.0
+        return None if not timestamp else time.time() - timestamp
+
+    def wait_for_update(self, sequence=None, timeout=None, interval=0.001):
+        """
+        block until a snapshot newer than sequence is published, there is no cross process
+        notification so the sequence is polled every interval seconds
+
+        Args:
+            sequence(int): last seen sequence, None for the current one
+            timeout(float): max seconds to wait, None to wait forever
+        Returns:
+            sequence(int): the new sequence, None on timeout
+        """
+        if sequence is None:
+            sequence = self.sequence
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            current = self.sequence
+            if current > sequence:
+                return current
+            if deadline is not None and time.monotonic() >= deadline:
+                return None
+            time.sleep(interval)
+
+    def close(self):
+        self._buffer = None
+        self._segment.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+__all__ = ["RegisterImagePublisher", "RegisterImageReader", "ImageRange", "IMAGE_MAGIC", "IMAGE_VERSION"]
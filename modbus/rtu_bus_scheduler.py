@@ -0,0 +1,525 @@
+'''
+a bus scheduler for many slaves on one multi-drop RTU line
+RtuBusScheduler is the only thread touching the serial port of its ModbusRtuMaster,
+it serves per-slave polls and on-demand requests in priority order, adapts the response timeout
+of every slave to its measured turnaround, keeps the inter-frame gap between frames
+and skips unresponsive slaves for a while so they do not eat the bus
+'''
+
+from collections import namedtuple
+from concurrent.futures import Future
+import heapq, itertools, threading, time
+
+from modbus_tk.modbus import ModbusError
+
+from .connection_supervisor import ExponentialBackoff, is_link_error
+from .glog import logger as logging
+from .instrumentation import Histogram, RTU_FRAMING_BYTES
+from .io_worker import PRIORITY_HIGH, PRIORITY_NORMAL
+from .modbus_tcp_client import FMT_SIGNED_WORD, BYTE_ORDER_BIG_ENDIAN
+from .poll_engine import KIND_REGISTER, KIND_COIL, value_changed
+
+SLAVE_ONLINE = "online"
+SLAVE_SKIPPED = "skipped"
+
+# the largest RTU frame, response size of requests of unknown size
+MAX_RTU_FRAME_BYTES = 256
+
+SLAVE_COUNTERS = ("requests", "errors", "timeouts", "skipped", "probes")
+
+BusSubscription = namedtuple('BusSubscription', ['name', 'slave_id', 'kind', 'address', 'count', 'display_format',
+                                                 'endianness', 'period', 'priority', 'deadband', 'callback'])
+
+
+def _answered(error):
+    """True if the slave answered, with a response or an exception response, error or its cause"""
+    while error is not None:
+        if isinstance(error, ModbusError):
+            return True
+        error = error.__cause__ or error.__context__
+    return False
+
+
+def character_time(baudrate, bytesize=8, parity='N', stopbits=1):
+    """seconds of one character on the line: start bit, data bits, parity bit and stop bits"""
+    return (1 + bytesize + (0 if parity == 'N' else 1) + stopbits) / float(baudrate)
+
+
+def inter_frame_gap(baudrate, bytesize=8, parity='N', stopbits=1):
+    """
+    silent interval between two frames, 3.5 character times,
+    fixed to 1.75ms above 19200 baud as recommended by the modbus serial line specification
+    """
+    if baudrate > 19200:
+        return 0.00175
+    return 3.5 * character_time(baudrate, bytesize, parity, stopbits)
+
+
+class _Slave(object):
+    """timeout estimation, skip state and bus accounting of one slave"""
+
+    def __init__(self, slave_id, priority, min_timeout, max_timeout, initial_timeout, max_failures):
+        self.slave_id = slave_id
+        self.priority = priority
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.initial_timeout = initial_timeout
+        self.max_failures = max_failures
+        # smoothed turnaround and its mean deviation, as the TCP retransmission timer (RFC 6298)
+        self.srtt = None
+        self.rttvar = None
+        self.failures = 0
+        self.skip_until = 0.0
+        self.skip_attempt = 0
+        self.latency = Histogram()
+        self.counters = dict.fromkeys(SLAVE_COUNTERS, 0)
+        self.busy = 0.0
+        self.wire = 0.0
+
+    @property
+    def state(self):
+        return SLAVE_SKIPPED if self.skip_until else SLAVE_ONLINE
+
+    def turnaround_timeout(self):
+        """
+        None until the first answer, the deviation of a steady slave decays to almost nothing,
+        so the margin is at least half the turnaround to absorb the scheduling jitter of the host
+        """
+        if self.srtt is None:
+            return None
+        return self.srtt + max(4 * self.rttvar, self.srtt / 2)
+
+    def timeout(self, response_wire):
+        """
+        response timeout of one request, the response has to be on the line within the turnaround estimate,
+        initial_timeout until the first answer, doubled for every consecutive failure before the skip,
+        a probe of a skipped slave is not doubled so a dead slave holds the line only briefly
+        """
+        turnaround = self.turnaround_timeout()
+        timeout = self.initial_timeout if turnaround is None else response_wire + turnaround
+        if self.failures < self.max_failures:
+            timeout *= 2 ** self.failures
+        return min(self.max_timeout, max(self.min_timeout, timeout))
+
+    def observe_turnaround(self, sample):
+        if self.srtt is None:
+            self.srtt = sample
+            self.rttvar = sample / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - sample)
+            self.srtt = 0.875 * self.srtt + 0.125 * sample
+
+    def reset_report(self):
+        self.latency = Histogram()
+        self.counters = dict.fromkeys(SLAVE_COUNTERS, 0)
+        self.busy = 0.0
+        self.wire = 0.0
+
+
+class _Job(object):
+    """one poll subscription or one on-demand request"""
+
+    __slots__ = ('slave', 'priority', 'due', 'subscription', 'method', 'args', 'kwargs', 'future',
+                 'request_bytes', 'response_bytes')
+
+    def __init__(self, slave, priority, due, subscription=None, method=None, args=(), kwargs=None, future=None,
+                 request_bytes=None, response_bytes=None):
+        self.slave = slave
+        self.priority = priority
+        self.due = due
+        self.subscription = subscription
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.future = future
+        self.request_bytes = request_bytes
+        self.response_bytes = response_bytes
+
+
+class RtuBusScheduler(object):
+    """RtuBusScheduler owns one RTU line, every request to its slaves goes through the scheduler thread"""
+
+    def __init__(self, master, min_timeout=0.02, max_timeout=1.0, initial_timeout=0.1, max_failures=3, backoff=None,
+                 frame_gap=None):
+        """
+        Args:
+            master(ModbusRtuMaster): a running master, its slave_id is set by the scheduler for every request,
+                                     it is not locked against other threads while the scheduler runs
+            min_timeout(float): lower bound of adaptive response timeouts in seconds
+            max_timeout(float): upper bound of adaptive response timeouts
+            initial_timeout(float): timeout until a slave first answers, doubled for every unanswered request,
+                                    a dead slave holds the line for initial_timeout * (2 ** max_failures - 1)
+                                    seconds before it is skipped
+            max_failures(int): count of consecutive unanswered requests after which a slave is skipped
+            backoff(ExponentialBackoff): skip durations of a slave failing again and again
+            frame_gap(float): silent interval between frames in seconds, None for 3.5 character times
+        """
+        self.master = master
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.initial_timeout = initial_timeout
+        self.max_failures = max_failures
+        # one thread probes the slaves of one line, there is no herd to spread with jitter
+        self.backoff = backoff or ExponentialBackoff(initial=1.0, max_delay=30.0, jitter=False)
+        self.character_time = character_time(master.baudrate, master.bytesize, master.parity, master.stopbits)
+        self.frame_gap = frame_gap if frame_gap is not None else inter_frame_gap(
+            master.baudrate, master.bytesize, master.parity, master.stopbits)
+        self._slaves = {}
+        self._subscriptions = {}
+        self._values = {}
+        # (due, sequence, job) of polls not due yet, (priority, due, sequence, job) of due polls and requests
+        self._timers = []
+        self._ready = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._timeout = None
+        self._line_free_at = 0.0
+        self._report_start = time.monotonic()
+        self._gap_time = 0.0
+        self._thread = None
+        self._running = False
+
+    def configure_slave(self, slave_id, priority=PRIORITY_NORMAL, min_timeout=None, max_timeout=None):
+        """
+        set the default priority and timeout bounds of one slave
+
+        Args:
+            priority(int): PRIORITY_* of io_worker or any int, lower is served first
+            min_timeout(float): None for the scheduler min_timeout
+            max_timeout(float): None for the scheduler max_timeout
+        """
+        with self._condition:
+            slave = self._slave(slave_id)
+            slave.priority = priority
+            if min_timeout is not None:
+                slave.min_timeout = min_timeout
+            if max_timeout is not None:
+                slave.max_timeout = max_timeout
+
+    def _slave(self, slave_id):
+        slave = self._slaves.get(slave_id)
+        if slave is None:
+            slave = self._slaves[slave_id] = _Slave(slave_id, PRIORITY_NORMAL, self.min_timeout, self.max_timeout,
+                                                    self.initial_timeout, self.max_failures)
+        return slave
+
+    def subscribe(self, name, slave_id, address, period, display_format=FMT_SIGNED_WORD,
+                  endianness=BYTE_ORDER_BIG_ENDIAN, count=1, priority=None, deadband=0.0, callback=None):
+        """
+        poll holding registers of one slave, see PollEngine.subscribe
+
+        Args:
+            name(str): unique name of the subscription
+            slave_id(int): slave address on the line, 1-247
+            period(float): poll period in seconds
+            count(int): count number of actual values
+            priority(int): None for the priority of the slave
+            callback(callable): callback(name, value, old_value) on every change, called on the scheduler thread
+        """
+        self._add(BusSubscription(name, slave_id, KIND_REGISTER, address, count, display_format, endianness,
+                                  period, priority, deadband, callback))
+
+    def subscribe_coils(self, name, slave_id, address, period, count=1, priority=None, callback=None):
+        """
+        poll coils of one slave, value is 0/1 or a tuple of 0/1 if count > 1
+        """
+        self._add(BusSubscription(name, slave_id, KIND_COIL, address, count, FMT_SIGNED_WORD, BYTE_ORDER_BIG_ENDIAN,
+                                  period, priority, 0.0, callback))
+
+    def _add(self, subscription):
+        if not 1 <= subscription.slave_id <= 247:
+            raise Exception("[Modbus-Error] can not poll slave {}, slave address is 1-247".format(
+                subscription.slave_id))
+        if subscription.kind == KIND_REGISTER:
+            words = subscription.count * (subscription.display_format.bytes // 2)
+            response_bytes = RTU_FRAMING_BYTES + 2 + 2 * words
+        else:
+            response_bytes = RTU_FRAMING_BYTES + 2 + (subscription.count + 7) // 8
+        with self._condition:
+            self._remove(subscription.name)
+            slave = self._slave(subscription.slave_id)
+            job = _Job(slave, subscription.priority, time.monotonic(), subscription=subscription,
+                       request_bytes=RTU_FRAMING_BYTES + 5, response_bytes=response_bytes)
+            self._subscriptions[subscription.name] = job
+            heapq.heappush(self._timers, (job.due, next(self._sequence), job))
+            self._condition.notify_all()
+
+    def unsubscribe(self, name):
+        with self._condition:
+            self._remove(name)
+
+    def _remove(self, name):
+        # a job left in the heaps is dropped when it is popped
+        self._subscriptions.pop(name, None)
+        self._values.pop(name, None)
+
+    def get(self, name):
+        """latest value of a subscription, None before the first read"""
+        with self._condition:
+            return self._values.get(name)
+
+    def submit(self, slave_id, method, *args, priority=PRIORITY_HIGH, **kwargs):
+        """
+        queue one ModbusRtuMaster call for slave_id, eg: submit(3, "write_holding_registers", 100, [1, 2])
+
+        Args:
+            method(str): name of a ModbusRtuMaster method
+            priority(int): lower is served first, requests of one priority are served before due polls of
+                           a larger one
+        Returns:
+            future(concurrent.futures.Future): result of the call, it fails fast while the slave is skipped
+        """
+        if not self._running:
+            raise Exception("[Modbus-Error] bus scheduler of {} is stopped".format(self.master.port))
+        future = Future()
+        with self._condition:
+            job = _Job(self._slave(slave_id), priority, time.monotonic(), method=method, args=args, kwargs=kwargs,
+                       future=future)
+            heapq.heappush(self._ready, (priority, job.due, next(self._sequence), job))
+            self._condition.notify_all()
+        return future
+
+    def execute(self, slave_id, method, *args, priority=PRIORITY_HIGH, timeout=None, **kwargs):
+        """submit() and wait for the result"""
+        return self.submit(slave_id, method, *args, priority=priority, **kwargs).result(timeout)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._running = True
+        # the scheduler thread is the only one on the port, the process-wide lock of modbus_tk is not needed
+        self.master.threadsafe = False
+        self._thread = threading.Thread(target=self._run, name="modbus-rtu-bus-{}".format(self.master.port),
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+            self.master.threadsafe = True
+        with self._condition:
+            pending, self._ready = self._ready, []
+        for _, _, _, job in pending:
+            if job.future is not None:
+                job.future.set_exception(Exception("[Modbus-Error] bus scheduler of {} is stopped".format(
+                    self.master.port)))
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _next_job(self):
+        """pop the first ready job, None once stopped"""
+        with self._condition:
+            while self._running:
+                now = time.monotonic()
+                while self._timers and self._timers[0][0] <= now:
+                    due, sequence, job = heapq.heappop(self._timers)
+                    if job.subscription is None or self._subscriptions.get(job.subscription.name) is not job:
+                        continue
+                    priority = job.priority if job.priority is not None else job.slave.priority
+                    heapq.heappush(self._ready, (priority, due, sequence, job))
+                if not self._ready:
+                    self._condition.wait(self._timers[0][0] - now if self._timers else None)
+                    continue
+                job = heapq.heappop(self._ready)[3]
+                if job.subscription is not None and self._subscriptions.get(job.subscription.name) is not job:
+                    continue
+                slave = job.slave
+                if slave.skip_until > now:
+                    slave.counters["skipped"] += 1
+                    if job.future is not None:
+                        job.future.set_exception(Exception(
+                            "[Modbus-Error] slave {} is skipped for {:.1f}s after {} unanswered requests".format(
+                                slave.slave_id, slave.skip_until - now, slave.failures)))
+                    else:
+                        self._reschedule(job, now)
+                    continue
+                if slave.skip_until:
+                    # the skip is over, this request probes the slave
+                    slave.counters["probes"] += 1
+                return job
+        return None
+
+    def _reschedule(self, job, now):
+        """keep the original phase of a poll, skip missed cycles instead of bursting"""
+        period = job.subscription.period
+        due = job.due + period
+        if due <= now:
+            due = now + period - (now - job.due) % period
+        job.due = due
+        heapq.heappush(self._timers, (due, next(self._sequence), job))
+
+    def _set_timeout(self, timeout):
+        # the serial port is reconfigured on every change, so unchanged timeouts are not set again
+        if timeout != self._timeout:
+            self.master.modbus_rtu_master.set_timeout(timeout)
+            self._timeout = timeout
+
+    def _transact(self, job):
+        """run job on the line, returns (result, error)"""
+        slave = job.slave
+        char = self.character_time
+        response_wire = char * (job.response_bytes if job.response_bytes is not None else MAX_RTU_FRAME_BYTES)
+        self._set_timeout(slave.timeout(response_wire))
+        # the silent interval after the previous frame
+        wait = self._line_free_at - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        self.master.slave_id = slave.slave_id
+        result, error = None, None
+        start = time.monotonic()
+        try:
+            subscription = job.subscription
+            if subscription is None:
+                result = getattr(self.master, job.method)(*job.args, **job.kwargs)
+            elif subscription.kind == KIND_REGISTER:
+                result = self.master.read_hr_commands(subscription.address, subscription.count,
+                                                      subscription.display_format, subscription.endianness)
+                result = result[0] if subscription.count == 1 else tuple(result)
+            else:
+                coils = self.master.read_coils(subscription.address, subscription.count)
+                result = coils[0] if subscription.count == 1 else tuple(coils[:subscription.count])
+        except Exception as e:
+            error = e
+        end = time.monotonic()
+        self._line_free_at = end + self.frame_gap
+        self._account(job, start, end, error)
+        return result, error
+
+    def _account(self, job, start, end, error):
+        slave = job.slave
+        elapsed = end - start
+        with self._condition:
+            slave.counters["requests"] += 1
+            slave.busy += elapsed
+            self._gap_time += self.frame_gap
+            if error is None:
+                slave.latency.observe(elapsed)
+                if job.request_bytes is not None:
+                    wire = self.character_time * (job.request_bytes + job.response_bytes)
+                    slave.wire += wire
+                    slave.observe_turnaround(max(0.0, elapsed - wire))
+            else:
+                slave.counters["errors"] += 1
+            if error is not None and not _answered(error):
+                if not is_link_error(error) or slave.slave_id == 0:
+                    # a local error, eg: a value out of range of its format, nothing was sent,
+                    # or a broadcast which is never answered
+                    return
+                slave.counters["timeouts"] += 1
+                slave.failures += 1
+                if slave.failures >= self.max_failures:
+                    slave.skip_until = end + self.backoff.delay(slave.skip_attempt)
+                    slave.skip_attempt += 1
+                    logging.info("[Modbus] slave {} on {} is skipped for {:.1f}s after {} unanswered requests".format(
+                        slave.slave_id, self.master.port, slave.skip_until - end, slave.failures))
+            else:
+                # an exception response is an answer too
+                if slave.skip_until:
+                    logging.info("[Modbus] slave {} on {} answers again".format(slave.slave_id, self.master.port))
+                slave.failures = 0
+                slave.skip_until = 0.0
+                slave.skip_attempt = 0
+
+    def _publish(self, subscription, value):
+        with self._condition:
+            if subscription.name not in self._subscriptions:
+                # unsubscribed while reading
+                return
+            old = self._values.get(subscription.name)
+            if not value_changed(old, value, subscription.deadband):
+                return
+            self._values[subscription.name] = value
+        if subscription.callback is not None:
+            try:
+                subscription.callback(subscription.name, value, old)
+            except Exception as e:
+                logging.error("[Modbus-Error] callback of {} failed! the error is: {}".format(subscription.name, e))
+
+    def _run(self):
+        while True:
+            job = self._next_job()
+            if job is None:
+                return
+            result, error = self._transact(job)
+            if job.future is not None:
+                if error is None:
+                    job.future.set_result(result)
+                else:
+                    job.future.set_exception(error)
+                continue
+            if error is None:
+                self._publish(job.subscription, result)
+            elif not is_link_error(error):
+                # unanswered polls are counted in the report, an exception response is a configuration error
+                logging.error("[Modbus-Error] poll of {} failed! the error is: {}".format(job.subscription.name,
+                                                                                         error))
+            with self._condition:
+                if self._subscriptions.get(job.subscription.name) is job:
+                    self._reschedule(job, time.monotonic())
+
+    def report(self):
+        """
+        bus utilisation since start or the last reset_report()
+
+        Returns:
+            report(dict): elapsed seconds, busy/gap/idle seconds and utilisation of the line,
+                          per slave its counters, busy seconds, share of the line, wire efficiency,
+                          latency quantiles and the current timeout
+        """
+        with self._condition:
+            elapsed = max(time.monotonic() - self._report_start, 1e-9)
+            slaves = {}
+            busy = 0.0
+            for slave_id, slave in sorted(self._slaves.items()):
+                busy += slave.busy
+                slaves[slave_id] = dict(slave.counters,
+                                        state=slave.state,
+                                        busy=slave.busy,
+                                        utilisation=slave.busy / elapsed,
+                                        efficiency=slave.wire / slave.busy if slave.busy else None,
+                                        p50=slave.latency.quantile(0.5) if slave.latency.count else None,
+                                        p99=slave.latency.quantile(0.99) if slave.latency.count else None,
+                                        turnaround=slave.srtt,
+                                        timeout=slave.timeout(0.0))
+            gap = min(self._gap_time, elapsed - busy)
+            return {"port": self.master.port, "elapsed": elapsed, "busy": busy, "gap": gap,
+                    "idle": max(0.0, elapsed - busy - gap), "utilisation": (busy + gap) / elapsed,
+                    "slaves": slaves}
+
+    def report_text(self):
+        """report() as a table, one row per slave"""
+        report = self.report()
+        lines = ["{} {:.1f}s: line {:.1%} used ({:.1%} frames, {:.1%} gaps)".format(
+            report["port"], report["elapsed"], report["utilisation"], report["busy"] / report["elapsed"],
+            report["gap"] / report["elapsed"]),
+            "{:>5} {:>7} {:>8} {:>7} {:>7} {:>8} {:>7} {:>9} {:>9} {:>9}".format(
+                "slave", "state", "requests", "errors", "skipped", "busy", "share", "p50 ms", "p99 ms",
+                "timeout ms")]
+        for slave_id, slave in report["slaves"].items():
+            lines.append("{:>5} {:>7} {:>8} {:>7} {:>7} {:>7.2f}s {:>7.1%} {:>9} {:>9} {:>9.1f}".format(
+                slave_id, slave["state"], slave["requests"], slave["errors"], slave["skipped"], slave["busy"],
+                slave["utilisation"],
+                "-" if slave["p50"] is None else "{:.1f}".format(slave["p50"] * 1000),
+                "-" if slave["p99"] is None else "{:.1f}".format(slave["p99"] * 1000),
+                slave["timeout"] * 1000))
+        return "\n".join(lines)
+
+    def reset_report(self):
+        with self._condition:
+            for slave in self._slaves.values():
+                slave.reset_report()
+            self._gap_time = 0.0
+            self._report_start = time.monotonic()
+
+
+__all__ = ["RtuBusScheduler", "BusSubscription", "character_time", "inter_frame_gap", "SLAVE_ONLINE",
+           "SLAVE_SKIPPED", "SLAVE_COUNTERS", "MAX_RTU_FRAME_BYTES"]
@@ -0,0 +1,374 @@
+'''
+in-process Modbus stand-in slaves for benchmarks and offline runs
+StandInTcpSlave serves Modbus TCP on localhost, StandInRtuSlave serves Modbus RTU
+over a pseudo-terminal pair, both can emulate slow PLCs by injected latency and dropped replies
+'''
+
+import os, random, select, socket, socketserver, struct, threading, time
+
+import modbus_tk.defines as cst
+import serial
+from modbus_tk import hooks, modbus_rtu, modbus_tcp
+
+from . import mc_protocol_client as mc
+
+HOLDING_REGISTERS_BLOCK = "holding_registers"
+INPUT_REGISTERS_BLOCK = "input_registers"
+COILS_BLOCK = "coils"
+DISCRETE_INPUTS_BLOCK = "discrete_inputs"
+
+
+def free_tcp_port(address="127.0.0.1"):
+    """a tcp port nobody listens on right now"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.bind((address, 0))
+        return sock.getsockname()[1]
+    finally:
+        sock.close()
+
+
+class FaultInjector(object):
+    """delays every reply by latency (+ uniform jitter) seconds and drops drop_rate of them"""
+
+    def __init__(self, latency=0.0, jitter=0.0, drop_rate=0.0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.drop_rate = drop_rate
+        self._random = random.Random(seed)
+        self.dropped = 0
+
+    def delay(self):
+        delay = self.latency + (self._random.uniform(0, self.jitter) if self.jitter else 0.0)
+        if delay > 0:
+            time.sleep(delay)
+
+    def drop(self):
+        if self.drop_rate and self._random.random() < self.drop_rate:
+            self.dropped += 1
+            return True
+        return False
+
+
+def _add_slave_blocks(server, slave_ids, size):
+    for slave_id in slave_ids:
+        slave = server.add_slave(slave_id)
+        slave.add_block(HOLDING_REGISTERS_BLOCK, cst.HOLDING_REGISTERS, 0, size)
+        slave.add_block(INPUT_REGISTERS_BLOCK, cst.ANALOG_INPUTS, 0, size)
+        slave.add_block(COILS_BLOCK, cst.COILS, 0, size)
+        slave.add_block(DISCRETE_INPUTS_BLOCK, cst.DISCRETE_INPUTS, 0, size)
+
+
+class StandInTcpSlave(object):
+    """a modbus_tk TcpServer on localhost with holding/input registers, coils and discrete inputs of every slave id"""
+
+    def __init__(self, port=None, address="127.0.0.1", slave_ids=(1,), size=10000, faults=None):
+        """
+        Args:
+            port(int): tcp port, a free one if None
+            size(int): count of addresses of every block
+            faults(FaultInjector): latency and drops applied to every reply
+        """
+        self.address = address
+        self.port = free_tcp_port(address) if port is None else port
+        self.faults = faults or FaultInjector()
+        self.server = modbus_tcp.TcpServer(port=self.port, address=address)
+        _add_slave_blocks(self.server, slave_ids, size)
+        self._hook = self._before_send
+
+    def _before_send(self, args):
+        server, _, response = args
+        if server is not self.server:
+            return None
+        self.faults.delay()
+        # an empty response is not sent by TcpServer
+        return b"" if self.faults.drop() else response
+
+    def slave(self, slave_id=1):
+        return self.server.get_slave(slave_id)
+
+    def start(self):
+        hooks.install_hook("modbus_tcp.TcpServer.before_send", self._hook)
+        self.server.start()
+        # TcpServer binds in its own thread
+        deadline = time.monotonic() + 5.0
+        while time.monotonic() < deadline:
+            try:
+                socket.create_connection((self.address, self.port), 0.1).close()
+                break
+            except OSError:
+                time.sleep(0.01)
+        return self
+
+    def stop(self):
+        self.server.stop()
+        hooks.uninstall_hook("modbus_tcp.TcpServer.before_send", self._hook)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+class PtyPair(object):
+    """
+    two connected pseudo-terminals, like `socat pty pty`
+    bytes written to one port are read from the other
+    """
+
+    def __init__(self):
+        self._master_a, slave_a = os.openpty()
+        self._master_b, slave_b = os.openpty()
+        self.port_a = os.ttyname(slave_a)
+        self.port_b = os.ttyname(slave_b)
+        # keep the slave ends open so the masters never see EOF
+        self._slaves = (slave_a, slave_b)
+        self._running = True
+        self._thread = threading.Thread(target=self._bridge, name="modbus-pty-bridge", daemon=True)
+        self._thread.start()
+
+    def _bridge(self):
+        peers = {self._master_a: self._master_b, self._master_b: self._master_a}
+        while self._running:
+            readable = select.select(list(peers), [], [], 0.1)[0]
+            for fd in readable:
+                try:
+                    data = os.read(fd, 4096)
+                except OSError:
+                    continue
+                if data:
+                    os.write(peers[fd], data)
+
+    def close(self):
+        self._running = False
+        self._thread.join()
+        for fd in (self._master_a, self._master_b) + self._slaves:
+            os.close(fd)
+
+
+class StandInRtuSlave(object):
+    """
+    a modbus_tk RtuServer on one end of a PtyPair
+    open a ModbusRtuMaster on self.port, the other end, with the same parity
+    """
+
+    def __init__(self, baudrate=115200, parity='N', slave_ids=(1,), size=10000, faults=None):
+        """
+        Args:
+            parity(str): parity of the pty, some kernels reject parity on pseudo-terminals
+        """
+        self.baudrate = baudrate
+        self.parity = parity
+        self.faults = faults or FaultInjector()
+        self.pty = PtyPair()
+        self.port = self.pty.port_b
+        self.server = modbus_rtu.RtuServer(serial.Serial(port=self.pty.port_a, baudrate=baudrate,
+                                                         bytesize=8, parity=parity, stopbits=1))
+        _add_slave_blocks(self.server, slave_ids, size)
+        self._hook = self._before_write
+
+    def _before_write(self, args):
+        server, response = args
+        if server is not self.server:
+            return None
+        self.faults.delay()
+        # an empty response is not written by RtuServer
+        return b"" if self.faults.drop() else response
+
+    def slave(self, slave_id=1):
+        return self.server.get_slave(slave_id)
+
+    def start(self):
+        hooks.install_hook("modbus_rtu.RtuServer.before_write", self._hook)
+        self.server.start()
+        return self
+
+    def stop(self):
+        self.server.stop()
+        hooks.uninstall_hook("modbus_rtu.RtuServer.before_write", self._hook)
+        self.pty.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+class McDeviceRangeError(Exception):
+    """a device number beyond the device memory of a stand-in MC PLC"""
+
+
+class McDeviceMemory(object):
+    """device memory of a stand-in MC PLC, word devices hold 16 bit words and bit devices hold 0/1"""
+
+    def __init__(self, size=65536):
+        self.size = size
+        self.devices = {}
+        self.lock = threading.Lock()
+
+    def points(self, device_type):
+        points = self.devices.get(device_type.code)
+        if points is None:
+            points = self.devices[device_type.code] = [0] * self.size
+        return points
+
+    def check(self, device_type, number, points):
+        """raise McDeviceRangeError unless points points from number exist"""
+        if number + points > self.size:
+            raise McDeviceRangeError("{}{} + {} points is out of range".format(device_type.name, number, points))
+
+    def read_words(self, device_type, number, count):
+        self.check(device_type, number, 16 * count if device_type.bit else count)
+        points = self.points(device_type)
+        if not device_type.bit:
+            return points[number:number + count]
+        # bit devices are accessed in units of 16 points, the first point is bit 0
+        return [sum(points[number + 16 * i + j] << j for j in range(16)) for i in range(count)]
+
+    def write_words(self, device_type, number, words):
+        self.check(device_type, number, 16 * len(words) if device_type.bit else len(words))
+        points = self.points(device_type)
+        if not device_type.bit:
+            points[number:number + len(words)] = [w & 0xFFFF for w in words]
+            return
+        for i, word in enumerate(words):
+            for j in range(16):
+                points[number + 16 * i + j] = word >> j & 1
+
+
+class _McServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class _McRequestHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        server = self.server.stand_in
+        sock = self.request
+        while True:
+            try:
+                header = mc.recv_exactly(sock, mc.HEADER_SIZE)
+                _, length = mc.unpack_header(header)
+                body = mc.recv_exactly(sock, length)
+            except (ConnectionError, OSError):
+                return
+            server.faults.delay()
+            if server.faults.drop():
+                continue
+            try:
+                end_code, data = 0, server.handle(body)
+            except McDeviceRangeError:
+                end_code, data = mc.END_CODE_DEVICE_RANGE, b""
+            except Exception:
+                end_code, data = mc.END_CODE_COMMAND, b""
+            try:
+                sock.sendall(mc.pack_response(header, end_code, data))
+            except OSError:
+                # the client gave up on the request and closed the connection
+                return
+
+
+class StandInMcServer(object):
+    """
+    a Mitsubishi MC protocol 3E binary stand-in PLC on localhost
+    serves batch read/write (0x0401/0x1401), random read/write (0x0403/0x1402) and multi-block read (0x0406)
+    """
+
+    def __init__(self, port=None, address="127.0.0.1", size=65536, faults=None):
+        self.address = address
+        self.port = free_tcp_port(address) if port is None else port
+        self.memory = McDeviceMemory(size)
+        self.faults = faults or FaultInjector()
+        self._server = None
+        self._thread = None
+
+    def handle(self, body):
+        """
+        Args:
+            body(bytes): request data after the header, from the monitoring timer on
+        Returns:
+            data(bytes): response data after the end code
+        """
+        _, command, subcommand = struct.unpack_from("<HHH", body)
+        if subcommand not in (mc.SUBCMD_WORD, mc.SUBCMD_BIT):
+            raise Exception("subcommand 0x{:04X} is not supported".format(subcommand))
+        data = body[6:]
+        memory = self.memory
+        with memory.lock:
+            if command == mc.CMD_BATCH_READ:
+                device_type, number = mc.unpack_device(data)
+                count = struct.unpack_from("<H", data, 4)[0]
+                if subcommand == mc.SUBCMD_BIT:
+                    memory.check(device_type, number, count)
+                    return mc.pack_bits(memory.points(device_type)[number:number + count])
+                return struct.pack("<{}H".format(count), *memory.read_words(device_type, number, count))
+            if command == mc.CMD_BATCH_WRITE:
+                device_type, number = mc.unpack_device(data)
+                count = struct.unpack_from("<H", data, 4)[0]
+                if subcommand == mc.SUBCMD_BIT:
+                    memory.check(device_type, number, count)
+                    memory.points(device_type)[number:number + count] = mc.unpack_bits(data[6:], count)
+                else:
+                    memory.write_words(device_type, number, struct.unpack_from("<{}H".format(count), data, 6))
+                return b""
+            if command == mc.CMD_RANDOM_READ:
+                word_count, dword_count = data[0], data[1]
+                words = []
+                for i in range(word_count):
+                    words += memory.read_words(*mc.unpack_device(data, 2 + 4 * i), 1)
+                for i in range(dword_count):
+                    low, high = memory.read_words(*mc.unpack_device(data, 2 + 4 * (word_count + i)), 2)
+                    words += [low, high]
+                return struct.pack("<{}H".format(len(words)), *words)
+            if command == mc.CMD_RANDOM_WRITE:
+                offset = 1
+                if subcommand == mc.SUBCMD_BIT:
+                    for _ in range(data[0]):
+                        device_type, number = mc.unpack_device(data, offset)
+                        memory.check(device_type, number, 1)
+                        memory.points(device_type)[number] = data[offset + 4] & 1
+                        offset += 5
+                    return b""
+                word_count, dword_count = data[0], data[1]
+                offset = 2
+                for _ in range(word_count):
+                    memory.write_words(*mc.unpack_device(data, offset), struct.unpack_from("<H", data, offset + 4))
+                    offset += 6
+                for _ in range(dword_count):
+                    memory.write_words(*mc.unpack_device(data, offset), struct.unpack_from("<2H", data, offset + 4))
+                    offset += 8
+                return b""
+            if command == mc.CMD_MULTI_BLOCK_READ:
+                word_blocks, bit_blocks = data[0], data[1]
+                words = []
+                for i in range(word_blocks + bit_blocks):
+                    device_type, number = mc.unpack_device(data, 2 + 6 * i)
+                    words += memory.read_words(device_type, number, struct.unpack_from("<H", data, 6 + 6 * i)[0])
+                return struct.pack("<{}H".format(len(words)), *words)
+        raise Exception("command 0x{:04X} is not supported".format(command))
+
+    def start(self):
+        self._server = _McServer((self.address, self.port), _McRequestHandler)
+        self._server.stand_in = self
+        self._thread = threading.Thread(target=self._server.serve_forever, name="mc-stand-in", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+__all__ = ["StandInTcpSlave", "StandInRtuSlave", "StandInMcServer", "McDeviceMemory", "McDeviceRangeError", "PtyPair", "FaultInjector",
+           "free_tcp_port",
+           "HOLDING_REGISTERS_BLOCK", "INPUT_REGISTERS_BLOCK", "COILS_BLOCK", "DISCRETE_INPUTS_BLOCK"]
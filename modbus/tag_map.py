@@ -0,0 +1,126 @@
+'''
+a declarative tag table for ModbusTcpClient
+TagMap plans the fewest READ_HOLDING_REGISTERS requests covering all its tags
+and decodes every tag from the returned blocks
+'''
+
+from collections import namedtuple
+
+from .modbus_tcp_client import FMT_SIGNED_WORD, BYTE_ORDER_BIG_ENDIAN, get_register_codec
+
+# max count of holding registers of one modbus read holding registers request
+MAX_READ_REGISTERS = 125
+
+Tag = namedtuple('Tag', ['name', 'address', 'display_format', 'endianness', 'count'])
+Tag.__new__.__defaults__ = (FMT_SIGNED_WORD, BYTE_ORDER_BIG_ENDIAN, 1)
+
+# one planned request: starting address, count of holding registers and the tags it covers
+ReadBlock = namedtuple('ReadBlock', ['address', 'count', 'tags'])
+
+
+def tag_words(tag):
+    """count of holding registers occupied by tag"""
+    return tag.count * (tag.display_format.bytes // 2)
+
+
+def plan_reads(tags, max_gap=0, max_count=MAX_READ_REGISTERS):
+    """
+    merge the address ranges of tags into the fewest read blocks
+
+    Args:
+        tags(Iterable): Tag list, in any order, overlapping is allowed
+        max_gap(int): max count of unused holding registers allowed between two merged tags
+        max_count(int): max count of holding registers of one read block
+    Returns:
+        blocks(list): a list of ReadBlock sorted by address
+    """
+    blocks = []
+    start = end = None
+    covered = []
+    for tag in sorted(tags, key=lambda t: (t.address, tag_words(t))):
+        words = tag_words(tag)
+        if words > max_count:
+            raise Exception("[Modbus] tag {} spans {} holding registers, more than {}".format(tag.name, words, max_count))
+        tag_end = tag.address + words
+        if start is not None and tag.address - end <= max_gap and max(end, tag_end) - start <= max_count:
+            end = max(end, tag_end)
+            covered.append(tag)
+            continue
+        if start is not None:
+            blocks.append(ReadBlock(start, end - start, tuple(covered)))
+        start, end, covered = tag.address, tag_end, [tag]
+    if start is not None:
+        blocks.append(ReadBlock(start, end - start, tuple(covered)))
+    return blocks
+
+
+class TagMap(object):
+    """TagMap holds named tags and reads all of them with the fewest requests"""
+
+    def __init__(self, tags=(), max_gap=8, max_count=MAX_READ_REGISTERS):
+        self.max_gap = max_gap
+        self.max_count = max_count
+        self._tags = {}
+        self._blocks = None
+        for tag in tags:
+            self.add(tag)
+
+    def add(self, tag):
+        """add or replace a tag by its name"""
+        self._tags[tag.name] = tag
+        self._blocks = None
+
+    def remove(self, name):
+        del self._tags[name]
+        self._blocks = None
+
+    def __len__(self):
+        return len(self._tags)
+
+    def __contains__(self, name):
+        return name in self._tags
+
+    def __getitem__(self, name):
+        return self._tags[name]
+
+    @property
+    def blocks(self):
+        """planned read blocks, re-planned only after tags changed"""
+        if self._blocks is None:
+            self._blocks = plan_reads(self._tags.values(), self.max_gap, self.max_count)
+        return self._blocks
+
+    @staticmethod
+    def decode_block(block, holding_registers, signed, results=None):
+        """
+        decode every tag of block from holding registers read at block.address
+
+        Returns:
+            results(dict): tag name to value, a tuple of values if tag.count > 1
+        """
+        if results is None:
+            results = {}
+        for tag in block.tags:
+            offset = tag.address - block.address
+            codec = get_register_codec(tag.display_format, tag.endianness, signed)
+            values = codec.decode(holding_registers[offset:offset + tag_words(tag)])
+            results[tag.name] = values[0] if tag.count == 1 else values
+        return results
+
+    def read(self, client):
+        """
+        read all tags by client
+
+        Args:
+            client(ModbusTcpClient): a connected client
+        Returns:
+            results(dict): tag name to value, a tuple of values if tag.count > 1
+        """
+        results = {}
+        for block in self.blocks:
+            holding_registers = client.read_holding_registers(block.address, block.count)
+            TagMap.decode_block(block, holding_registers, client.signed, results)
+        return results
+
+
+__all__ = ["Tag", "TagMap", "ReadBlock", "plan_reads", "tag_words", "MAX_READ_REGISTERS"]
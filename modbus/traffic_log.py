@@ -0,0 +1,351 @@
+'''
+time-series capture and replay of modbus register traffic
+TrafficRecorder appends every request of a ModbusTcpClient to a memory-mapped, append-only binary log,
+TrafficLog indexes a log by time and address, ReplayTcpSlave serves the recorded values back
+on localhost at the original or an accelerated speed
+
+log layout, little endian:
+    header  magic "MBTL", version u16, reserved u16, end offset u64
+    entry   time.time() f64, function code u8, slave u8, address u16, count u16, payload size u16, payload
+            the payload holds the registers as sent on the wire (AB), or one byte of 0/1 per coil
+'''
+
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+import heapq, mmap, os, struct, threading, time
+
+import modbus_tk.defines as cst
+
+from .glog import logger as logging
+from .stand_in_servers import (StandInTcpSlave, HOLDING_REGISTERS_BLOCK, INPUT_REGISTERS_BLOCK, COILS_BLOCK,
+                               DISCRETE_INPUTS_BLOCK)
+
+LOG_MAGIC = b"MBTL"
+LOG_VERSION = 1
+
+_HEADER = struct.Struct("<4sHHQ")
+_END_OFFSET = 8
+_ENTRY = struct.Struct("<dBBHHH")
+
+TABLE_HOLDING_REGISTERS = "holding_registers"
+TABLE_INPUT_REGISTERS = "input_registers"
+TABLE_COILS = "coils"
+TABLE_DISCRETE_INPUTS = "discrete_inputs"
+
+# the table a function code reads or writes, and whether its payload holds bits
+_FUNCTION_TABLES = {
+    cst.READ_COILS: (TABLE_COILS, True),
+    cst.READ_DISCRETE_INPUTS: (TABLE_DISCRETE_INPUTS, True),
+    cst.READ_HOLDING_REGISTERS: (TABLE_HOLDING_REGISTERS, False),
+    cst.READ_INPUT_REGISTERS: (TABLE_INPUT_REGISTERS, False),
+    cst.WRITE_SINGLE_COIL: (TABLE_COILS, True),
+    cst.WRITE_SINGLE_REGISTER: (TABLE_HOLDING_REGISTERS, False),
+    cst.WRITE_MULTIPLE_COILS: (TABLE_COILS, True),
+    cst.WRITE_MULTIPLE_REGISTERS: (TABLE_HOLDING_REGISTERS, False),
+}
+
+_TABLE_BLOCKS = {
+    TABLE_HOLDING_REGISTERS: HOLDING_REGISTERS_BLOCK,
+    TABLE_INPUT_REGISTERS: INPUT_REGISTERS_BLOCK,
+    TABLE_COILS: COILS_BLOCK,
+    TABLE_DISCRETE_INPUTS: DISCRETE_INPUTS_BLOCK,
+}
+
+Entry = namedtuple('Entry', ['timestamp', 'function_code', 'slave', 'address', 'count', 'payload'])
+
+
+def entry_values(entry):
+    """
+    Returns:
+        values(tuple): unsigned holding registers, or 0/1 of coils
+    """
+    if _FUNCTION_TABLES[entry.function_code][1]:
+        return tuple(entry.payload)
+    return struct.unpack(">{}H".format(entry.count), entry.payload)
+
+
+class TrafficRecorder(object):
+    """TrafficRecorder appends entries to a log file, attach it by ModbusTcpClient.set_recorder()"""
+
+    def __init__(self, path, chunk_size=1 << 20):
+        """
+        Args:
+            path(str): log file, appended to if it exists
+            chunk_size(int): the file grows by chunk_size bytes, it is cut to its content on close()
+        """
+        self.path = path
+        self.chunk_size = chunk_size
+        self.entries = 0
+        self._lock = threading.Lock()
+        exists = os.path.exists(path) and os.path.getsize(path) >= _HEADER.size
+        self._file = open(path, "r+b" if exists else "w+b")
+        if not exists:
+            self._file.truncate(chunk_size)
+        self._mmap = mmap.mmap(self._file.fileno(), 0)
+        if exists:
+            magic, version, _, self._end = _HEADER.unpack_from(self._mmap)
+            if magic != LOG_MAGIC or version != LOG_VERSION:
+                raise Exception("[Modbus-Error] {} is not a traffic log of version {}".format(path, LOG_VERSION))
+        else:
+            self._end = _HEADER.size
+            _HEADER.pack_into(self._mmap, 0, LOG_MAGIC, LOG_VERSION, 0, self._end)
+
+    def append(self, function_code, slave, address, count, payload, timestamp=None):
+        """
+        append one entry, payload is copied
+
+        Args:
+            payload(bytes/memoryview): registers as sent on the wire, or one byte of 0/1 per coil
+        """
+        size = _ENTRY.size + len(payload)
+        with self._lock:
+            if self._mmap is None:
+                return
+            end = self._end
+            if end + size > len(self._mmap):
+                grow = max(self.chunk_size, size)
+                self._mmap.resize(len(self._mmap) + grow)
+            _ENTRY.pack_into(self._mmap, end, time.time() if timestamp is None else timestamp,
+                             function_code, slave, address, count, len(payload))
+            self._mmap[end + _ENTRY.size:end + size] = payload
+            self._end = end + size
+            # readers trust entries up to the end offset only, it is written last
+            struct.pack_into("<Q", self._mmap, _END_OFFSET, self._end)
+            self.entries += 1
+
+    def record_execute(self, kwargs, result):
+        """
+        append a request executed by TcpMaster.execute(), called by ModbusTcpClient
+        reads are recorded with their results, writes with their output values
+        """
+        function_code = kwargs["function_code"]
+        table = _FUNCTION_TABLES.get(function_code)
+        if table is None:
+            return
+        if function_code in (cst.READ_COILS, cst.READ_DISCRETE_INPUTS, cst.READ_HOLDING_REGISTERS,
+                             cst.READ_INPUT_REGISTERS):
+            values = result
+        else:
+            values = kwargs["output_value"]
+            if function_code in (cst.WRITE_SINGLE_COIL, cst.WRITE_SINGLE_REGISTER):
+                values = (values,)
+        if table[1]:
+            payload = bytes(1 if v else 0 for v in values)
+        else:
+            payload = struct.pack(">{}H".format(len(values)), *[v & 0xFFFF for v in values])
+        self.append(function_code, kwargs["slave"], kwargs["starting_address"], len(values), payload)
+
+    def flush(self):
+        with self._lock:
+            if self._mmap is not None:
+                self._mmap.flush()
+
+    def close(self):
+        with self._lock:
+            if self._mmap is None:
+                return
+            self._mmap.flush()
+            self._mmap.close()
+            self._mmap = None
+            self._file.truncate(self._end)
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class TrafficLog(object):
+    """TrafficLog reads a log, entries are indexed by time and by (slave, table, address range)"""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "rb")
+        self._mmap = None
+        self._times = []
+        self._offsets = []
+        # (slave, table) to {(address, count): (times, entry indexes)} in time order,
+        # polls repeat the same few ranges so a query bisects a few short lists instead of scanning the log
+        self._ranges = {}
+        self._end = _HEADER.size
+        self.refresh()
+
+    def refresh(self):
+        """index the entries appended since the last refresh, a recorder may still be writing"""
+        size = os.fstat(self._file.fileno()).st_size
+        if self._mmap is None or len(self._mmap) != size:
+            if self._mmap is not None:
+                self._mmap.close()
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, _, end = _HEADER.unpack_from(self._mmap)
+        if magic != LOG_MAGIC or version != LOG_VERSION:
+            raise Exception("[Modbus-Error] {} is not a traffic log of version {}".format(self.path, LOG_VERSION))
+        # the file may have grown after it was mapped
+        end = min(end, len(self._mmap))
+        offset = self._end
+        while offset + _ENTRY.size <= end:
+            timestamp, function_code, slave, address, count, size = _ENTRY.unpack_from(self._mmap, offset)
+            if offset + _ENTRY.size + size > end:
+                break
+            index = len(self._offsets)
+            self._times.append(timestamp)
+            self._offsets.append(offset)
+            ranges = self._ranges.setdefault((slave, _FUNCTION_TABLES[function_code][0]), {})
+            times, indexes = ranges.setdefault((address, count), ([], []))
+            times.append(timestamp)
+            indexes.append(index)
+            offset += _ENTRY.size + size
+        self._end = offset
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __getitem__(self, index):
+        offset = self._offsets[index]
+        timestamp, function_code, slave, address, count, size = _ENTRY.unpack_from(self._mmap, offset)
+        start = offset + _ENTRY.size
+        return Entry(timestamp, function_code, slave, address, count, self._mmap[start:start + size])
+
+    @property
+    def start_time(self):
+        return self._times[0] if self._times else None
+
+    @property
+    def end_time(self):
+        return self._times[-1] if self._times else None
+
+    def slaves(self):
+        return sorted({slave for slave, _ in self._ranges})
+
+    def entries(self, start_time=None, end_time=None):
+        """entries of start_time <= timestamp <= end_time in time order"""
+        first = 0 if start_time is None else bisect_left(self._times, start_time)
+        last = len(self._times) if end_time is None else bisect_right(self._times, end_time)
+        for index in range(first, last):
+            yield self[index]
+
+    def find(self, slave, table, address, count=1, start_time=None, end_time=None):
+        """
+        entries of slave touching addresses [address, address + count) of table in time order
+
+        Args:
+            table(str): TABLE_HOLDING_REGISTERS, TABLE_INPUT_REGISTERS, TABLE_COILS or TABLE_DISCRETE_INPUTS
+        """
+        runs = []
+        for times, indexes in self._overlapping(slave, table, address, count):
+            first = 0 if start_time is None else bisect_left(times, start_time)
+            last = len(times) if end_time is None else bisect_right(times, end_time)
+            runs.append(indexes[first:last])
+        for index in heapq.merge(*runs):
+            yield self[index]
+
+    def _overlapping(self, slave, table, address, count):
+        """(times, entry indexes) of every recorded range touching [address, address + count)"""
+        for (first_address, first_count), run in self._ranges.get((slave, table), {}).items():
+            if first_address < address + count and address < first_address + first_count:
+                yield run
+
+    def value_at(self, slave, table, address, timestamp):
+        """
+        latest recorded value of one address at timestamp, None if never recorded before
+
+        Returns:
+            value(int): unsigned holding register or 0/1
+        """
+        latest = -1
+        for times, indexes in self._overlapping(slave, table, address, 1):
+            position = bisect_right(times, timestamp)
+            if position:
+                latest = max(latest, indexes[position - 1])
+        if latest < 0:
+            return None
+        entry = self[latest]
+        return entry_values(entry)[address - entry.address]
+
+    def close(self):
+        self._mmap.close()
+        self._file.close()
+
+
+class ReplayTcpSlave(StandInTcpSlave):
+    """
+    ReplayTcpSlave is a StandInTcpSlave whose memory follows a recorded log,
+    every recorded read result and write is applied at its original time divided by speed
+    """
+
+    def __init__(self, log, speed=1.0, start_time=None, end_time=None, loop=False, port=None,
+                 address="127.0.0.1", size=10000, faults=None):
+        """
+        Args:
+            log(TrafficLog/str): recorded log or its path
+            speed(float): replay speed, 2.0 replays twice as fast, None applies every entry at once
+            start_time(float): entries before start_time are applied before serving, None for the log start
+            end_time(float): entries after end_time are not replayed
+            loop(bool): start over at the end of the log
+        """
+        self.log = TrafficLog(log) if isinstance(log, str) else log
+        super(ReplayTcpSlave, self).__init__(port, address, self.log.slaves() or (1,), size, faults)
+        self.speed = speed
+        self.start_time = self.log.start_time if start_time is None else start_time
+        self.end_time = end_time
+        self.loop = loop
+        self.replayed = 0
+        self.finished = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _apply(self, entry):
+        table = _FUNCTION_TABLES[entry.function_code][0]
+        self.slave(entry.slave).set_values(_TABLE_BLOCKS[table], entry.address, entry_values(entry))
+        self.replayed += 1
+
+    def _try_apply(self, entry):
+        # an entry beyond the stand-in memory is skipped, the replay goes on
+        try:
+            self._apply(entry)
+        except Exception as e:
+            logging.error("[Modbus-Error] replay of entry at {} failed! the error is: {}".format(entry.timestamp, e))
+
+    def _replay(self):
+        while not self._stopped.is_set():
+            if self.start_time is None:
+                break
+            for entry in self.log.entries(end_time=self.start_time):
+                self._try_apply(entry)
+            started = time.monotonic()
+            for entry in self.log.entries(start_time=self.start_time, end_time=self.end_time):
+                if entry.timestamp <= self.start_time:
+                    continue
+                if self.speed:
+                    delay = started + (entry.timestamp - self.start_time) / self.speed - time.monotonic()
+                    if delay > 0 and self._stopped.wait(delay):
+                        return
+                self._try_apply(entry)
+            if not self.loop:
+                break
+        self.finished.set()
+
+    def start(self):
+        super(ReplayTcpSlave, self).start()
+        self._stopped.clear()
+        self.finished.clear()
+        self._thread = threading.Thread(target=self._replay, name="modbus-replay", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        super(ReplayTcpSlave, self).stop()
+
+    def wait(self, timeout=None):
+        """block until the log is replayed, returns False on timeout"""
+        return self.finished.wait(timeout)
+
+
+__all__ = ["TrafficRecorder", "TrafficLog", "ReplayTcpSlave", "Entry", "entry_values", "LOG_MAGIC", "LOG_VERSION",
+           "TABLE_HOLDING_REGISTERS", "TABLE_INPUT_REGISTERS", "TABLE_COILS", "TABLE_DISCRETE_INPUTS"]
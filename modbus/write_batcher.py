@@ -0,0 +1,160 @@
+'''
+a write-behind batcher for ModbusTcpClient holding registers
+WriteBatcher buffers writes for a short window, merges contiguous or overlapping ranges
+(last write wins per register) and sends the fewest WRITE_MULTIPLE_REGISTERS frames
+'''
+
+from concurrent.futures import Future
+import struct, threading
+
+from .glog import logger as logging
+from .modbus_tcp_client import ModbusTcpClient, FMT_SIGNED_WORD, BYTE_ORDER_BIG_ENDIAN
+
+# max count of holding registers of one modbus write multiple registers request
+MAX_WRITE_REGISTERS = 123
+
+
+class _PendingWrite(object):
+    __slots__ = ('address', 'values', 'future')
+
+    def __init__(self, address, values, future):
+        self.address = address
+        self.values = values
+        self.future = future
+
+
+def merge_writes(writes, max_count=MAX_WRITE_REGISTERS):
+    """
+    merge writes into frames, a later write overrides the registers of an earlier one
+
+    Args:
+        writes(list): _PendingWrite list in issue order
+        max_count(int): max count of holding registers of one frame
+    Returns:
+        frames(list): a list of (address, values, futures) sorted by address
+    """
+    registers = {}
+    owners = {}
+    for write in writes:
+        for offset, value in enumerate(write.values):
+            registers[write.address + offset] = value
+            owners.setdefault(write.address + offset, []).append(write.future)
+    frames = []
+    address = values = futures = None
+    for register in sorted(registers):
+        if values is not None and register == address + len(values) and len(values) < max_count:
+            values.append(registers[register])
+        else:
+            if values is not None:
+                frames.append((address, values, futures))
+            address, values, futures = register, [registers[register]], set()
+        futures.update(owners[register])
+    if values is not None:
+        frames.append((address, values, futures))
+    return frames
+
+
+class WriteBatcher(object):
+    """
+    WriteBatcher collects writes to one client and flushes them after window seconds or on flush()
+    a write spanning several frames succeeds only if all of its frames are written,
+    values are checked when a write is buffered, so a bad value fails its own write only
+    """
+
+    def __init__(self, client, window=0.005, max_count=MAX_WRITE_REGISTERS):
+        """
+        Args:
+            client(ModbusTcpClient): a connected client
+            window(float): seconds a write stays buffered before an automatic flush, None to flush explicitly only
+            max_count(int): max count of holding registers of one frame
+        """
+        self.client = client
+        self.window = window
+        self.max_count = max_count
+        self._writes = []
+        self._lock = threading.Lock()
+        # serializes frames of consecutive flushes, keeps barriers ordered
+        self._flush_lock = threading.Lock()
+        self._timer = None
+
+    def write_holding_registers(self, address, holding_register_values):
+        """
+        buffer a write of holding registers
+
+        Returns:
+            future(concurrent.futures.Future): result is None once written, exception on failure
+        """
+        future = Future()
+        future.set_running_or_notify_cancel()
+        values = tuple(holding_register_values)
+        try:
+            # the same format the client packs the merged frame with
+            struct.pack(">{}{}".format(len(values), "h" if self.client.signed else "H"), *values)
+        except Exception as e:
+            return self._failed(future, address, e)
+        with self._lock:
+            self._writes.append(_PendingWrite(address, values, future))
+            if self.window is not None and self._timer is None:
+                self._timer = threading.Timer(self.window, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+        return future
+
+    def write_hr_commands(self, address, values, display_format=FMT_SIGNED_WORD, endianness=BYTE_ORDER_BIG_ENDIAN):
+        """
+        buffer a write of actual values, see ModbusTcpClient.write_hr_commands
+        """
+        try:
+            holding_register_values = ModbusTcpClient.pack_values(values, self.client.signed, display_format,
+                                                                  endianness)
+        except Exception as e:
+            future = Future()
+            future.set_running_or_notify_cancel()
+            return self._failed(future, address, e)
+        return self.write_holding_registers(address, holding_register_values)
+
+    @staticmethod
+    def _failed(future, address, error):
+        future.set_exception(Exception("[Modbus-Error] can not write holding registers at {}! the error is: {}".format(
+            address, error)))
+        return future
+
+    def flush(self):
+        """
+        write every buffered write now, blocks until all frames are sent
+        """
+        with self._flush_lock:
+            with self._lock:
+                writes, self._writes = self._writes, []
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+            if not writes:
+                return
+            failures = {}
+            for address, values, futures in merge_writes(writes, self.max_count):
+                try:
+                    self.client.write_holding_registers(address, values)
+                except Exception as e:
+                    logging.error("[Modbus-Error] batched write at {} failed! the error is: {}".format(address, e))
+                    for future in futures:
+                        failures.setdefault(future, e)
+            for write in writes:
+                if write.future.done():
+                    continue
+                if write.future in failures:
+                    write.future.set_exception(failures[write.future])
+                else:
+                    write.future.set_result(None)
+
+    def barrier(self):
+        """
+        fence: every write issued before the barrier is on the wire before any write issued after it
+        """
+        self.flush()
+
+    def close(self):
+        self.flush()
+
+
+__all__ = ["WriteBatcher", "merge_writes", "MAX_WRITE_REGISTERS"]
@@ -0,0 +1,143 @@
+'''
+McProtocolClient against the local stand-in MC PLC
+'''
+
+import time
+
+import pytest
+
+from modbus.mc_protocol_client import (McProtocolClient, parse_device, DEVICE_TYPES, END_CODE_DEVICE_RANGE,
+                                       END_CODE_COMMAND, CMD_BATCH_READ)
+from modbus.modbus_tcp_client import FMT_SIGNED_2WORD, FMT_FLOAT_2WORD
+from modbus.stand_in_servers import StandInMcServer, FaultInjector
+
+MEMORY_SIZE = 4096
+
+
+@pytest.fixture
+def server():
+    with StandInMcServer(size=MEMORY_SIZE) as server:
+        yield server
+
+
+@pytest.fixture
+def plc(server):
+    plc = McProtocolClient(server_ip=server.address, port=server.port, time_out=2.0, max_retry=3)
+    assert plc.connect()
+    yield plc
+    plc.close()
+
+
+def test_batch_words(plc, server):
+    values = [-1, -32768, -1567, 0, 32766, 16524, 32767, 1, 4567]
+    plc.batch_write_words("D100", values)
+    assert list(plc.batch_read_words("D100", len(values))) == values
+    assert server.memory.points(DEVICE_TYPES["D"])[100] == 0xFFFF
+
+
+def test_batch_words_unsigned(plc):
+    plc.set_signed(False)
+    plc.batch_write_words("W1A", [0xFFFF, 0x8000])
+    assert plc.batch_read_words("W1A", 2) == (0xFFFF, 0x8000)
+
+
+def test_batch_bits(plc, server):
+    values = [1, 0, 1, 1, 0, 0, 0, 1, 1]
+    plc.batch_write_bits("M10", values)
+    assert list(plc.batch_read_bits("M10", len(values))) == values
+    # X is hexadecimal, X1F is point 31
+    plc.batch_write_bits("X1F", [1])
+    assert server.memory.points(DEVICE_TYPES["X"])[31] == 1
+
+
+def test_bit_device_words(plc):
+    # word access to a bit device spans 16 points, the first point is bit 0
+    plc.batch_write_words("M0", [0x0005])
+    assert plc.batch_read_bits("M0", 4) == (1, 0, 1, 0)
+
+
+def test_read_write_commands(plc):
+    dwords = [-1, -123456789, 0, 123456789, 45678912]
+    plc.write_commands("D200", dwords, display_format=FMT_SIGNED_2WORD)
+    assert list(plc.read_commands("D200", len(dwords), display_format=FMT_SIGNED_2WORD)) == dwords
+    # low word first
+    plc.set_signed(False)
+    assert plc.batch_read_words("D206", 2) == (123456789 & 0xFFFF, 123456789 >> 16)
+    plc.set_signed(True)
+    plc.write_commands("D300", [1.5, -2.25], display_format=FMT_FLOAT_2WORD)
+    assert plc.read_commands("D300", 2, display_format=FMT_FLOAT_2WORD) == (1.5, -2.25)
+
+
+def test_random_read_write(plc):
+    plc.random_write([("D10", 7), ("W1A", -2)], [("D300", -123456)])
+    assert plc.random_read(["D10", "W1A"], ["D300"]) == ((7, -2), (-123456,))
+    assert plc.random_read(["D10"]) == ((7,), ())
+    assert plc.random_read(dword_devices=["D300"]) == ((), (-123456,))
+
+
+def test_random_write_bits(plc):
+    plc.random_write_bits([("M5", 1), ("Y10", 1), ("M6", 0)])
+    assert plc.batch_read_bits("M5", 2) == (1, 0)
+    assert plc.batch_read_bits("Y10", 1) == (1,)
+
+
+def test_multi_block_read(plc):
+    plc.batch_write_words("D0", [1, 2, 3])
+    plc.batch_write_words("W100", [-4])
+    plc.batch_write_bits("M16", [1, 1, 0, 1])
+    words, bits = plc.multi_block_read([("D0", 3), ("W100", 1)], [("M16", 1)])
+    assert words == [(1, 2, 3), (-4,)]
+    assert bits[0][:5] == (1, 1, 0, 1, 0)
+    assert len(bits[0]) == 16
+
+
+def test_device_out_of_range(plc):
+    with pytest.raises(Exception, match="end code 0x{:04X}".format(END_CODE_DEVICE_RANGE)):
+        plc.batch_read_words("D{}".format(MEMORY_SIZE - 1), 2)
+    with pytest.raises(Exception, match="end code 0x{:04X}".format(END_CODE_DEVICE_RANGE)):
+        plc.batch_write_bits("M{}".format(MEMORY_SIZE), [1])
+    with pytest.raises(Exception, match="end code 0x{:04X}".format(END_CODE_DEVICE_RANGE)):
+        plc.random_read(["D0", "D{}".format(MEMORY_SIZE)])
+    # the link is still usable after an error end code
+    plc.batch_write_words("D0", [42])
+    assert plc.batch_read_words("D0") == (42,)
+
+
+def test_unsupported_command(plc):
+    with pytest.raises(Exception, match="end code 0x{:04X}".format(END_CODE_COMMAND)):
+        plc._execute(0x0619, 0x0000, b"")
+    with pytest.raises(Exception, match="end code 0x{:04X}".format(END_CODE_COMMAND)):
+        # batch read of subcommand 2 is not served
+        plc._execute(CMD_BATCH_READ, 0x0002, b"\x00\x00\x00\xa8\x01\x00")
+
+
+def test_late_reply_is_not_taken_for_the_next_one():
+    faults = FaultInjector()
+    with StandInMcServer(size=MEMORY_SIZE, faults=faults) as server:
+        plc = McProtocolClient(server_ip=server.address, port=server.port, time_out=0.2, max_retry=1)
+        assert plc.connect()
+        try:
+            plc.batch_write_words("D0", [11, 22])
+            faults.latency = 0.5
+            with pytest.raises(Exception, match=r"\[MC-Error\]"):
+                plc.batch_read_words("D0")
+            faults.latency = 0.0
+            # the reply to D0 is on the line by now
+            time.sleep(0.5)
+            assert plc.batch_read_words("D1") == (22,)
+            assert plc.batch_read_words("D0") == (11,)
+        finally:
+            plc.close()
+
+
+@pytest.mark.parametrize("device, name, number", [("D100", "D", 100), ("x1f", "X", 31), (" W10 ", "W", 16),
+                                                  ("M8000", "M", 8000)])
+def test_parse_device(device, name, number):
+    device_type, device_number = parse_device(device)
+    assert (device_type.name, device_number) == (name, number)
+
+
+@pytest.mark.parametrize("device", ["Q100", "D", "100", "DE", "M1F"])
+def test_parse_device_invalid(device):
+    with pytest.raises(Exception, match=r"\[MC-Error\]"):
+        parse_device(device)
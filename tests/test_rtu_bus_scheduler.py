@@ -0,0 +1,165 @@
+'''
+RtuBusScheduler against local stand-in RTU slaves on a pseudo-terminal
+'''
+
+import threading, time
+
+import modbus_tk.defines as cst
+import pytest
+
+from modbus.connection_supervisor import ExponentialBackoff
+from modbus.modbus_rtu_client import ModbusRtuMaster
+from modbus.rtu_bus_scheduler import RtuBusScheduler, SLAVE_ONLINE, SLAVE_SKIPPED
+from modbus.stand_in_servers import StandInRtuSlave
+
+BAUDRATE = 115200
+DEAD_SLAVE = 9
+
+
+@pytest.fixture
+def line():
+    with StandInRtuSlave(baudrate=BAUDRATE, parity='N', slave_ids=(1, 2)) as line:
+        yield line
+
+
+@pytest.fixture
+def master(line):
+    master = ModbusRtuMaster(line.port, BAUDRATE, parity='N')
+    master.run(timeout=1.0)
+    yield master
+    master.stop()
+
+
+def poll_rate(scheduler, slave_id, seconds):
+    """answered requests per second of slave_id in the next seconds"""
+    scheduler.reset_report()
+    time.sleep(seconds)
+    slave = scheduler.report()["slaves"][slave_id]
+    return (slave["requests"] - slave["errors"]) / seconds
+
+
+def test_polls_keep_phase(master):
+    scheduler = RtuBusScheduler(master, initial_timeout=0.5, max_failures=1)
+    scheduler.subscribe("a", 1, 0, 0.05)
+    with scheduler:
+        time.sleep(0.2)
+        assert poll_rate(scheduler, 1, 1.0) == pytest.approx(20, abs=3)
+        # the unanswered request holds the line for 0.5s, the missed polls are not made up for
+        due = scheduler._subscriptions["a"].due
+        scheduler.reset_report()
+        start = time.monotonic()
+        with pytest.raises(Exception):
+            scheduler.execute(DEAD_SLAVE, "read_holding_registers", 0, 1)
+        time.sleep(0.5)
+        elapsed = time.monotonic() - start
+        assert scheduler.report()["slaves"][1]["requests"] <= (elapsed - 0.5) / 0.05 + 2
+        cycles = (scheduler._subscriptions["a"].due - due) / 0.05
+        assert cycles == pytest.approx(round(cycles), abs=1e-6)
+
+
+def test_adaptive_timeout(line, master):
+    scheduler = RtuBusScheduler(master, min_timeout=0.01, initial_timeout=0.5)
+    scheduler.subscribe("a", 1, 0, 0.02)
+    line.faults.latency = 0.04
+    with scheduler:
+        time.sleep(1.5)
+        slave = scheduler.report()["slaves"][1]
+        # a tight timeout misses a reply now and then on a busy host
+        assert slave["errors"] <= slave["requests"] // 20
+        assert 0.04 < slave["timeout"] < 0.1
+        line.faults.latency = 0.0
+        time.sleep(1.5)
+        slave = scheduler.report()["slaves"][1]
+        assert slave["errors"] <= slave["requests"] // 20
+        assert slave["timeout"] < 0.04
+
+
+def test_dead_slave_is_skipped(line, master):
+    scheduler = RtuBusScheduler(master, initial_timeout=0.05, max_failures=3,
+                                backoff=ExponentialBackoff(initial=1.0, jitter=False))
+    scheduler.subscribe("dead", DEAD_SLAVE, 0, 0.05)
+    with scheduler:
+        time.sleep(0.6)
+        slave = scheduler.report()["slaves"][DEAD_SLAVE]
+        assert slave["state"] == SLAVE_SKIPPED
+        assert slave["timeouts"] == 3
+        # fails fast, nothing is sent
+        with pytest.raises(Exception, match="skipped"):
+            scheduler.execute(DEAD_SLAVE, "read_holding_registers", 0, 1)
+        assert scheduler.report()["slaves"][DEAD_SLAVE]["requests"] == 3
+        # the slave comes up and answers the next probe
+        line.server.add_slave(DEAD_SLAVE).add_block("hr", cst.HOLDING_REGISTERS, 0, 10)
+        time.sleep(1.0)
+        slave = scheduler.report()["slaves"][DEAD_SLAVE]
+        assert slave["state"] == SLAVE_ONLINE
+        assert slave["probes"] >= 1
+        assert scheduler.get("dead") == 0
+
+
+def test_dead_slave_does_not_starve_the_line(master):
+    scheduler = RtuBusScheduler(master)
+    scheduler.subscribe("healthy", 1, 0, 0.05)
+    scheduler.subscribe("dead", DEAD_SLAVE, 0, 0.05)
+    with scheduler:
+        # until the skip, the dead slave holds the line for 0.1 + 0.2 + 0.4s, then 0.1s per probe
+        assert poll_rate(scheduler, 1, 2.0) >= 8
+        assert scheduler.report()["slaves"][DEAD_SLAVE]["state"] == SLAVE_SKIPPED
+        assert poll_rate(scheduler, 1, 2.0) >= 15
+
+
+def test_local_error_is_not_a_failure(line, master):
+    scheduler = RtuBusScheduler(master, max_failures=1)
+    with scheduler:
+        for _ in range(3):
+            # 70000 does not fit in a register, nothing is sent
+            with pytest.raises(Exception):
+                scheduler.execute(1, "write_hr_commands", 0, [70000])
+            # an exception response is an answer
+            with pytest.raises(Exception, match="Modbus-Error"):
+                scheduler.execute(1, "read_holding_registers", 20000, 1)
+        slave = scheduler.report()["slaves"][1]
+        assert slave["state"] == SLAVE_ONLINE
+        assert (slave["errors"], slave["timeouts"]) == (6, 0)
+        scheduler.execute(1, "write_hr_commands", 0, [-2])
+        assert scheduler.execute(1, "read_hr_commands", 0) == (-2,)
+        assert line.slave(1).get_values("holding_registers", 0, 1) == (0xFFFE,)
+
+
+def test_local_error_is_not_an_answer(master):
+    scheduler = RtuBusScheduler(master, initial_timeout=0.05, max_failures=2)
+    with scheduler:
+        with pytest.raises(Exception):
+            scheduler.execute(DEAD_SLAVE, "read_holding_registers", 0, 1)
+        with pytest.raises(Exception):
+            scheduler.execute(DEAD_SLAVE, "write_hr_commands", 0, [70000])
+        with pytest.raises(Exception):
+            scheduler.execute(DEAD_SLAVE, "read_holding_registers", 0, 1)
+        assert scheduler.report()["slaves"][DEAD_SLAVE]["state"] == SLAVE_SKIPPED
+
+
+def test_scheduler_does_not_wait_for_other_lines():
+    with StandInRtuSlave(baudrate=BAUDRATE, parity='N') as line, \
+            StandInRtuSlave(baudrate=BAUDRATE, parity='N') as other_line:
+        master = ModbusRtuMaster(line.port, BAUDRATE, parity='N')
+        other_master = ModbusRtuMaster(other_line.port, BAUDRATE, parity='N', slave_id=DEAD_SLAVE)
+        master.run(timeout=1.0)
+        other_master.run(timeout=1.0)
+
+        def unanswered_read():
+            # a plain master holds the process-wide lock of modbus_tk until its request times out
+            with pytest.raises(Exception):
+                other_master.read_holding_registers(0, 1)
+
+        other = threading.Thread(target=unanswered_read)
+        try:
+            with RtuBusScheduler(master) as scheduler:
+                other.start()
+                time.sleep(0.1)
+                start = time.monotonic()
+                assert scheduler.execute(1, "read_holding_registers", 0, 1) == (0,)
+                assert time.monotonic() - start < 0.5
+            assert master.threadsafe
+        finally:
+            other.join()
+            master.stop()
+            other_master.stop()